@@ -1,10 +1,14 @@
 from flask import Flask, flash, redirect, render_template, request, session, jsonify
 from flask_session import Session
-from chupochess import Board, GameState
-from helpers import DataLayer as dl
-from cs50 import SQL 
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from chupochess import Board, GameState, Chupponnent, MoveRecord, OpeningBook, Tablebase
+from helpers import DataLayer as dl, BoardCache, ConnectionPool, PendingMoves
+import os
 
 INVALID_LOC = 255
+BOOK_PATH = "book.bin"      # opening book of the chupponnent (optional, see book.py)
+TABLEBASE_PATH = "tablebase.bin"    # endgame tablebase (optional, see tablebase.py)
+LONG_POLL_TIMEOUT = 20      # seconds an /awaitOpponent request waits for the chupponnent's move before the FE has to ask again
 
 # Configure application
 app = Flask(__name__)
@@ -17,21 +21,77 @@ app.config["SESSION_PERMANENT"] = False
 app.config["SESSION_TYPE"] = "filesystem"
 Session(app)
 
-# configure database:
-db = SQL("sqlite:///chupochess.db")
+# configure database (pooled connections, shared by the request threads and the chupponnent's background jobs;
+# DB_SYNCHRONOUS=FULL trades commit latency for durability of the last moves on power failure):
+db = ConnectionPool("chupochess.db", synchronous=os.environ.get("DB_SYNCHRONOUS", "NORMAL"))
+dl.migrate(db)
+
+# live boards of the active games (so that e.g. selecting a piece does not need a data base round trip):
+boardCache = BoardCache(maxSize=256, ttl=600)
+dl.cache = boardCache
+
+# optional worker processes for the chupponnent's root-parallel search (created once, reused by every request; 
+# e.g. CHUPPONNENT_WORKERS=4, the default 1 keeps the single process search):
+workers = int(os.environ.get("CHUPPONNENT_WORKERS", 1))
+if workers > 1:
+    Chupponnent.executor = ProcessPoolExecutor(max_workers=workers)
+
+# opening book (memory-mapped, the chupponnent plays book moves without searching):
+if os.path.exists(BOOK_PATH):
+    Chupponnent.book = OpeningBook(BOOK_PATH)
+
+# endgame tablebase (memory-mapped, used by the chupponnent's search and the game end detection):
+if os.path.exists(TABLEBASE_PATH):
+    Chupponnent.tablebase = Tablebase(TABLEBASE_PATH)
+
+# the chupponnent's moves are computed in the background (the request with white's move does not wait for them):
+pendingMoves = PendingMoves(ThreadPoolExecutor(max_workers=4))
 
 def getBoardFromDb(user: str) -> Board:
     """ helper function to get the existing Game (board) or initiate a new one """
+    board = boardCache.get(user)
+    if board is not None:
+        return board
     bytes = dl.getBytes(db, user)
     if bytes:
         # load existing game: 
         board = Board.fromBytes(bytes)
+        boardCache.put(user, board)
     else: 
         # create new game:
         board = Board.startingPosition()
-        dl.storeNewMove(db, user, board.toBytes())
+        storeNewMove(user, board)
     return board
 
+def storeNewMove(user: str, board: Board, move: tuple = None) -> None:
+    """ write-through: stores the board (and the move that led to it, see storedMove) in the data base and keeps it as 
+        the live board of the user """
+    dl.storeNewMove(db, user, board.toBytes(), move)
+    boardCache.put(user, board)
+
+def storedMove(record: MoveRecord) -> tuple:
+    """ the move of an undo record in the format of the move history (source, target, promotion) """
+    return (record.source, record.target, 'Q' if record.promotionIndex is not None else None)
+
+def opponentMove(user: str, whiteBytes: bytes, whiteMove: tuple) -> None:
+    """ background job: searches and makes black's move on a board of its own (decoded from whiteBytes, the live board 
+        is never modified here and keeps answering requests meanwhile), stores white's move (whiteBytes, whiteMove) and 
+        the reply together and then replaces the live board """
+    try:
+        board = Board.fromBytes(whiteBytes)
+        move = board.opponent.generateMove(board)
+        if move:
+            record = board.makeMove(move[0], move[1], True)
+            dl.storeMovePair(db, user, whiteBytes, board.toBytes(), whiteMove, storedMove(record))
+        else:
+            dl.storeNewMove(db, user, whiteBytes, whiteMove)
+        boardCache.put(user, board)
+    except:
+        # white's move has not been stored -> the live board must not be served anymore, the next request reloads 
+        # the game from the data base (the position before white's move)
+        boardCache.invalidate(user)
+        raise
+
 @app.route("/", methods=["GET"])
 def index():
     """Play chess"""
@@ -63,6 +123,7 @@ def requestHandler(endpoint, request):
     response['validMoves'] = []
     response['eogMessage'] = None
     response['notification'] = None
+    response['opponentPending'] = False
     # add initial request to response:
     response['request'] = {}
     response['request']['endpoint'] = endpoint
@@ -71,23 +132,42 @@ def requestHandler(endpoint, request):
 
     # get board representation:
     print(request.environ['REMOTE_ADDR'])
+    if endpoint in ["/drawRequest", "/surrender", "/unmakeMove"]:
+        # these requests change the game -> the chupponnent's move has to be finished first:
+        pendingMoves.wait(request.environ['REMOTE_ADDR'])
     board = getBoardFromDb(request.environ['REMOTE_ADDR'])
 
     # check the request type:
-    if endpoint == "/drawRequest":
+    if endpoint == "/awaitOpponent":
+        # long poll: answer as soon as the chupponnent has moved (or after the timeout, then the FE asks again)
+        if pendingMoves.wait(request.environ['REMOTE_ADDR'], LONG_POLL_TIMEOUT):
+            board = getBoardFromDb(request.environ['REMOTE_ADDR'])
+            response['pieces'] = board.getOutput()
+            if board.gameState == GameState.UNDEFINED:
+                response['eogMessage'] = 'ERROR'
+            elif board.gameState != GameState.IDLE:
+                response['eogMessage'] = board.gameState.name
+        else:
+            response['pieces'] = board.getOutput()
+            response['opponentPending'] = True
+    elif endpoint == "/drawRequest":
         if board.suggestDraw():
             response['pieces'] = board.getOutput() 
             response['eogMessage'] = 'DRAW'
+            # the end of game is not stored (yet) -> the live board must not keep it either:
+            boardCache.invalidate(request.environ['REMOTE_ADDR'])
         else:
             response['notification'] = 'Draw rejected by opponnent.'
     elif endpoint == "/surrender":
         response['pieces'] = board.getOutput() 
         board.whiteSurrenders()
         response['eogMessage'] = 'BLACK_WINS'
+        boardCache.invalidate(request.environ['REMOTE_ADDR'])
     elif endpoint == "/unmakeMove":
         bytes = dl.reverseMove(db, request.environ['REMOTE_ADDR'])
         if bytes: 
             board = Board.fromBytes(bytes)
+            boardCache.put(request.environ['REMOTE_ADDR'], board)
         else: 
             board = getBoardFromDb(request.environ['REMOTE_ADDR']) 
         response['pieces'] = board.getOutput()
@@ -100,7 +180,11 @@ def requestHandler(endpoint, request):
         # 2) source but no target -> valid moves for source piece requested
         # 3) source + target but not a valid move -> valid moves for source piece requested
         # 4) source + target which form a valid move -> make move requested (could lead to EOG or not)
-        if src == INVALID_LOC and tar == INVALID_LOC:
+        if pendingMoves.isPending(request.environ['REMOTE_ADDR']):
+            # it's black's turn -> nothing to select or move until the chupponnent's move has been made
+            response['pieces'] = board.getOutput()
+            response['opponentPending'] = True
+        elif src == INVALID_LOC and tar == INVALID_LOC:
             response['pieces'] = board.getOutput()
         elif src != INVALID_LOC and tar == INVALID_LOC:
             response['pieces'] = board.getOutput()
@@ -110,15 +194,16 @@ def requestHandler(endpoint, request):
             response['validMoves'] = board.getMoves(src)
         elif src != INVALID_LOC and tar != INVALID_LOC and (tar in board.getMoves(src)):
             # make white move: 
-            board.makeMove(src, tar)
-            dl.storeNewMove(db, request.environ['REMOTE_ADDR'], board.toBytes())
-            # generate black move: 
-            generateMove = board.opponent.generateMove(board)
-            if generateMove:
-                board.makeMove(generateMove[0], generateMove[1], True)
-                dl.storeNewMove(db, request.environ['REMOTE_ADDR'], board.toBytes())
+            record = board.makeMove(src, tar)
             response['pieces'] = board.getOutput()
-            if board.gameState != GameState.IDLE:
+            if board.gameState == GameState.IDLE:
+                # generate black move in the background, the FE waits for it via /awaitOpponent
+                # (white's move is stored together with the reply, see opponentMove):
+                pendingMoves.submit(request.environ['REMOTE_ADDR'], opponentMove, request.environ['REMOTE_ADDR'], board.toBytes(), \
+                    storedMove(record))
+                response['opponentPending'] = True
+            else:
+                storeNewMove(request.environ['REMOTE_ADDR'], board, storedMove(record))
                 if board.gameState == GameState.UNDEFINED:
                     response['eogMessage'] = 'ERROR'
                 else:
@@ -131,6 +216,10 @@ def requestHandler(endpoint, request):
 def getBoard():
     return requestHandler("/getBoard", request)
 
+@app.route("/awaitOpponent", methods=["POST"])
+def awaitOpponent():
+    return requestHandler("/awaitOpponent", request)
+
 @app.route("/unmakeMove", methods=["POST"])
 def unmakeMove():
     return requestHandler("/unmakeMove", request)
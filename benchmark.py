@@ -0,0 +1,149 @@
+# benchmarks for the chupochess engine and its storage
+# usage: 'python benchmark.py <benchmark>' from the root dir (see 'python benchmark.py --help')
+
+import argparse
+import itertools
+import os
+import random
+import tempfile
+import time
+from chupochess import Board, Evaluator, GameState
+from helpers import ConnectionPool, DataLayer, MIGRATIONS
+
+# a few positions from different game phases (extended FEN):
+POSITIONS = [
+    'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1 0',
+    'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1 0',
+    'r1k4r/p2nb1p1/2b4p/1p1n1p2/2PP4/3Q1NB1/1P3PPP/R5K1 b - c3 0 19 0',
+    '8/5k2/R4P2/8/8/p2r3p/8/6K1 b - - 1 68 0',
+]
+
+
+def _timeit(function, repetitions: int) -> float:
+    """ returns the average execution time of function in microseconds """
+    start = time.perf_counter()
+    for _ in range(repetitions):
+        function()
+    return (time.perf_counter() - start) / repetitions * 1e6
+
+
+def benchmarkEncoding(repetitions: int = 1000) -> None:
+    """ compares size and encode/decode latency of the legacy protobuf and the compact board encoding """
+    print('%-10s %8s %12s %12s' % ('format', 'bytes', 'encode [us]', 'decode [us]'))
+    for name, encode in [('protobuf', lambda board: board.toProto().SerializeToString()), ('compact', lambda board: board.toCompactBytes())]:
+        size = encodeTime = decodeTime = 0
+        for ext_fen in POSITIONS:
+            board = Board.fromString(ext_fen)
+            blob = encode(board)
+            size += len(blob)
+            encodeTime += _timeit(lambda: encode(board), repetitions)
+            decodeTime += _timeit(lambda: Board.fromBytes(blob), repetitions)
+        n = len(POSITIONS)
+        print('%-10s %8d %12.1f %12.1f' % (name, size / n, encodeTime / n, decodeTime / n))
+
+
+def benchmarkEvaluation(repetitions: int = 2000) -> None:
+    """ evaluations per second of the single evaluation terms and the full evaluation (incremental piece-square 
+        score vs. computing it from scratch) """
+    boards = [Board.fromString(ext_fen) for ext_fen in POSITIONS]
+    evaluator = Evaluator()
+    terms = [
+        ('material', evaluator.material),
+        ('positional', evaluator.positional),
+        ('positional (scratch)', lambda board: board._computePositional()),
+        ('mobility', evaluator.mobility),
+        ('king safety', evaluator.kingSafety),
+        ('evaluate', evaluator.evaluate),
+    ]
+    print('%-22s %14s' % ('term', 'evaluations/s'))
+    for name, function in terms:
+        elapsed = sum(_timeit(lambda: function(board), repetitions) for board in boards) / len(boards)
+        print('%-22s %14.0f' % (name, 1e6 / elapsed))
+
+
+def benchmarkQueries(maxRows: int = 1000000, repetitions: int = 20, pliesPerGame: int = 40) -> None:
+    """ per-request cost of the data layer as the gamestate table grows: initial schema (version 1, no indexes) vs. 
+        the latest schema """
+    blob = Board.startingPosition().toBytes()
+    print('%10s %7s %14s %18s %17s' % ('rows', 'schema', 'getBytes [us]', 'storeNewMove [us]', 'reverseMove [us]'))
+    rows = 10000
+    while rows <= maxRows:
+        games = rows // pliesPerGame
+        for version in (1, len(MIGRATIONS)):
+            with tempfile.TemporaryDirectory() as directory:
+                db = ConnectionPool(os.path.join(directory, 'benchmark.db'))
+                DataLayer.migrate(db, version)
+                with db.connection() as connection, connection:
+                    connection.executemany("INSERT INTO active_games (user, timestamp) VALUES (?, '');", (('user%d' % game,) for game in range(games)))
+                    connection.executemany("INSERT INTO gamestate (game_id, move_id, board) VALUES (?, ?, ?);", \
+                        ((game + 1, move, blob) for game in range(games) for move in range(pliesPerGame)))
+                users = itertools.cycle(['user%d' % game for game in random.sample(range(games), min(games, repetitions))])
+                getBytes = _timeit(lambda: DataLayer.getBytes(db, next(users)), repetitions)
+                storeNewMove = _timeit(lambda: DataLayer.storeNewMove(db, next(users), blob), repetitions)
+                reverseMove = _timeit(lambda: DataLayer.reverseMove(db, next(users)), repetitions)
+                db.close()
+            print('%10d %7d %14.1f %18.1f %17.1f' % (rows, version, getBytes, storeNewMove, reverseMove))
+        rows *= 10
+
+
+def benchmarkCommits(repetitions: int = 200) -> None:
+    """ latency of storing white's move and black's reply: two separate commits (storeNewMove) vs. one transaction 
+        (storeMovePair), per journal mode and synchronous level """
+    blob = Board.startingPosition().toBytes()
+    print('%-9s %-12s %16s %16s' % ('journal', 'synchronous', '2 commits [us]', '1 commit [us]'))
+    for journalMode, synchronous in [('DELETE', 'FULL'), ('WAL', 'FULL'), ('WAL', 'NORMAL')]:
+        with tempfile.TemporaryDirectory() as directory:
+            db = ConnectionPool(os.path.join(directory, 'benchmark.db'), journalMode=journalMode, synchronous=synchronous)
+            DataLayer.migrate(db)
+            DataLayer.storeNewMove(db, 'user', blob)
+            separate = _timeit(lambda: (DataLayer.storeNewMove(db, 'user', blob), DataLayer.storeNewMove(db, 'user', blob)), repetitions)
+            pair = _timeit(lambda: DataLayer.storeMovePair(db, 'user', blob, blob), repetitions)
+            db.close()
+        print('%-9s %-12s %16.1f %16.1f' % (journalMode, synchronous, separate, pair))
+
+
+def benchmarkStorage(games: int = 50, plies: int = 120) -> None:
+    """ data base size and getBytes latency of games with random moves: a full board per ply vs. the move history 
+        (keyframes + move records, see DataLayer.KEYFRAME_INTERVAL) """
+    print('%-10s %12s %14s' % ('history', 'bytes/ply', 'getBytes [us]'))
+    for name, delta in [('snapshots', False), ('moves', True)]:
+        generator = random.Random(0)
+        with tempfile.TemporaryDirectory() as directory:
+            db = ConnectionPool(os.path.join(directory, 'benchmark.db'))
+            DataLayer.migrate(db)
+            stored = 0
+            for game in range(games):
+                board = Board.startingPosition()
+                DataLayer.storeNewMove(db, 'user%d' % game, board.toBytes())
+                for ply in range(plies):
+                    moves = board.getAllMoves(board.activeColor())
+                    if board.gameState != GameState.IDLE or not moves:
+                        break
+                    source, target = generator.choice(moves)
+                    record = board.makeMove(source, target, True)
+                    move = (source, target, 'Q' if record.promotionIndex is not None else None) if delta else None
+                    DataLayer.storeNewMove(db, 'user%d' % game, board.toBytes(), move)
+                    stored += 1
+            with db.connection() as connection:
+                connection.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+                connection.execute("VACUUM;")
+                size = connection.execute("PRAGMA page_count;").fetchone()[0] * connection.execute("PRAGMA page_size;").fetchone()[0]
+            users = itertools.cycle(['user%d' % game for game in range(games)])
+            latency = _timeit(lambda: DataLayer.getBytes(db, next(users)), games)
+            db.close()
+        print('%-10s %12.1f %14.1f' % (name, size / stored, latency))
+
+
+BENCHMARKS = {
+    'commits': benchmarkCommits,
+    'encoding': benchmarkEncoding,
+    'evaluation': benchmarkEvaluation,
+    'queries': benchmarkQueries,
+    'storage': benchmarkStorage,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='chupochess benchmarks')
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS.keys()))
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark]()
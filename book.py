@@ -0,0 +1,15 @@
+# opening book: builds the chupponnent's opening book (see chupochess.OpeningBook) from a file with PGN games
+# usage: 'python book.py games.pgn' from the root dir (see 'python book.py --help'), the app picks up 'book.bin' at startup
+
+import argparse
+from chupochess import OpeningBook, TrainingHelper
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='chupochess opening book builder')
+    parser.add_argument('pgn', help='file with one or more PGN games')
+    parser.add_argument('--output', default='book.bin')
+    parser.add_argument('--plies', type=int, default=20, help='number of halfmoves per game that go into the book')
+    args = parser.parse_args()
+    with open(args.pgn, encoding='utf-8') as file:
+        entries, skipped = OpeningBook.build(TrainingHelper.readPgns(file), args.output, args.plies)
+    print('%d book entries (skipped games: %d) -> %s' % (entries, skipped, args.output))
@@ -1,9 +1,21 @@
-from itertools import filterfalse
-from typing import List, Tuple
+from typing import Callable, Iterable, Iterator, List, TextIO, Tuple
 from anytree import NodeMixin
+from collections import deque
+from concurrent.futures import Executor
 from enum import Enum
+from functools import partial
+from itertools import repeat
+import mmap
+import os
+import random
 import re
+import struct
+import time
 import chupochess_pb2
+try:
+    import numpy as np      # optional: only needed for the training data export (TrainingExporter)
+except ImportError:
+    np = None
 
 INVALID_LOC = 255
 
@@ -47,7 +59,8 @@ class FEN:
     """ https://en.wikipedia.org/wiki/Forsyth%E2%80%93Edwards_Notation """
     def __init__(self, fen: str) -> None:
         inp = fen.split()
-        self.piecePlacement = inp[0]
+        self._piecePlacement = inp[0]
+        self._squares = None
         self.activeColor = inp[1]
         self.castlingAvailability = inp[2]
         self.enPassantTarget = inp[3]
@@ -59,34 +72,263 @@ class FEN:
         # FEN for starting position:
         return cls('rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1')
 
+    @property
+    def piecePlacement(self) -> str:
+        # the piece placement is only built on demand (and then cached until the next move):
+        if self._piecePlacement is None:
+            self._piecePlacement = FEN.piecePlacementFromSquares(self._squares)
+        return self._piecePlacement
+
+    @piecePlacement.setter
+    def piecePlacement(self, piecePlacement: str) -> None:
+        self._piecePlacement = piecePlacement
+
+    def bind(self, squares: dict) -> None:
+        """ binds the FEN to the squares of its board, so that the piece placement can be invalidated (set to None) 
+            on every move and rebuilt lazily """
+        self._squares = squares
+
+    def piecePlacementFromSquares(squares: dict) -> str:
+        ranks = []
+        for rankStart in range(0, 64, 8):
+            rank = ''
+            emptySquares = 0
+            for loc in range(rankStart, rankStart + 8):
+                piece = squares[loc].currentPiece
+                if piece is None:
+                    emptySquares += 1
+                else:
+                    if emptySquares:
+                        rank += str(emptySquares)
+                        emptySquares = 0
+                    rank += piece.identifier
+            if emptySquares:
+                rank += str(emptySquares)
+            ranks.append(rank)
+        return '/'.join(ranks)
+
     def __str__(self) -> str:
         return self.piecePlacement + ' ' + self.activeColor + ' ' + self.castlingAvailability + \
             ' ' + self.enPassantTarget + ' ' + str(self.halfmoveClock) + \
             ' ' + str(self.fullMoveNumber)
 
+class MoveRecord:
+    """ compact undo record of a single move: everything Board.unmakeMove() needs to restore the position before the move
+        (pieces are referenced, not copied -> making and unmaking moves does not allocate any Board/Square/Piece objects) """
+    __slots__ = ('source', 'target', 'movedPiece', 'capturedPiece', 'capturedLocation', 'capturedIndex', 'promotionIndex', 'rookMove',
+        'piecePlacement', 'castlingAvailability', 'enPassantTarget', 'halfmoveClock', 'fullMoveNumber', 'stat', 'kingLocation', 'gameState', 'zobristKey', 'legalMoves', 'legality', 'history', 'historyLength')
+
+    def __init__(self, board: 'Board', source: int, target: int) -> None:
+        self.source = source
+        self.target = target
+        piece = board.squares[source].currentPiece
+        self.movedPiece = piece
+        self.capturedPiece = board.squares[target].currentPiece
+        self.capturedLocation = target
+        self.promotionIndex = None
+        self.rookMove = None
+        if piece.identifier.upper() == 'P':
+            if not self.capturedPiece and board.fen.enPassantTarget != '-' and Location.algebraicSqToAbsoluteSq(board.fen.enPassantTarget) == target:
+                # en passant capture:
+                self.capturedLocation = target + 8 if piece.color == PieceColor.WHITE else target - 8
+                self.capturedPiece = board.squares[self.capturedLocation].currentPiece
+            if piece._isPawnPromotion(target):
+                self.promotionIndex = board.pieces[piece.color].index(piece)
+        elif piece.identifier.upper() == 'K' and abs(target - source) == 2:
+            # castling: the rook moves from the corner to the square the king crossed:
+            self.rookMove = (source + 3, source + 1) if target > source else (source - 4, source - 1)
+        self.capturedIndex = board.pieces[self.capturedPiece.color].index(self.capturedPiece) if self.capturedPiece else None
+        self.piecePlacement = board.fen._piecePlacement       # might be None (not built yet), that's fine
+        self.castlingAvailability = board.fen.castlingAvailability
+        self.enPassantTarget = board.fen.enPassantTarget
+        self.halfmoveClock = board.fen.halfmoveClock
+        self.fullMoveNumber = board.fen.fullMoveNumber
+        self.stat = board.stat
+        self.kingLocation = (board.kingLocation[PieceColor.WHITE], board.kingLocation[PieceColor.BLACK])
+        self.gameState = board.gameState
+        self.zobristKey = board.zobristKey
+        self.legalMoves = board._legalMoves
+        self.legality = board._legality
+        self.history = board.history
+        self.historyLength = len(board.history)
+
+class LegalityContext:
+    """ everything the move filter of a color needs to know about checks and pins, computed once per position:
+        - checkers: bitboard of the opponent pieces giving check
+        - checkMask: the targets that resolve the check (all locations if not in check, none in case of a double check)
+        - pinned: location of every pinned piece -> the locations it may move to without exposing the king
+    """
+    __slots__ = ('checkers', 'checkMask', 'pinned')
+
+    def __init__(self, board: 'Board', color: PieceColor) -> None:
+        kingLocation = board.kingLocation[color]
+        king = board.squares[kingLocation].currentPiece
+        self.checkers = king._attackersOf(board, kingLocation)
+        if not self.checkers:
+            self.checkMask = Bitboard.FULL
+        elif self.checkers & (self.checkers - 1):
+            # double check -> only the king can move:
+            self.checkMask = 0
+        else:
+            checker = self.checkers.bit_length() - 1
+            self.checkMask = BETWEEN[kingLocation][checker] | self.checkers
+        # pins: look from the king through the own pieces at the opponent's sliders, a slider pins if exactly one
+        # (own) piece is in between:
+        opp = 'pnbrqk' if color == PieceColor.WHITE else 'PNBRQK'
+        bb = board.bitboards
+        oppOccupancy = board.occupancy[color.inverse()]
+        snipers = (Bitboard.slidingAttacks(kingLocation, oppOccupancy, Bitboard.DIAGONALS) & (bb[opp[2]] | bb[opp[4]])) | \
+            (Bitboard.slidingAttacks(kingLocation, oppOccupancy, Bitboard.LINES) & (bb[opp[3]] | bb[opp[4]]))
+        occupied = board.occupied()
+        self.pinned = {}
+        for sniper in Bitboard.toLocations(snipers):
+            blockers = BETWEEN[kingLocation][sniper] & occupied
+            if blockers and not blockers & (blockers - 1) and blockers & board.occupancy[color]:
+                # a pinned knight can never move, every other piece may move along the pin line:
+                self.pinned[blockers.bit_length() - 1] = 0 if blockers & bb[opp[1].swapcase()] else LINE[kingLocation][sniper]
+
+
 class Board(NodeMixin):
     def __init__(self, fen: FEN, unmakeCounter: int, squares: dict, pieces: dict, kingLocation: dict, stat: int, gameState: GameState, parent=None, children=None) -> None:
         self.fen = fen
         self.unmakeCounter = unmakeCounter
         self.squares = squares
+        self.fen.bind(squares)
         self.pieces = pieces
+        self.material = dict.fromkeys('PNBRQKpnbrqk', 0)     # piece count per identifier, kept in sync by removePiece/promotions
+        for color in pieces:
+            for piece in pieces[color]:
+                self.material[piece.identifier] += 1
         self.kingLocation = kingLocation
         self.stat = stat
         self.gameState = gameState    
+        self._legalMoves = {}           # legal move cache of the side to move (location -> targets), reset on every move
+        self._legality = {}             # LegalityContext per color, reset on every move
+        self._initBitboards()
+        self.zobristKey = self._computeZobristKey()
+        self.positional = self._computePositional()
+        self.history = []               # zobrist keys of the previous positions since the last irreversible move (oldest first)
         self.parent = parent
         if children:
             self.children = children
         self.opponent = Chupponnent()
 
+    def _initBitboards(self) -> None:
+        """ builds the bitboard representation (one 64-bit integer per piece identifier plus one occupancy
+            integer per color) from the squares dict; afterwards, both are kept in sync by _placePiece/_liftPiece """
+        self.bitboards = dict.fromkeys('PNBRQKpnbrqk', 0)
+        self.occupancy = {PieceColor.WHITE: 0, PieceColor.BLACK: 0}
+        for loc in range(64):
+            piece = self.squares[loc].currentPiece
+            if piece:
+                self.bitboards[piece.identifier] |= 1 << loc
+                self.occupancy[piece.color] |= 1 << loc
+
+    def _computeZobristKey(self) -> int:
+        """ computes the 64-bit zobrist key of the position from scratch; afterwards, it is updated incrementally 
+            (see _placePiece/_liftPiece, removeCastlingRights, setEnPassantTarget and _applyMove) """
+        key = 0
+        for identifier, bitboard in self.bitboards.items():
+            for loc in Bitboard.toLocations(bitboard):
+                key ^= ZOBRIST_PIECES[identifier][loc]
+        if self.fen.activeColor == 'b':
+            key ^= ZOBRIST_BLACK_TO_MOVE
+        for char in self.fen.castlingAvailability.replace('-', ''):
+            key ^= ZOBRIST_CASTLING[char]
+        if self.fen.enPassantTarget != '-':
+            key ^= ZOBRIST_EN_PASSANT[self.fen.enPassantTarget[0]]
+        return key
+
+    def _computePositional(self) -> int:
+        """ computes the piece-square score of the position (in centipawns, from white's point of view) from scratch;
+            afterwards, it is updated incrementally (see _placePiece/_liftPiece) """
+        score = 0
+        for identifier, bitboard in self.bitboards.items():
+            for loc in Bitboard.toLocations(bitboard):
+                score += PIECE_SQUARE[identifier][loc]
+        return score
+
+    def _placePiece(self, piece: object, location: int) -> None:
+        self.squares[location].set(piece)
+        bit = 1 << location
+        self.bitboards[piece.identifier] |= bit
+        self.occupancy[piece.color] |= bit
+        self.zobristKey ^= ZOBRIST_PIECES[piece.identifier][location]
+        self.positional += PIECE_SQUARE[piece.identifier][location]
+
+    def _liftPiece(self, location: int) -> object:
+        """ empties the square and returns the piece that was standing there (or None) """
+        piece = self.squares[location].reset()
+        if piece:
+            mask = ~(1 << location)
+            self.bitboards[piece.identifier] &= mask
+            self.occupancy[piece.color] &= mask
+            self.zobristKey ^= ZOBRIST_PIECES[piece.identifier][location]
+            self.positional -= PIECE_SQUARE[piece.identifier][location]
+        return piece
+
+    def occupied(self) -> int:
+        return self.occupancy[PieceColor.WHITE] | self.occupancy[PieceColor.BLACK]
+
     def toBytes(self) -> bytes:
-        return self.toProto().SerializeToString()
+        return self.toCompactBytes()
 
     @classmethod
     def fromBytes(cls, bytes: bytes):
+        """ reads both the compact encoding and the (legacy) protobuf encoding """
+        if bytes[:len(COMPACT_MAGIC)] == COMPACT_MAGIC:
+            return cls.fromCompactBytes(bytes)
         proto = chupochess_pb2.Board()
         proto.ParseFromString(bytes)
         return cls.fromProto(proto)
 
+    def toCompactBytes(self) -> bytes:
+        """ compact encoding, variable length: a fixed 48 byte header (magic + version, one nibble per square (2 squares 
+            per byte), then flags (side to move + castling rights), en passant square, clocks, unmake counter, stat and 
+            game state), followed by the position history for the repetition detection: 8 bytes per entry (one zobrist key 
+            per position since the last irreversible move) """
+        codes = [COMPACT_CODES[square.currentPiece.identifier] if square.currentPiece else 0 for square in (self.squares[loc] for loc in range(64))]
+        placement = bytes((codes[i] << 4) | codes[i + 1] for i in range(0, 64, 2))
+        flags = 1 if self.fen.activeColor == 'b' else 0
+        for bit, char in enumerate('KQkq'):
+            if char in self.fen.castlingAvailability:
+                flags |= 2 << bit
+        enPassant = INVALID_LOC if self.fen.enPassantTarget == '-' else Location.algebraicSqToAbsoluteSq(self.fen.enPassantTarget)
+        return COMPACT_MAGIC + COMPACT_FORMAT.pack(COMPACT_VERSION, placement, flags, enPassant, int(self.fen.halfmoveClock), \
+            int(self.fen.fullMoveNumber), self.unmakeCounter, self.stat, self.gameState.value) + \
+            struct.pack('<%dQ' % len(self.history), *self.history)
+
+    @classmethod
+    def fromCompactBytes(cls, bytes: bytes):
+        version, placement, flags, enPassant, halfmoveClock, fullMoveNumber, unmakeCounter, stat, gameState = \
+            COMPACT_FORMAT.unpack_from(bytes, len(COMPACT_MAGIC))
+        if version not in (1, COMPACT_VERSION):
+            raise Exception("ERROR: Unknown compact board version: " + str(version))
+        castling = ''.join(char for bit, char in enumerate('KQkq') if flags & (2 << bit))
+        fen = FEN('- ' + ('b' if flags & 1 else 'w') + ' ' + (castling or '-') + ' ' + \
+            ('-' if enPassant == INVALID_LOC else Location.absoluteSqToAlgebraicSq(enPassant)) + ' ' + str(halfmoveClock) + ' ' + str(fullMoveNumber))
+        fen.piecePlacement = None       # built from the squares on demand
+        squares = {}
+        pieces = {PieceColor.WHITE: [], PieceColor.BLACK: []}
+        kingLocation = {}
+        for loc in range(64):
+            code = (placement[loc >> 1] >> 4) if loc % 2 == 0 else (placement[loc >> 1] & 0x0F)
+            if code:
+                identifier = COMPACT_IDENTIFIERS[code]
+                color = PieceColor.WHITE if identifier.isupper() else PieceColor.BLACK
+                piece = PieceFactory.switcher[identifier.upper()](color, loc)
+                squares[loc] = Square(loc, True, piece)
+                pieces[color].append(piece)
+                if identifier.upper() == 'K':
+                    kingLocation[color] = loc
+            else:
+                squares[loc] = Square(loc)
+        board = cls(fen, unmakeCounter, squares, pieces, kingLocation, stat, GameState(gameState))
+        # position history (version 2+, the rest of the blob):
+        offset = len(COMPACT_MAGIC) + COMPACT_FORMAT.size
+        board.history = list(struct.unpack_from('<%dQ' % ((len(bytes) - offset) // 8), bytes, offset))
+        return board
+
     def toProto(self) -> chupochess_pb2.Board:
         proto = chupochess_pb2.Board()
         proto.fen = str(self.fen)
@@ -109,24 +351,12 @@ class Board(NodeMixin):
 
     @classmethod
     def fromProto(cls, proto: chupochess_pb2.Board):
-        fen = FEN(proto.fen)
-        unmakeCounter = proto.unmakeCounter
-        kingLocation = {}
-        kingLocation[PieceColor.WHITE] = proto.whiteKingLocation
-        kingLocation[PieceColor.BLACK] = proto.blackKingLocation
-        stat = proto.stat
-        gameState = GameState(proto.gameState)
-        squares = {}
-        for key in proto.squares.keys():
-            squares[key] = Square.fromProto(proto.squares[key])
-        pieces = {}
-        pieces[PieceColor.WHITE] = []
-        pieces[PieceColor.BLACK] = []
-        for key in proto.whitePieces.keys():
-            pieces[PieceColor.WHITE].append(Piece.fromProto(proto.whitePieces[key]))
-        for key in proto.blackPieces.keys():
-            pieces[PieceColor.BLACK].append(Piece.fromProto(proto.blackPieces[key]))
-        return cls(fen, unmakeCounter, squares, pieces, kingLocation, stat, gameState)
+        # the squares and piece lists of the proto are separate copies of the same pieces -> the board is rebuilt from
+        # the FEN, so that both reference the same Piece objects (the engine moves the pieces in place)
+        board = cls.fromFen(FEN(proto.fen), proto.unmakeCounter)
+        board.stat = proto.stat
+        board.gameState = GameState(proto.gameState)
+        return board
 
     @classmethod
     def fromFen(cls, fen: FEN, unmakeCounter: int, parent=None, children=None):
@@ -175,71 +405,119 @@ class Board(NodeMixin):
                 output[i] = ''
         return output
     def getMoves(self, location: int, chupponnentMove: bool = False) -> List[int]:
-        if self.gameState != GameState.IDLE:
+        """ returns the valid target locations of the piece on location
+            hint: for the side to move, the lists are cached until the next move -> do not modify the returned list """
+        piece = self.squares[location].currentPiece
+        if self.gameState != GameState.IDLE or piece is None:
             return []
-        elif self.squares[location].isOccupied and self.squares[location].currentPiece.color == PieceColor.WHITE:
-            return self.squares[location].currentPiece.getValidMoves(self)
-        elif self.squares[location].isOccupied and chupponnentMove:    # we trust our chupponnent to just query for occupied squares
-            return self.squares[location].currentPiece.getValidMoves(self)
-        else:
+        elif piece.color != PieceColor.WHITE and not chupponnentMove:    # we trust our chupponnent to just query for occupied squares
             return []
-
-    def makeMove(self, source: int, target: int, chupponnentMove: bool = False) -> int:
-        # returns true/false whether move was made successfully
-        if target in self.getMoves(source, chupponnentMove):
-            # update halfmove clock: 
-            if self.squares[target].isOccupied or self.squares[source].currentPiece.identifier.upper() == 'P':
-                self.fen.halfmoveClock = '0'
-            else:
-                self.fen.halfmoveClock = str(int(self.fen.halfmoveClock) + 1)
-            self.squares[source].currentPiece.makeMove(self, target)
-            # update FEN for successful move:
-            # 1) piece placement: fen
-            self.fen.piecePlacement = ''
-            emptySquares = 0 
-            for loc in range(64):
-                if loc % 8 == 0 and loc > 0 :
-                    if emptySquares != 0 :
-                        self.fen.piecePlacement += str(emptySquares)
-                        emptySquares = 0
-                    self.fen.piecePlacement += '/'
-                if not self.squares[loc].isOccupied:
-                    emptySquares += 1
-                elif emptySquares == 0:
-                    self.fen.piecePlacement += str(self.squares[loc].currentPiece)
-                else:
-                    self.fen.piecePlacement += str(emptySquares)
-                    emptySquares = 0
-                    self.fen.piecePlacement += str(self.squares[loc].currentPiece)
-                if loc == 63 and emptySquares > 0:
-                    self.fen.piecePlacement += str(emptySquares)
-            # 2) active color: 
-            self.fen.activeColor = 'b' if self.fen.activeColor == 'w' else 'w'
-            # move count: 
-            if self.fen.activeColor == 'w':
-                self.fen.fullMoveNumber = str(int(self.fen.fullMoveNumber) + 1)  # increase full move count after black's move
-            self._updateGameState()  
-        return self.gameState.value   
+        elif (piece.color == PieceColor.WHITE) != (self.fen.activeColor == 'w'):
+            # not this side's turn -> nothing to share
+            return piece.getValidMoves(self)
+        moves = self._legalMoves.get(location)
+        if moves is None:
+            moves = piece.getValidMoves(self)
+            self._legalMoves[location] = moves
+        return moves
+
+    def makeMove(self, source: int, target: int, chupponnentMove: bool = False) -> 'MoveRecord':
+        # returns the undo record if the move was made successfully or None if it was not a valid move
+        if target not in self.getMoves(source, chupponnentMove):
+            return None
+        record = self._applyMove(source, target)
+        self._updateGameState()
+        return record
+
+    def _applyMove(self, source: int, target: int) -> 'MoveRecord':
+        """ makes the move without validating it and without updating the game state, returns the undo record
+            hint: only use this for moves that are known to be valid (e.g. taken from getAllMoves()) """
+        record = MoveRecord(self, source, target)
+        # update halfmove clock: 
+        # and the position history (positions before an irreversible move can never be repeated):
+        if record.capturedPiece or record.movedPiece.identifier.upper() == 'P':
+            self.fen.halfmoveClock = '0'
+            self.history = []
+        else:
+            self.fen.halfmoveClock = str(int(self.fen.halfmoveClock) + 1)
+            self.history.append(self.zobristKey)
+        record.movedPiece.makeMove(self, target)
+        self._legalMoves = {}
+        self._legality = {}
+        # update FEN for successful move:
+        # 1) piece placement: invalidate, will be rebuilt on demand
+        self.fen.piecePlacement = None
+        # 2) active color: 
+        self.fen.activeColor = 'b' if self.fen.activeColor == 'w' else 'w'
+        self.zobristKey ^= ZOBRIST_BLACK_TO_MOVE
+        # move count: 
+        if self.fen.activeColor == 'w':
+            self.fen.fullMoveNumber = str(int(self.fen.fullMoveNumber) + 1)  # increase full move count after black's move
+        return record
+
+    def unmakeMove(self, record: 'MoveRecord') -> None:
+        """ restores the position before the move of record in place
+            hint: records have to be unmade in reverse order (the last move made is the first one to be unmade) """
+        piece = record.movedPiece
+        color = piece.color
+        if record.promotionIndex is not None:
+            # remove the promoted piece and bring back the pawn:
+            promotedPiece = self._liftPiece(record.target)
+            self.pieces[color].remove(promotedPiece)
+            self.pieces[color].insert(record.promotionIndex, piece)
+            self.material[promotedPiece.identifier] -= 1
+            self.material[piece.identifier] += 1
+        else:
+            self._liftPiece(record.target)
+        self._placePiece(piece, record.source)
+        if record.rookMove:
+            self._placePiece(self._liftPiece(record.rookMove[1]), record.rookMove[0])
+        if record.capturedPiece:
+            self._placePiece(record.capturedPiece, record.capturedLocation)
+            self.pieces[record.capturedPiece.color].insert(record.capturedIndex, record.capturedPiece)
+            self.material[record.capturedPiece.identifier] += 1
+        self.fen.piecePlacement = record.piecePlacement
+        self.fen.activeColor = 'w' if color == PieceColor.WHITE else 'b'
+        self.fen.castlingAvailability = record.castlingAvailability
+        self.fen.enPassantTarget = record.enPassantTarget
+        self.fen.halfmoveClock = record.halfmoveClock
+        self.fen.fullMoveNumber = record.fullMoveNumber
+        self.stat = record.stat
+        self.kingLocation[PieceColor.WHITE], self.kingLocation[PieceColor.BLACK] = record.kingLocation
+        self.gameState = record.gameState
+        self.zobristKey = record.zobristKey
+        self._legalMoves = record.legalMoves
+        self._legality = record.legality
+        self.history = record.history
+        del self.history[record.historyLength:]
 
     def _updateGameState(self) -> None:
-        color = PieceColor.WHITE if self.fen.activeColor == 'w' else PieceColor.BLACK
-        kingMoveCount = len(self.getMoves(self.kingLocation[color], True))
+        color = self.activeColor()
+        tablebaseValue = Chupponnent.tablebase.probe(self) if Chupponnent.tablebase is not None else None
 
         if self._isInsufficientMaterial():
             self.gameState = GameState.DRAW
         elif int(self.fen.halfmoveClock) >= 150:
             # 75-move-rule:
             self.gameState = GameState.DRAW
-        # TODO: fivefold repetition rule!
-        elif kingMoveCount > 0:
+        elif self.repetitionCount() >= 5:
+            # fivefold repetition rule:
+            self.gameState = GameState.DRAW
+        elif tablebaseValue is not None and tablebaseValue != Tablebase.DRAW:
+            # small endgame: the tablebase knows checkmate/stalemate without generating any moves
+            if tablebaseValue == Tablebase.MATE:
+                self._colorXwins(color.inverse())
+            elif tablebaseValue == Tablebase.STALEMATE:
+                self.gameState = GameState.DRAW
+        elif len(self.getMoves(self.kingLocation[color], True)) > 0:
             # (for performance): if the king has at least one valid move, the game is not over:
             return          
-        elif len(self.squares[self.kingLocation[color]].currentPiece.isInCheck(self)) >= 2:
+        elif self.legalityContext(color).checkMask == 0:
             # 2 opponent pieces attacking and no valid king moves -> checkmate
             self._colorXwins(color.inverse())
-        elif len(self.getAllMoves(color)) == 0:
+        elif not self.hasAnyLegalMove(color):
             # no valid moves -> check if in check
-            if len(self.squares[self.kingLocation[color]].currentPiece.isInCheck(self)) > 0:
+            if self.legalityContext(color).checkers:
                 # checkmate: 
                 self._colorXwins(color.inverse())
             else:
@@ -255,17 +533,11 @@ class Board(NodeMixin):
             self.stat = -10000
         
     def _isInsufficientMaterial(self) -> bool:
-        if len(self.pieces[PieceColor.WHITE]) > 2 or len(self.pieces[PieceColor.BLACK]) > 2:
+        material = self.material
+        if material['P'] or material['R'] or material['Q'] or material['p'] or material['r'] or material['q']:
             return False
-        else:
-            # check for pieces other than king, bishop and knight:
-            for piece in self.pieces[PieceColor.WHITE]:
-                if piece.identifier not in ['K', 'B', 'N']:
-                    return False
-            for piece in self.pieces[PieceColor.BLACK]:
-                if piece.identifier not in ['k', 'b', 'n']:
-                    return False
-            return True
+        # only kings and at most one minor piece (bishop or knight) per side left:
+        return material['B'] + material['N'] <= 1 and material['b'] + material['n'] <= 1
 
     def removePiece(self, piece: object) -> None:
         if not piece: return
@@ -273,6 +545,7 @@ class Board(NodeMixin):
         for pieces in self.pieces[piece.color]:
             if pieces.identifier == piece.identifier and pieces.location == piece.location:
                 self.pieces[piece.color].remove(pieces)
+                self.material[piece.identifier] -= 1
                 return
 
     def getPGN(self, extendedFens: List[str]) -> str:
@@ -288,19 +561,74 @@ class Board(NodeMixin):
         for char in self.fen.castlingAvailability:
             if char not in toBeDeleted:
                 newFen += char
+            else:
+                self.zobristKey ^= ZOBRIST_CASTLING[char]
         if newFen == '': 
             newFen = '-'
         self.fen.castlingAvailability = newFen
 
+    def activeColor(self) -> PieceColor:
+        return PieceColor.WHITE if self.fen.activeColor == 'w' else PieceColor.BLACK
+
+    def setEnPassantTarget(self, target: str) -> None:
+        # target in algebraic notation or '-'
+        if self.fen.enPassantTarget != '-':
+            self.zobristKey ^= ZOBRIST_EN_PASSANT[self.fen.enPassantTarget[0]]
+        if target != '-':
+            self.zobristKey ^= ZOBRIST_EN_PASSANT[target[0]]
+        self.fen.enPassantTarget = target
+
+    def legalityContext(self, color: PieceColor) -> 'LegalityContext':
+        """ returns the checks and pins of color in the current position (computed on the first request) """
+        context = self._legality.get(color)
+        if context is None:
+            context = LegalityContext(self, color)
+            self._legality[color] = context
+        return context
+
+    def repetitionCount(self) -> int:
+        """ returns how often the current position occurred (including now) since the last irreversible move """
+        # only every second position has the same side to move:
+        return self.history[-2::-2].count(self.zobristKey) + 1
+
+    def hasAnyLegalMove(self, color: PieceColor) -> bool:
+        """ returns True if color has at least one valid move (stops at the first piece that can move) """
+        for location in Bitboard.toLocations(self.occupancy[color]):
+            if self.getMoves(location, True):
+                return True
+        return False
+
     def getAllMoves(self, color: PieceColor) -> List[Tuple[int,int]]:
         """ returns a List of all possible moves for all pieces of the input color (Format: Tuple[source: int, target: int]) """
         lst = []
-        for piece in self.pieces[color]:
-            validMoves = self.getMoves(piece.location, True)
-            for move in validMoves:
-                lst.append((piece.location, move))
+        for location in Bitboard.toLocations(self.occupancy[color]):
+            for move in self.getMoves(location, True):
+                lst.append((location, move))
+        return lst
+
+    def getAllCaptures(self, color: PieceColor) -> List[Tuple[int,int]]:
+        """ like getAllMoves(), but only captures and promotions (quiet moves are not generated at all)
+            hint: if color is in check, use getAllMoves() for the evasions - the check mask limits them to the few moves
+            that resolve the check anyway """
+        lst = []
+        if self.gameState != GameState.IDLE:
+            return lst
+        for location in Bitboard.toLocations(self.occupancy[color]):
+            for move in self.squares[location].currentPiece.getValidCaptures(self):
+                lst.append((location, move))
         return lst
 
+    def attackersTo(self, location: int, occupied: int) -> int:
+        """ returns a bitboard of the pieces of both colors attacking location, given the occupancy (sliders are
+            blocked by the pieces in occupied; pieces not in occupied are still returned) """
+        bb = self.bitboards
+        diagonal = bb['B'] | bb['Q'] | bb['b'] | bb['q']
+        linear = bb['R'] | bb['Q'] | bb['r'] | bb['q']
+        return (KNIGHT_ATTACKS[location] & (bb['N'] | bb['n'])) | (KING_ATTACKS[location] & (bb['K'] | bb['k'])) | \
+            (PAWN_ATTACKS[PieceColor.BLACK][location] & bb['P']) | (PAWN_ATTACKS[PieceColor.WHITE][location] & bb['p']) | \
+            (Bitboard.slidingAttacks(location, occupied, Bitboard.DIAGONALS) & diagonal) | \
+            (Bitboard.slidingAttacks(location, occupied, Bitboard.LINES) & linear)
+
     def suggestDraw(self) -> bool:
         # TODO: add to PGN/FEN?
         if self.opponent.acceptsDraw(self):
@@ -314,145 +642,792 @@ class Board(NodeMixin):
         self.gameState = GameState.BLACK_WINS
 
 
+class TranspositionTable:
+    """ fixed-size hash table of search results indexed by zobrist key; every bucket has two slots:
+        - a depth-preferred slot that is only overwritten by results of at least the same search depth
+        - an always-replace slot that takes everything the depth-preferred slot rejects
+        entries are tuples (key, depth, score, flag, move)
+    """
+    EXACT = 0
+    LOWER_BOUND = 1     # score is at least this (beta cutoff)
+    UPPER_BOUND = 2     # score is at most this (no move raised alpha)
+
+    def __init__(self, bits: int = 16) -> None:
+        self.size = 1 << bits
+        self._mask = self.size - 1
+        self._deep = [None] * self.size
+        self._recent = [None] * self.size
+        self.probes = 0
+        self.hits = 0
+        self.stores = 0
+        self.overwrites = 0
+
+    def probe(self, key: int) -> tuple:
+        """ returns the stored entry for key or None """
+        self.probes += 1
+        index = key & self._mask
+        entry = self._deep[index]
+        if entry is None or entry[0] != key:
+            entry = self._recent[index]
+            if entry is None or entry[0] != key:
+                return None
+        self.hits += 1
+        return entry
+
+    def store(self, key: int, depth: int, score: int, flag: int, move: Tuple[int, int]) -> None:
+        self.stores += 1
+        index = key & self._mask
+        entry = (key, depth, score, flag, move)
+        deep = self._deep[index]
+        if deep is None or deep[0] == key or depth >= deep[1]:
+            if deep is not None and deep[0] != key:
+                self.overwrites += 1
+            self._deep[index] = entry
+        else:
+            recent = self._recent[index]
+            if recent is not None and recent[0] != key:
+                self.overwrites += 1
+            self._recent[index] = entry
+
+    def clear(self) -> None:
+        self._deep = [None] * self.size
+        self._recent = [None] * self.size
+
+    def stats(self) -> dict:
+        """ counters for tuning the table size """
+        return {
+            'size': self.size,
+            'probes': self.probes,
+            'hits': self.hits,
+            'hitRate': self.hits / self.probes if self.probes else 0.0,
+            'stores': self.stores,
+            'overwrites': self.overwrites
+        }
+
+
+class Evaluator:
+    """ static evaluation of a position in centipawns from white's point of view, the weighted sum of:
+        - material: the piece values (Board.stat)
+        - positional: the piece-square tables (Board.positional, updated incrementally whenever a piece is placed or lifted)
+        - mobility: the squares attacked by knights, bishops, rooks and queens (not occupied by own pieces)
+        - king safety: the own pawns next to the king
+        other evaluators can be plugged into the Chupponnent, either with different weights (0 disables a term) or by
+        overriding the terms in a subclass
+    """
+    def __init__(self, material: int = 100, positional: int = 1, mobility: int = 2, kingSafety: int = 10) -> None:
+        self.materialWeight = material
+        self.positionalWeight = positional
+        self.mobilityWeight = mobility
+        self.kingSafetyWeight = kingSafety
+
+    def evaluate(self, board: Board) -> int:
+        score = self.materialWeight * self.material(board) + self.positionalWeight * self.positional(board)
+        if self.mobilityWeight:
+            score += self.mobilityWeight * self.mobility(board)
+        if self.kingSafetyWeight:
+            score += self.kingSafetyWeight * self.kingSafety(board)
+        return score
+
+    def material(self, board: Board) -> int:
+        return board.stat
+
+    def positional(self, board: Board) -> int:
+        return board.positional
+
+    def mobility(self, board: Board) -> int:
+        bb = board.bitboards
+        occupied = board.occupied()
+        score = 0
+        for color, sign, identifiers in ((PieceColor.WHITE, 1, 'NBRQ'), (PieceColor.BLACK, -1, 'nbrq')):
+            targets = ~board.occupancy[color]
+            attacks = 0
+            for loc in Bitboard.toLocations(bb[identifiers[0]]):
+                attacks += (KNIGHT_ATTACKS[loc] & targets).bit_count()
+            for loc in Bitboard.toLocations(bb[identifiers[1]]):
+                attacks += (Bitboard.slidingAttacks(loc, occupied, Bitboard.DIAGONALS) & targets).bit_count()
+            for loc in Bitboard.toLocations(bb[identifiers[2]]):
+                attacks += (Bitboard.slidingAttacks(loc, occupied, Bitboard.LINES) & targets).bit_count()
+            for loc in Bitboard.toLocations(bb[identifiers[3]]):
+                attacks += (Bitboard.slidingAttacks(loc, occupied, Bitboard.DIAGONALS + Bitboard.LINES) & targets).bit_count()
+            score += sign * attacks
+        return score
+
+    def kingSafety(self, board: Board) -> int:
+        # pawn shield: own pawns on the squares around the king
+        white = (KING_ATTACKS[board.kingLocation[PieceColor.WHITE]] & board.bitboards['P']).bit_count()
+        black = (KING_ATTACKS[board.kingLocation[PieceColor.BLACK]] & board.bitboards['p']).bit_count()
+        return white - black
+
+
+class SearchTimeout(Exception):
+    """ raised inside the search when the time or node budget of the chupponnent is used up """
+    pass
+
+
 class Chupponnent:
-    def __init__(self) -> None:
-        pass
+    MATE_SCORE = 10000      # same magnitude as the stat of a won game (see Board._colorXwins)
+    MAX_PLY = 32            # the quiescence search stops here at the latest
+    SEE_VALUES = {'P': 1, 'N': 3, 'B': 3, 'R': 5, 'Q': 9, 'K': 100}
+    executor = None         # if set (e.g. a ProcessPoolExecutor created at app startup), the root moves are searched in parallel
+    book = None             # if set (an OpeningBook opened at app startup), book moves are played without any search
+    tablebase = None        # if set (a Tablebase opened at app startup), small endgames are scored exactly by the search
+
+    def __init__(self, maxDepth: int = 4, timeLimit: float = 1.0, nodeLimit: int = 20000, tableBits: int = 16, evaluator: Evaluator = None) -> None:
+        # search budget: the search stops at whatever comes first
+        self.maxDepth = maxDepth
+        self.timeLimit = timeLimit      # in seconds
+        self.nodeLimit = nodeLimit
+        self.tableBits = tableBits
+        self.evaluator = evaluator if evaluator is not None else Evaluator()
+        self.table = None               # transposition table, created on the first search
+        self.nodes = 0
+        self.killers = []
+        self.history = {}
+        self._deadline = 0
 
     def generateMove(self, board: Board) -> Tuple[int, int]:
-        # TODO
-        # just for getting everything else on track: at the moment, this only selects a random black piece and (also randomly) one
-        # of its valid moves and does this move without any intelligence -> this is only a mock up 
-        from random import seed, randint
-        seed(1)
-        moves = board.getAllMoves(PieceColor.BLACK)
+        """ returns the chupponnent's move for the side to move (Format: Tuple[source: int, target: int]) or None if there is no valid move """
+        if Chupponnent.book is not None:
+            move = Chupponnent.book.getMove(board)
+            if move is not None:
+                return move
+        if Chupponnent.executor is not None:
+            return self.generateParallelMove(board, Chupponnent.executor)
+        return self.generateSmartMove(board)
+
+    def generateSmartMove(self, board: Board) -> Tuple[int, int]:
+        """ negamax alpha-beta search with iterative deepening: every iteration searches one ply deeper, so when the 
+            budget is used up, the best move of the last completed iteration is returned """
+        moves = self._orderMoves(board, board.getAllMoves(board.activeColor()), 0)
         if len(moves) == 0:
             return None
+        if self.table is None:
+            self.table = TranspositionTable(self.tableBits)
+        self.nodes = 0
+        self.killers = [[None, None] for _ in range(self.maxDepth + 1)]
+        self.history = {}
+        self._deadline = time.perf_counter() + self.timeLimit
+        bestMove = moves[0]
+        for depth in range(1, self.maxDepth + 1):
+            try:
+                score, move = self._searchRoot(board, moves, depth)
+            except SearchTimeout:
+                break
+            bestMove = move
+            # search the best move first in the next iteration:
+            moves.remove(move)
+            moves.insert(0, move)
+            if abs(score) >= Chupponnent.MATE_SCORE - self.maxDepth:
+                # forced mate found, searching deeper won't change anything
+                break
+        return bestMove
+
+    def generateParallelMove(self, board: Board, executor: Executor) -> Tuple[int, int]:
+        """ root-parallel variant of generateSmartMove(): in every iteration, the first (best so far) root move is searched
+            here to get a bound, then all other root moves are searched against that bound as separate tasks of executor 
+            (positions are shipped in the compact encoding, the evaluator is pickled -> subclasses have to be defined at 
+            module level); the node limit applies per task
+            hint: the result only depends on the scores (ties: move order), not on the order in which the tasks finish """
+        moves = self._orderMoves(board, board.getAllMoves(board.activeColor()), 0)
+        if len(moves) <= 1:
+            return moves[0] if moves else None
+        if self.table is None:
+            self.table = TranspositionTable(self.tableBits)
+        self.killers = [[None, None] for _ in range(self.maxDepth + 1)]
+        self.history = {}
+        deadline = time.time() + self.timeLimit
+        self._deadline = time.perf_counter() + self.timeLimit
+        blob = board.toCompactBytes()
+        bestMove = moves[0]
+        for depth in range(1, self.maxDepth + 1):
+            self.nodes = 0
+            try:
+                alpha = self._scoreMove(board, moves[0], depth, -Chupponnent.MATE_SCORE - 1)
+            except SearchTimeout:
+                break
+            scores = list(executor.map(_scoreRootMove, repeat(blob), moves[1:], repeat(depth), repeat(alpha), repeat(deadline), \
+                repeat(self.nodeLimit), repeat(self.tableBits), repeat(self.evaluator)))
+            if None in scores:
+                # at least one task ran out of budget -> the iteration is incomplete
+                break
+            scores.insert(0, alpha)
+            best = max(range(len(moves)), key=lambda i: (scores[i], -i))
+            bestMove = moves[best]
+            moves.insert(0, moves.pop(best))
+            if abs(scores[best]) >= Chupponnent.MATE_SCORE - self.maxDepth:
+                break
+        return bestMove
+
+    def _scoreMove(self, board: Board, move: Tuple[int, int], depth: int, alpha: int) -> int:
+        """ returns the score of the root move if it is better than alpha, otherwise an upper bound (<= alpha): 
+            a null window search proves that the move is not better, only if it is, the move is searched with the full window """
+        record = board._applyMove(move[0], move[1])
+        try:
+            if alpha > -Chupponnent.MATE_SCORE - 1:
+                score = -self._negamax(board, depth - 1, -alpha - 1, -alpha, 1)
+                if score <= alpha:
+                    return score
+            return -self._negamax(board, depth - 1, -Chupponnent.MATE_SCORE - 1, -alpha, 1)
+        finally:
+            board.unmakeMove(record)
+
+    def _searchRoot(self, board: Board, moves: List[Tuple[int, int]], depth: int) -> Tuple[int, Tuple[int, int]]:
+        alpha = -Chupponnent.MATE_SCORE - 1
+        bestMove = moves[0]
+        for move in moves:
+            record = board._applyMove(move[0], move[1])
+            try:
+                score = -self._negamax(board, depth - 1, -Chupponnent.MATE_SCORE - 1, -alpha, 1)
+            finally:
+                board.unmakeMove(record)
+            if score > alpha:
+                alpha = score
+                bestMove = move
+        return alpha, bestMove
+
+    def _negamax(self, board: Board, depth: int, alpha: int, beta: int, ply: int) -> int:
+        """ returns the score of the position from the point of view of the side to move """
+        self.nodes += 1
+        if self.nodes >= self.nodeLimit or (self.nodes & 127 == 0 and time.perf_counter() > self._deadline):
+            raise SearchTimeout()
+        if ply > 0 and board.repetitionCount() >= 2:
+            # going back to a position of the game/search line: the opponent can repeat it, too -> treat it as a draw
+            return 0
+        if Chupponnent.tablebase is not None:
+            score = Chupponnent.tablebase.score(board, ply)
+            if score is not None:
+                return score
+        if depth == 0:
+            return self._quiescence(board, alpha, beta, ply)
+        key = board.zobristKey
+        entry = self.table.probe(key)
+        tableMove = None
+        if entry is not None:
+            tableMove = entry[4]
+            if entry[1] >= depth:
+                score = self._scoreFromTable(entry[2], ply)
+                if entry[3] == TranspositionTable.EXACT:
+                    return score
+                elif entry[3] == TranspositionTable.LOWER_BOUND and score >= beta:
+                    return score
+                elif entry[3] == TranspositionTable.UPPER_BOUND and score <= alpha:
+                    return score
+        color = board.activeColor()
+        moves = board.getAllMoves(color)
+        if len(moves) == 0:
+            # checkmate (the sooner the better) or stalemate:
+            if board.legalityContext(color).checkers:
+                return -Chupponnent.MATE_SCORE + ply
+            return 0
+        alphaOrig = alpha
+        bestScore = -Chupponnent.MATE_SCORE - 1
+        bestMove = None
+        for move in self._orderMoves(board, moves, ply, tableMove):
+            isCapture = board.squares[move[1]].isOccupied
+            record = board._applyMove(move[0], move[1])
+            try:
+                score = -self._negamax(board, depth - 1, -beta, -alpha, ply + 1)
+            finally:
+                board.unmakeMove(record)
+            if score > bestScore:
+                bestScore = score
+                bestMove = move
+            if score > alpha:
+                alpha = score
+            if alpha >= beta:
+                if not isCapture:
+                    # quiet move caused a cutoff -> remember it for sibling nodes (killer) and in general (history):
+                    killers = self.killers[ply]
+                    if move != killers[0]:
+                        killers[1] = killers[0]
+                        killers[0] = move
+                    self.history[move] = self.history.get(move, 0) + depth * depth
+                break
+        if bestScore <= alphaOrig:
+            flag = TranspositionTable.UPPER_BOUND
+        elif bestScore >= beta:
+            flag = TranspositionTable.LOWER_BOUND
         else:
-            return moves[randint(0, len(moves) - 1)]
-
+            flag = TranspositionTable.EXACT
+        self.table.store(key, depth, self._scoreToTable(bestScore, ply), flag, bestMove)
+        return bestScore
+
+    def _quiescence(self, board: Board, alpha: int, beta: int, ply: int) -> int:
+        """ searches captures only (all evasions if in check) until the position is quiet, so that the evaluation is not
+            taken in the middle of an exchange (horizon effect); captures losing material (see _staticExchange) are skipped """
+        self.nodes += 1
+        if self.nodes >= self.nodeLimit or (self.nodes & 127 == 0 and time.perf_counter() > self._deadline):
+            raise SearchTimeout()
+        color = board.activeColor()
+        if board.legalityContext(color).checkers:
+            moves = board.getAllMoves(color)
+            if len(moves) == 0:
+                return -Chupponnent.MATE_SCORE + ply
+            bestScore = -Chupponnent.MATE_SCORE - 1
+        else:
+            # stand pat: the side to move does not have to capture
+            bestScore = self._evaluate(board)
+            if bestScore >= beta or ply >= Chupponnent.MAX_PLY:
+                return bestScore
+            alpha = max(alpha, bestScore)
+            moves = [move for move in board.getAllCaptures(color) if self._staticExchange(board, move[0], move[1]) >= 0]
+        for move in self._orderMoves(board, moves, ply):
+            record = board._applyMove(move[0], move[1])
+            try:
+                score = -self._quiescence(board, -beta, -alpha, ply + 1)
+            finally:
+                board.unmakeMove(record)
+            if score > bestScore:
+                bestScore = score
+            if score > alpha:
+                alpha = score
+            if alpha >= beta:
+                break
+        return bestScore
+
+    def _staticExchange(self, board: Board, source: int, target: int) -> int:
+        """ static exchange evaluation: the material balance (in piece values, from the point of view of the moving side) 
+            of the capture source -> target followed by all recaptures on target, each side always recapturing with its
+            least valuable piece and stopping as soon as continuing does not pay off """
+        piece = board.squares[source].currentPiece
+        victim = board.squares[target].currentPiece
+        # en passant: the captured pawn is not on target
+        gain = [victim.value if victim else (1 if piece.identifier.upper() == 'P' and Location.getFileOffset(source, target) else 0)]
+        attackerValue = Chupponnent.SEE_VALUES[piece.identifier.upper()]
+        occupied = board.occupied() ^ (1 << source)
+        color = piece.color.inverse()
+        while True:
+            attackers = board.attackersTo(target, occupied) & occupied & board.occupancy[color]
+            if not attackers:
+                break
+            # score of color if it captures the piece on target (and the exchange stops there):
+            gain.append(attackerValue - gain[-1])
+            identifiers = 'PNBRQK' if color == PieceColor.WHITE else 'pnbrqk'
+            for identifier in identifiers:
+                candidates = board.bitboards[identifier] & attackers
+                if candidates:
+                    occupied ^= candidates & -candidates
+                    attackerValue = Chupponnent.SEE_VALUES[identifier.upper()]
+                    break
+            color = color.inverse()
+        # going backwards, every side chooses between capturing and stopping the exchange:
+        for i in range(len(gain) - 1, 0, -1):
+            gain[i - 1] = -max(-gain[i - 1], gain[i])
+        return gain[0]
+
+    def _scoreToTable(self, score: int, ply: int) -> int:
+        # mate scores are stored relative to the position (not to the root) so that they stay valid in other move orders:
+        if score >= Chupponnent.MATE_SCORE - 1000:
+            return score + ply
+        elif score <= -Chupponnent.MATE_SCORE + 1000:
+            return score - ply
+        return score
+
+    def _scoreFromTable(self, score: int, ply: int) -> int:
+        if score >= Chupponnent.MATE_SCORE - 1000:
+            return score - ply
+        elif score <= -Chupponnent.MATE_SCORE + 1000:
+            return score + ply
+        return score
+
+    def _evaluate(self, board: Board) -> int:
+        # the evaluator scores from white's point of view:
+        score = self.evaluator.evaluate(board)
+        return score if board.fen.activeColor == 'w' else -score
+
+    def _orderMoves(self, board: Board, moves: List[Tuple[int, int]], ply: int, tableMove: Tuple[int, int] = None) -> List[Tuple[int, int]]:
+        """ sorts moves by their chance to cause a cutoff: the best move stored in the transposition table, then captures
+            (most valuable victim, least valuable attacker), then killer moves, then quiet moves by their history score """
+        killers = self.killers[ply] if ply < len(self.killers) else [None, None]
+        def priority(move: Tuple[int, int]) -> Tuple[int, int]:
+            victim = board.squares[move[1]].currentPiece
+            if move == tableMove:
+                return (4, 0)
+            elif victim:
+                return (3, 10 * victim.value - board.squares[move[0]].currentPiece.value)
+            elif move == killers[0]:
+                return (2, 1)
+            elif move == killers[1]:
+                return (2, 0)
+            return (1, self.history.get(move, 0))
+        return sorted(moves, key=priority, reverse=True)
 
-    def generateSmartMove(self, board: Board) -> Tuple[int, int]:
-        # TODO
+    def acceptsDraw(self, board: Board) -> bool:
+        # chupponnent will only accept a draw if we're at 100 halfmoves, the position occurred three times or only the black king is left: 
+        return ((int(board.fen.halfmoveClock) >= 100) or (board.repetitionCount() >= 3) or (len(board.pieces[PieceColor.BLACK]) == 1))
+
+def _scoreRootMove(bytes: bytes, move: Tuple[int, int], depth: int, alpha: int, deadline: float, nodeLimit: int, tableBits: int, \
+    evaluator: Evaluator) -> int:
+    """ task of the root-parallel search (see Chupponnent.generateParallelMove), module level so that it can be pickled;
+        returns None if the budget was used up (deadline in seconds since the epoch -> comparable across processes) """
+    board = Board.fromCompactBytes(bytes)
+    chupponnent = Chupponnent(depth, nodeLimit=nodeLimit, tableBits=tableBits, evaluator=evaluator)
+    chupponnent.table = TranspositionTable(tableBits)
+    chupponnent.killers = [[None, None] for _ in range(depth + 1)]
+    chupponnent._deadline = time.perf_counter() + (deadline - time.time())
+    try:
+        return chupponnent._scoreMove(board, move, depth, alpha)
+    except SearchTimeout:
         return None
 
-    def simulateMoves(depth: int):
-        # TODO!
-        pass
 
-    def acceptsDraw(self, board: Board) -> bool:
-        # chupponnent will only accept a draw if we're at 100 halfmoves or only the black king is left: 
-        return ((int(board.fen.halfmoveClock) >= 100) or (len(board.pieces[PieceColor.BLACK]) == 1))
+class OpeningBook:
+    """ 
+    Opening book: the moves played in a collection of games, indexed by the zobrist key of the position before the move.
+    The book file (see build()) consists of a header (magic, version, number of entries) and the entries (key, source, target,
+    weight = how often the move was played), sorted by key -> the file is memory-mapped and looked up with a binary search,
+    so opening a book does not read it.
+    """
+    HEADER = struct.Struct('<2sBxI')
+    ENTRY = struct.Struct('<QBBH')
+    MAGIC = b'OB'
+    VERSION = 1
+
+    def __init__(self, path: str) -> None:
+        with open(path, 'rb') as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.size = OpeningBook.HEADER.unpack_from(self._map)
+        if magic != OpeningBook.MAGIC or version != OpeningBook.VERSION:
+            raise Exception("ERROR: Unknown opening book format: " + path)
+
+    def close(self) -> None:
+        self._map.close()
+
+    def probe(self, key: int) -> List[Tuple[Tuple[int, int], int]]:
+        """ returns the book moves of the position with the zobrist key (Format: Tuple[move: Tuple[source, target], weight]) """
+        # binary search for the first entry with the key:
+        low, high = 0, self.size
+        while low < high:
+            middle = (low + high) // 2
+            if OpeningBook.ENTRY.unpack_from(self._map, OpeningBook.HEADER.size + middle * OpeningBook.ENTRY.size)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        moves = []
+        for index in range(low, self.size):
+            entryKey, source, target, weight = OpeningBook.ENTRY.unpack_from(self._map, OpeningBook.HEADER.size + index * OpeningBook.ENTRY.size)
+            if entryKey != key:
+                break
+            moves.append(((source, target), weight))
+        return moves
+
+    def getMove(self, board: Board) -> Tuple[int, int]:
+        """ returns the most played book move of the position or None if the position is not in the book """
+        moves = self.probe(board.zobristKey)
+        if not moves:
+            return None
+        legalMoves = board.getAllMoves(board.activeColor())
+        # (the legality check protects against key collisions)
+        moves = [(weight, move) for move, weight in moves if move in legalMoves]
+        return max(moves, key=lambda entry: entry[0])[1] if moves else None
+
+    def build(pgns: Iterable[str], path: str, maxPlies: int = 20) -> Tuple[int, int]:
+        """ builds the book file from the first maxPlies halfmoves of the games (PGN) and returns the number of entries 
+            and the number of skipped games (games that cannot be replayed, e.g. with an unsupported pawn promotion) """
+        counts = {}
+        skipped = 0
+        for result in TrainingHelper.replayGames(pgns):
+            if result is None:
+                skipped += 1
+                continue
+            board = Board.startingPosition()
+            for move in result[0][:maxPlies]:
+                counts[(board.zobristKey, move)] = counts.get((board.zobristKey, move), 0) + 1
+                board._applyMove(move[0], move[1])
+        entries = sorted(counts.items(), key=lambda entry: (entry[0][0], -entry[1]))
+        with open(path, 'wb') as file:
+            file.write(OpeningBook.HEADER.pack(OpeningBook.MAGIC, OpeningBook.VERSION, len(entries)))
+            for (key, (source, target)), weight in entries:
+                file.write(OpeningBook.ENTRY.pack(key, source, target, min(weight, 0xFFFF)))
+        return len(entries), skipped
+
+
+class Tablebase:
+    """
+    Endgame tablebase for king + queen/rook/pawn vs. king, solved by retrograde analysis (see build()).
+    Every table stores one byte per position: DRAW, STALEMATE (side to move has no moves and is not in check) or the
+    distance to mate + 1 in plies (MATE: the side to move is checkmated) (the side with the extra piece always wins, so the value does not need a sign).
+    The tables are computed with the extra piece on the white side; for the black side, the position is mirrored.
+    Position index: ((sideToMove * 64 + strongKing) * 64 + piece) * 64 + weakKing, sideToMove 0: strong side, 1: weak side
+    """
+    HEADER = struct.Struct('<2sB')
+    MAGIC = b'TB'
+    VERSION = 1
+    TABLES = 'QRP'                  # KQK, KRK, KPK (in this order in the file)
+    MAX_PIECES = 3                  # the tablebase covers positions with at most this number of pieces (kings included)
+    SIZE = 64 * 64 * 64             # positions per side to move
+    DRAW = 0
+    MATE = 1
+    STALEMATE = 255
+
+    def __init__(self, path: str) -> None:
+        with open(path, 'rb') as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version = Tablebase.HEADER.unpack_from(self._map)
+        if magic != Tablebase.MAGIC or version != Tablebase.VERSION:
+            raise Exception("ERROR: Unknown tablebase format: " + path)
+
+    def close(self) -> None:
+        self._map.close()
+
+    def probe(self, board: Board) -> int:
+        """ returns the table value of the position (see class description) or None if it is not covered """
+        white, black = board.pieces[PieceColor.WHITE], board.pieces[PieceColor.BLACK]
+        if len(white) + len(black) != Tablebase.MAX_PIECES:
+            return None
+        strongColor = PieceColor.WHITE if len(white) == 2 else PieceColor.BLACK
+        piece = [piece for piece in board.pieces[strongColor] if piece.identifier.upper() != 'K'][0]
+        table = Tablebase.TABLES.find(piece.identifier.upper())
+        if table == -1:
+            return None
+        strongKing, location, weakKing = board.kingLocation[strongColor], piece.location, board.kingLocation[strongColor.inverse()]
+        if strongColor == PieceColor.BLACK:
+            # mirror vertically, so that the strong side plays "upwards" like white:
+            strongKing, location, weakKing = strongKing ^ 56, location ^ 56, weakKing ^ 56
+        sideToMove = 0 if board.activeColor() == strongColor else 1
+        index = ((sideToMove * 64 + strongKing) * 64 + location) * 64 + weakKing
+        return self._map[Tablebase.HEADER.size + table * 2 * Tablebase.SIZE + index]
+
+    def score(self, board: Board, ply: int) -> int:
+        """ returns the negamax score (see Chupponnent) of the position or None if it is not covered """
+        value = self.probe(board)
+        if value is None:
+            return None
+        elif value == Tablebase.DRAW or value == Tablebase.STALEMATE:
+            return 0
+        elif len(board.pieces[board.activeColor()]) == 2:
+            # side to move is the strong side:
+            return Chupponnent.MATE_SCORE - ply - (value - 1)
+        return -Chupponnent.MATE_SCORE + ply + (value - 1)
+
+    def build(path: str) -> None:
+        """ solves all tables and writes the tablebase file """
+        tables = {}
+        for piece in Tablebase.TABLES:
+            tables[piece] = Tablebase._solve(piece, tables.get('Q'))
+        with open(path, 'wb') as file:
+            file.write(Tablebase.HEADER.pack(Tablebase.MAGIC, Tablebase.VERSION))
+            for piece in Tablebase.TABLES:
+                file.write(tables[piece])
+
+    def _solve(piece: str, queenTable: bytearray = None) -> bytearray:
+        """ retrograde analysis of king + piece (white) vs. king (black): starting from the mates, the won positions are
+            found by taking back moves, ordered by the distance to mate; black is lost once all of its moves lead to
+            positions that are won for white (capturing the piece is never lost)
+            queenTable: the solved KQK table (for KPK: pawn promotions lead into KQK) """
+        N = Tablebase.SIZE
+        values = bytearray(2 * N)
+        legal = bytearray(N)            # white to move: legal if black is not in check
+        counters = [0] * N              # black to move: moves that do not (yet) lead to a position won for white
+        buckets = [[] for _ in range(Tablebase.STALEMATE)]
+        directions = {'Q': Bitboard.DIAGONALS + Bitboard.LINES, 'R': Bitboard.LINES, 'P': None}[piece]
+        locations = range(8, 56) if piece == 'P' else range(64)
+        for wk in range(64):
+            guarded = KING_ATTACKS[wk]
+            for x in locations:
+                if x == wk:
+                    continue
+                # squares attacked by the piece (the black king is no blocker, it must not step back on the attack path):
+                attacks = Bitboard.slidingAttacks(x, 1 << wk, directions) if directions else PAWN_ATTACKS[PieceColor.WHITE][x]
+                for bk in range(64):
+                    if bk == wk or bk == x or guarded & (1 << bk):
+                        continue
+                    i = (wk * 64 + x) * 64 + bk
+                    check = attacks & (1 << bk)
+                    if not check:
+                        legal[i] = 1
+                    # black's moves (capturing the piece is possible if the white king does not protect it):
+                    counters[i] = (KING_ATTACKS[bk] & ~guarded & ~attacks).bit_count()
+                    if counters[i] == 0:
+                        if check:
+                            buckets[Tablebase.MATE].append(N + i)
+                        else:
+                            values[N + i] = Tablebase.STALEMATE
+                    if piece == 'P' and x < 16 and legal[i] and x - 8 not in (wk, bk):
+                        # promotion: won if black is lost in the resulting KQK position
+                        value = queenTable[N + (wk * 64 + x - 8) * 64 + bk]
+                        if value != Tablebase.DRAW and value != Tablebase.STALEMATE:
+                            buckets[value + 1].append(i)
+        for value in range(Tablebase.MATE, Tablebase.STALEMATE - 1):
+            for i in buckets[value]:
+                if values[i]:
+                    continue
+                values[i] = value
+                position = i % N
+                wk, x, bk = position // 4096, (position // 64) % 64, position % 64
+                occupied = (1 << wk) | (1 << x) | (1 << bk)
+                if i >= N:
+                    # black is lost -> white wins wherever white can move into this position:
+                    predecessors = [(s * 64 + x) * 64 + bk for s in Bitboard.toLocations(KING_ATTACKS[wk] & ~KING_ATTACKS[bk] & ~occupied)]
+                    if piece == 'P':
+                        sources = [x + 8] if x < 48 and not occupied & (1 << (x + 8)) else []
+                        if 32 <= x < 40 and sources and not occupied & (1 << (x + 16)):
+                            sources.append(x + 16)
+                    else:
+                        sources = Bitboard.toLocations(Bitboard.slidingAttacks(x, occupied, directions) & ~occupied)
+                    predecessors.extend((wk * 64 + s) * 64 + bk for s in sources)
+                    for q in predecessors:
+                        if legal[q] and not values[q]:
+                            buckets[value + 1].append(q)
+                else:
+                    # white wins -> one less escape for black wherever black can move into this position:
+                    for s in Bitboard.toLocations(KING_ATTACKS[bk] & ~KING_ATTACKS[wk] & ~occupied):
+                        r = (wk * 64 + x) * 64 + s
+                        counters[r] -= 1
+                        if counters[r] == 0:
+                            buckets[value + 1].append(N + r)
+        return values
+
 
 class TrainingHelper:
     def __init__(self) -> None:
         pass
 
+    # movetext tokens: tag pairs, comments, NAGs, move numbers and results are skipped, groups: start of a variation,
+    # end of a variation, halfmove (SAN)
+    PGN_TOKENS = re.compile(r'\[[^\]]*\]|\{[^}]*\}|;[^\n]*|(\()|(\))|\$\d+|\d+\.+|1-0|0-1|1/2-1/2|\*|([^\s.{}()\[\]]+)')
+    SAN = re.compile(r'([NBRQK])?([a-h])?([1-8])?x?([a-h][1-8])(?:=([NBRQ]))?')
+
     def pgnToFen(pgn: str) -> List[str]:
-        idx = pgn.rfind("]")
-        if idx == -1:
-            payload = pgn
-        else:
-            payload = pgn[idx+1:]
-        # delete comments:
-        payload = re.sub(r'\{.*\}', '', payload).strip()
-        # delete result (if applicable):
-        payload = re.sub(r'1/2-1/2', '', payload).strip()
-        payload = re.sub(r'\d{1}-\d{1}', '', payload).strip()
-        # convert to move list:
-        tmp = re.split(r'\d{1,3}\.', payload)        # we assume that a chess game never has more than 999 moves
-        movelist = []
-        for move in tmp:
-            if move.strip() != '':
-                movelist.append(move.strip())
+        """ returns the FENs of the game, starting with the starting position """
+        return TrainingHelper.replay(pgn, True)[1]
+
+    def readPgns(file: TextIO) -> Iterator[str]:
+        """ yields the games of a (multi-game) PGN file one by one, without reading the whole file """
+        lines = []
+        movetext = False
+        for line in file:
+            if line.startswith('[') and movetext:
+                # tag pairs after the movetext -> next game:
+                yield ''.join(lines)
+                lines = []
+                movetext = False
+            elif line.strip() and not line.startswith('['):
+                movetext = True
+            lines.append(line)
+        if movetext:
+            yield ''.join(lines)
+
+    def sanMoves(pgn: str) -> List[str]:
+        """ returns the halfmoves (SAN) of the game (without the ones of variations) """
+        moves = []
+        depth = 0           # variations can be nested
+        for start, end, san in TrainingHelper.PGN_TOKENS.findall(pgn):
+            if start:
+                depth += 1
+            elif end:
+                depth = max(depth - 1, 0)
+            elif san and depth == 0:
+                moves.append(san)
+        return moves
+
+    def replay(pgn: str, withFens: bool = False) -> Tuple[List[Tuple[int, int]], List[str]]:
+        """ replays the game and returns its moves (Format: Tuple[source: int, target: int]) and, if withFens, its FENs 
+            (starting with the starting position; otherwise empty, the FEN strings are the expensive part of a replay) """
         board = Board.startingPosition()
-        fenlist = [str(board.fen)]
-        for move in movelist:
-            for black_moves, halfmove in enumerate(move.split(' ')):
-                fenlist.append(TrainingHelper._makeHalfmove(halfmove, bool(black_moves), board))
-        return fenlist
-
-    def _makeHalfmove(halfmove: str, black_moves: bool, board: Board) -> str:
-        """ makes the move and returns the FEN afterwards """
-        # Hint: The following conditions are partly more explicit than theoretically necessary; This is a
-        #       conscious decision to uncover errors/unhandled usecases and direct these to the ELSE statement.
-        if '-' in halfmove:
-            # castling:
-            color = PieceColor.BLACK if bool(black_moves) else PieceColor.WHITE
+        moves = []
+        fens = [str(board.fen)] if withFens else []
+        for san in TrainingHelper.sanMoves(pgn):
+            move = TrainingHelper._sanToMove(san, board)
+            board._applyMove(move[0], move[1])
+            moves.append(move)
+            if withFens:
+                fens.append(str(board.fen))
+        return moves, fens
+
+    def replayGames(pgns: Iterable[str], executor: Executor = None, withFens: bool = False, chunkSize: int = 64, readAhead: int = 16) -> Iterator[tuple]:
+        """ yields the replay() result of every game (in order) or None if the game could not be replayed (see mapGames) """
+        return TrainingHelper.mapGames(partial(TrainingHelper.replay, withFens=withFens), pgns, executor, chunkSize, readAhead)
+
+    def mapGames(function: Callable, pgns: Iterable[str], executor: Executor = None, chunkSize: int = 64, readAhead: int = 16) -> Iterator:
+        """ yields function(pgn) for every game (in order) or None if it raised (e.g. for a game that could not be replayed);
+            with an executor (e.g. a ProcessPoolExecutor), chunks of chunkSize games are processed in parallel
+            (at most readAhead chunks are in flight, so pgns can be a lazy reader like readPgns()) """
+        if executor is None:
+            for pgn in pgns:
+                yield _mapGames(function, [pgn])[0]
+            return
+        pending = deque()
+        chunk = []
+        for pgn in pgns:
+            chunk.append(pgn)
+            if len(chunk) == chunkSize:
+                pending.append(executor.submit(_mapGames, function, chunk))
+                chunk = []
+                if len(pending) >= readAhead:
+                    yield from pending.popleft().result()
+        if chunk:
+            pending.append(executor.submit(_mapGames, function, chunk))
+        while pending:
+            yield from pending.popleft().result()
+
+    def encodePosition(board: Board) -> tuple:
+        """ returns the position as a plain tuple (e.g. for TrainingExporter): the 12 bitboards (in the order of 
+            TrainingExporter.IDENTIFIERS), side to move (1: white), castling rights (bits KQkq) and en passant square """
+        return tuple(board.bitboards[identifier] for identifier in TrainingExporter.IDENTIFIERS) + (
+            1 if board.fen.activeColor == 'w' else 0,
+            TrainingHelper._castlingBits(board.fen.castlingAvailability),
+            INVALID_LOC if board.fen.enPassantTarget == '-' else Location.algebraicSqToAbsoluteSq(board.fen.enPassantTarget))
+
+    def fenToPosition(fen: str) -> tuple:
+        """ like encodePosition(), but directly from a FEN (without building a Board) """
+        fields = fen.split(' ')
+        bitboards = dict.fromkeys(TrainingExporter.IDENTIFIERS, 0)
+        location = 0
+        for char in fields[0]:
+            if char.isnumeric():
+                location += int(char)
+            elif char != '/':
+                bitboards[char] |= 1 << location
+                location += 1
+        return tuple(bitboards.values()) + (1 if fields[1] == 'w' else 0, TrainingHelper._castlingBits(fields[2]),
+            INVALID_LOC if fields[3] == '-' else Location.algebraicSqToAbsoluteSq(fields[3]))
+
+    def gamePositions(pgn: str) -> List[tuple]:
+        """ replays the game and returns its positions (see encodePosition), starting with the starting position """
+        board = Board.startingPosition()
+        positions = [TrainingHelper.encodePosition(board)]
+        for san in TrainingHelper.sanMoves(pgn):
+            move = TrainingHelper._sanToMove(san, board)
+            board._applyMove(move[0], move[1])
+            positions.append(TrainingHelper.encodePosition(board))
+        return positions
+
+    def _castlingBits(castlingAvailability: str) -> int:
+        return sum(1 << bit for bit, char in enumerate('KQkq') if char in castlingAvailability)
+
+    def _sanToMove(san: str, board: Board) -> Tuple[int, int]:
+        """ returns the move (source, target) of the halfmove (SAN) for the side to move """
+        color = board.activeColor()
+        san = san.rstrip('+#!?')
+        if san in ('O-O', 'O-O-O'):
             source = board.kingLocation[color]
-            if 'O-O-O' in halfmove:
-                # queenside (long)
-                target = 2 if bool(black_moves) else 58
-            else: 
-                # kingside (short)
-                target = 6 if bool(black_moves) else 62
-        elif '=Q' in halfmove:
-            # pawn promotion -> can be identified uniquely with everything before the equal sign:
-            return TrainingHelper._makeHalfmove(halfmove.split('=')[0], black_moves, board)
-        elif '=' in halfmove:
+            target = source - 2 if san == 'O-O-O' else source + 2
+            if target in board.getMoves(source, True):
+                return source, target
+            raise Exception("ERROR: Invalid move (SAN): " + san)
+        match = TrainingHelper.SAN.fullmatch(san)
+        if match is None:
+            raise Exception("ERROR: Unknown move (SAN): " + san)
+        identifier, file, rank, square, promotion = match.groups()
+        if promotion is not None and promotion != 'Q':
             # since the chupochess engine only supports pawn promotion to a queen,
             # we should make sure that the PGN data to feed the chupponnent with 
             # later on does not contain any pawn promotions other than that!
-            raise Exception("ERROR: Unknown pawn promotion move (SAN): " + halfmove)
-        elif '+' in halfmove:
-            # move results in a check -> not really relevant for us
-            return TrainingHelper._makeHalfmove(halfmove.replace('+', ''), black_moves, board)
-        elif halfmove[0].islower() and 'x' in halfmove:
-            # pawn move with capture (includes en passant) -> source depends on departure file:
-            target = Location.algebraicSqToAbsoluteSq(halfmove.split('x')[1])
-            direction = -1 if black_moves else 1
-            srcFile = halfmove.split('x')[0]
-            tarFile = halfmove.split('x')[1][0]
-            if (srcFile < tarFile) == bool(direction + 1):     
-                source = target + (direction * 7)
-            else:
-                source = target + (direction * 9)
-        elif halfmove[0].islower():
-            # pawn move without capture:
-            direction = -1 if black_moves else 1
-            identifier = 'p' if black_moves else 'P'
-            target = Location.algebraicSqToAbsoluteSq(halfmove)
-            source = target + (direction * 8)
-            if board.squares[source].isOccupied == False or board.squares[source].currentPiece.identifier != identifier:
-                # pawn was moved 2 squares:
-                source = source + (direction * 8)
-        elif halfmove[0].isupper() and 'x' in halfmove:
-            # not-pawn move with capture
-            # at this point, the capture does not add any information to the SAN:
-            return TrainingHelper._makeHalfmove(halfmove.replace('x', ''), black_moves, board)
-        elif halfmove[0].isupper() and len(halfmove) == 3:
-            # unique move of not-pawn:
-            identifier = halfmove[0].lower() if black_moves else halfmove[0]
-            target = Location.algebraicSqToAbsoluteSq(halfmove[1:])
-            color = PieceColor.BLACK if black_moves else PieceColor.WHITE
-            for piece in board.pieces[color]:
-                if (piece.identifier == identifier) and (target in board.getMoves(piece.location, black_moves)):
-                    source = piece.location
-                    break
-        elif halfmove[0].isupper() and len(halfmove) == 4:
-            # additional information about departure file OR rank is given
-            identifier = halfmove[0].lower() if black_moves else halfmove[0]
-            color = PieceColor.BLACK if black_moves else PieceColor.WHITE
-            target = Location.algebraicSqToAbsoluteSq(halfmove[2:4]) 
-            if halfmove[1].isnumeric():
-                # rank is given: 
-                sources = Location.getLocationsOnRank(int(halfmove[1]))
-            else:
-                # file is given:
-                sources = Location.getLocationsOnFile(halfmove[1])
-            for piece in board.pieces[color]:
-                if (piece.identifier == identifier) and (piece.location in sources) and (target in board.getMoves(piece.location, black_moves)):
-                    source = piece.location
-                    break
-        elif halfmove[0].isupper() and len(halfmove) == 5:
-            # rank and file of the departure square are given (this only occurs in very rare cases but it is possible if e.g. 3 queens
-            # of one player are able to reach the same location)
-            source = Location.algebraicSqToAbsoluteSq(halfmove[1:3])
-            target = Location.algebraicSqToAbsoluteSq(halfmove[3:5]) 
-        else:
-            raise Exception("ERROR: Unknown move (SAN): " + halfmove)
-        board.makeMove(source, target, black_moves)
-        return str(board.fen)
-    
+            raise Exception("ERROR: Unknown pawn promotion move (SAN): " + san)
+        if identifier is None:
+            # pawn move: without a capture, the pawn stays on the file of the target square
+            identifier = 'P'
+            file = file or square[0]
+        target = Location.algebraicSqToAbsoluteSq(square)
+        # only the pieces of the moved kind (and on the given departure file/rank) are candidates:
+        sources = [source for source in Bitboard.toLocations(board.bitboards[identifier if color == PieceColor.WHITE else identifier.lower()]) \
+            if (file is None or source % 8 == ord(file) - 97) and (rank is None or 8 - source // 8 == int(rank)) \
+            and target in board.getMoves(source, True)]
+        if len(sources) != 1:
+            raise Exception("ERROR: Invalid move (SAN): " + san)
+        return sources[0], target
+
     def fenToStat(fen: str) -> int:
     # for quick evaluation which player has more material
         switcher = {
@@ -474,6 +1449,94 @@ class TrainingHelper:
         return stat
 
 
+def _mapGames(function: Callable, pgns: List[str]) -> list:
+    """ task of TrainingHelper.mapGames, module level so that it can be pickled """
+    results = []
+    for pgn in pgns:
+        try:
+            results.append(function(pgn))
+        except Exception:
+            results.append(None)
+    return results
+
+
+class TrainingExporter:
+    """
+    Writes positions (see TrainingHelper.encodePosition) in chunks to one .npy file per array in directory (numpy is 
+    optional for the rest of chupochess, but required here); load() memory-maps them again:
+    - planes: uint8 [n, 96], 12 bit planes (IDENTIFIERS order) of 8 bytes each, square 0 (a8) is the lowest bit
+              (np.unpackbits(planes, axis=1, bitorder='little').reshape(-1, 12, 64) gives one value per square)
+    - side: uint8 [n], 1 if white is to move; castling: uint8 [n], bits KQkq; enPassant: uint8 [n], square or INVALID_LOC
+    - material: int16 [n], material balance (label, like TrainingHelper.fenToStat)
+    """
+    IDENTIFIERS = 'PNBRQKpnbrqk'
+    VALUES = [1, 3, 3, 5, 9, 0, -1, -3, -3, -5, -9, 0]
+    ARRAYS = {'planes': ('|u1', (96,)), 'side': ('|u1', ()), 'castling': ('|u1', ()), 'enPassant': ('|u1', ()), 'material': ('<i2', ())}
+    HEADER_SIZE = 128       # fixed size .npy header (rewritten with the final row count on close)
+
+    def __init__(self, directory: str, chunkSize: int = 16384) -> None:
+        if np is None:
+            raise Exception("ERROR: The training data export requires numpy")
+        os.makedirs(directory, exist_ok=True)
+        self.chunkSize = chunkSize
+        self.count = 0
+        self._buffer = []
+        self._files = {name: open(os.path.join(directory, name + '.npy'), 'wb') for name in TrainingExporter.ARRAYS}
+        self._writeHeaders()
+
+    def add(self, position: tuple) -> None:
+        self._buffer.append(position)
+        if len(self._buffer) >= self.chunkSize:
+            self.flush()
+
+    def extend(self, positions: Iterable[tuple]) -> None:
+        for position in positions:
+            self.add(position)
+
+    def flush(self) -> None:
+        """ encodes the buffered positions and appends them to the files """
+        if not self._buffer:
+            return
+        arrays = TrainingExporter.encode(self._buffer)
+        for name, file in self._files.items():
+            file.write(arrays[name].tobytes())
+        self.count += len(self._buffer)
+        self._buffer = []
+
+    def close(self) -> None:
+        self.flush()
+        self._writeHeaders()
+        for file in self._files.values():
+            file.close()
+
+    def encode(positions: List[tuple]) -> dict:
+        """ returns the arrays (see class description) of the positions, vectorized over the whole batch """
+        rows = np.array(positions, dtype=np.uint64)
+        planes = np.ascontiguousarray(rows[:, :12]).astype('<u8').view(np.uint8).reshape(-1, 96)
+        counts = np.unpackbits(planes, axis=1).reshape(-1, 12, 64).sum(axis=2, dtype=np.int16)
+        return {
+            'planes': planes,
+            'side': rows[:, 12].astype(np.uint8),
+            'castling': rows[:, 13].astype(np.uint8),
+            'enPassant': rows[:, 14].astype(np.uint8),
+            'material': (counts @ np.array(TrainingExporter.VALUES, dtype=np.int16)).astype('<i2'),
+        }
+
+    def load(directory: str) -> dict:
+        """ returns the (read-only, memory-mapped) arrays of an export """
+        return {name: np.load(os.path.join(directory, name + '.npy'), mmap_mode='r') for name in TrainingExporter.ARRAYS}
+
+    def _writeHeaders(self) -> None:
+        # .npy format 1.0 with the row count padded to a fixed width, so that the header can be rewritten in place:
+        for name, file in self._files.items():
+            descr, shape = TrainingExporter.ARRAYS[name]
+            header = "{'descr': '%s', 'fortran_order': False, 'shape': (%20d,%s), }" % (descr, self.count, ''.join(' %d,' % size for size in shape))
+            header = header.ljust(TrainingExporter.HEADER_SIZE - 11) + '\n'
+            file.seek(0)
+            file.write(b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin1'))
+            file.seek(0, os.SEEK_END)
+
+
 class Piece:
     def __init__(self, color: PieceColor, identifier: str, value: int, location: int) -> None:
         self.color = color
@@ -518,79 +1581,77 @@ class Piece:
     
 
     def _switchSquaresAndCapture(self, board: Board, target: int) -> None:
-        board.squares[self.location].reset()
-        board.removePiece(board.squares[target].reset())    # make capture if there is sth to capture
-        self.location = target
-        board.squares[target].set(self)
+        board._liftPiece(self.location)
+        captured = board._liftPiece(target)
+        board.removePiece(captured)    # make capture if there is sth to capture
+        board._placePiece(self, target)
+        # a rook captured on its initial square takes its castling right with it:
+        if captured and captured.identifier.upper() == 'R':
+            location = Location.absoluteSqToTuple(target)
+            if location == (0, 0 if captured.color == PieceColor.WHITE else 7):
+                board.removeCastlingRights(captured.color, 'Q')
+            elif location == (7, 0 if captured.color == PieceColor.WHITE else 7):
+                board.removeCastlingRights(captured.color, 'K')
         # update en passant rights:
-        board.fen.enPassantTarget = '-'
+        board.setEnPassantTarget('-')
     
 
-    def _getMoveCandidatesFromOffsets(self, board: Board, offsets: List[Tuple[int, int]]) -> List[int]:
-        moveCandidates = []
-        for offset in offsets:
-            # explore the field in every possible direction
-            next = Location.getLocationsFromOffsets(self.location, [offset])
-            while next:
-                next = next[0]
-                if board.squares[next].isOccupied and board.squares[next].currentPiece.color != self.color:
-                    # opponent piece found: 
-                    moveCandidates.append(next)
-                    break
-                elif board.squares[next].isOccupied:
-                    # ally piece found:
-                    break
-                else:
-                    # no piece found:
-                    moveCandidates.append(next)
-                next = Location.getLocationsFromOffsets(next, [offset])
-        return moveCandidates
+    def _getSlidingMoveCandidates(self, board: Board, directions: List[int], capturesOnly: bool = False) -> List[int]:
+        attacks = Bitboard.slidingAttacks(self.location, board.occupied(), directions)
+        if capturesOnly:
+            return Bitboard.toLocations(attacks & board.occupancy[self.color.inverse()])
+        return Bitboard.toLocations(attacks & ~board.occupancy[self.color])
 
     def _isPinned(self, board: Board) -> bool:
         kingLocation = board.kingLocation[self.color]
-        fileOffset = Location.getFileOffset(kingLocation, self.location)
-        rankOffset = Location.getRankOffset(kingLocation, self.location)
         # check if self is on an "attack path" relative to king:
-        if abs(fileOffset) == abs(rankOffset):
+        direction = DIRECTIONS[kingLocation][self.location]
+        if direction in Bitboard.DIAGONALS:
             # potential attackers: bishop and queen
-            offset = (-int(fileOffset / abs(fileOffset)), -int(rankOffset / abs(rankOffset)))
-            attackers = ['Q', 'B']
-        elif fileOffset == 0:
-            # potential attackers: rook and queen
-            offset = (0, -int(rankOffset / abs(rankOffset)))
-            attackers = ['Q', 'R']
-        elif rankOffset == 0:
+            attackers = 'QB'
+        elif direction != 0:
             # potential attackers: rook and queen
-            offset = (-int(fileOffset / abs(fileOffset)), 0)
-            attackers = ['Q', 'R']
+            attackers = 'QR'
         else:
             # no pin possible
             return False
-        next = Location.getLocationsFromOffsets(kingLocation, [offset])
-        potentialPin = False
-        while next:
-            next = next[0]
-            if next == self.location:
-                potentialPin = True            
-            elif board.squares[next].isOccupied and board.squares[next].currentPiece.color != self.color and board.squares[next].currentPiece.identifier.upper() in attackers:
-                # attacker found -> if we already passed our piece (self), then it's a pin:
-                return potentialPin
-            elif board.squares[next].isOccupied:
-                # king is protected by other ally or opponent piece:
-                return False
-            next = Location.getLocationsFromOffsets(next, [offset])
-        # if we end up here, there was no attacker found:
-        return False
+        occupied = board.occupied()
+        if BETWEEN[kingLocation][self.location] & occupied:
+            # king is protected by other ally or opponent piece:
+            return False
+        # the first piece behind self (seen from the king) decides whether it's a pin:
+        blockers = RAYS[direction][self.location] & occupied
+        if not blockers:
+            return False
+        if self.color == PieceColor.WHITE:
+            attackers = attackers.lower()
+        first = Bitboard.firstLocation(blockers, direction)
+        return (board.bitboards[attackers[0]] | board.bitboards[attackers[1]]) & (1 << first) != 0
 
     def _getGlobalValidMoves(self, moveCandidates: List[int], board: Board) -> List[int]:
         """ takes into account the global board situation, that is:
+            - Pins (remove moves that would lead to a check)
+            - Checks (if the king is in check, only moves that prevent that check are valid)
+            hint: the checks and pins are computed once per position and color (see LegalityContext) and shared by all pieces,
+            _getGlobalValidMovesReference() is the original per-piece implementation
+        """
+        context = board.legalityContext(self.color)
+        allowed = context.checkMask & context.pinned.get(self.location, Bitboard.FULL)
+        if allowed == Bitboard.FULL:
+            return moveCandidates
+        return [move for move in moveCandidates if allowed & (1 << move)]
+
+    def _getGlobalValidMovesReference(self, moveCandidates: List[int], board: Board) -> List[int]:
+        """ per-piece reference implementation of _getGlobalValidMoves() (detects checks and pins from scratch on every call,
+            only used to cross-check the LegalityContext in the tests), takes into account the global board situation, that is:
             - Pins (remove moves that would lead to a check)
             - Checks (if the king is in check, only moves that prevent that check are valid)
             hint: _getGlobalValidMoves() will not be called by the king itself, so if the king is being checked by
             more than one piece at the same time, this function will just return an empty list (because a double
             check can only be solved by moving the king)
         """
-        check = board.squares[board.kingLocation[self.color]].currentPiece.isInCheck(board)
+        kingLocation = board.kingLocation[self.color]
+        check = board.squares[kingLocation].currentPiece.isInCheck(board)
         if len(check) >= 2:
             # a position where the king is checked by 2 or more pieces can only be resolved through moving the king
             return []
@@ -600,56 +1661,37 @@ class Piece:
             return []
         elif len(check) == 1:
             # king is in check -> only moves that block the attack path are valid
-            attackerLocation = check[0]
-            kingLocation = board.kingLocation[self.color]
-            blockingLocations = Location.getLocationsOnPath(kingLocation, attackerLocation)
-            blockingLocations.append(attackerLocation)      # capturing the attacker would solve the problem, too
-            return list(set(blockingLocations) & set(moveCandidates))
+            # (capturing the attacker would solve the problem, too)
+            allowed = BETWEEN[kingLocation][check[0]] | (1 << check[0])
         elif pin == True and self.identifier.upper() == 'N':
             # shortcut to save executing time: a pinned knight can never move:
             return []
         elif pin == True:
-            # offsets from piece's point of view:
-            kingOffset = Location.getTupleOffset(self.location, board.kingLocation[self.color])
-            validMoves = []
-            if abs(kingOffset[0]) == abs(kingOffset[1]):
-                # diagonal attack path -> only movements on this path are allowed to not end up in check:
-                relIndex = 0      # index actually does not matter for diagonal attack paths, just for code reuse; you could as well use 1 here
-                allowedNominalOffsets = [Location.nominalizeTuple(kingOffset)]             
-            else:
-                # linear attack path -> only movements on this path are allowed to not end up in check:
-                relIndex = 0 if kingOffset[1] == 0 else 1
-                allowedNominalOffsets = [tuple(ti/kingOffset[relIndex] for ti in kingOffset)]
-            # movements in the opposite direction are also valid:
-            allowedNominalOffsets.append(tuple(-ti for ti in allowedNominalOffsets[0]))
-            # check if move candidates are on the attack path:
-            for move in moveCandidates:
-                offset = Location.getTupleOffset(self.location, move)
-                if (tuple(ti/abs(offset[relIndex]) for ti in offset) if (abs(offset[relIndex]) != 0) else (0,0)) in allowedNominalOffsets:
-                    # legal move on the attack path -> do nothing
-                    validMoves.append(move)
-            return validMoves
+            # only movements on the attack path (in both directions) are allowed to not end up in check:
+            allowed = LINE[kingLocation][self.location]
         else:
             return moveCandidates
+        return [move for move in moveCandidates if allowed & (1 << move)]
 
 class King(Piece):
     def __init__(self, color: PieceColor, location: int = INVALID_LOC) -> None:
         Piece.__init__(self, color, 'K', 0, location)
 
     def getValidMoves(self, board: Board, currentLocation: int = INVALID_LOC) -> List[int]:
-        offsets = [(-1,1), (1,1), (-1, -1), (1,-1), (-1, 0), (1, 0), (0, -1), (0, 1)]
         if currentLocation == INVALID_LOC:
             currentLocation = self.location
-        moveCandidates = Location.getLocationsFromOffsets(currentLocation, offsets)
         # filter out move candidates with ally pieces and move candidates that would lead to a check:
-        moveCandidates[:] = filterfalse(lambda candidate : \
-            True if (board.squares[candidate].isOccupied and board.squares[candidate].currentPiece.color == self.color) else (
-                True if (len(self._locationUnderAttack(board, candidate, 1)) > 0) else False), moveCandidates)
+        moveCandidates = [candidate for candidate in Bitboard.toLocations(KING_ATTACKS[currentLocation] & ~board.occupancy[self.color]) \
+            if not self._attackersOf(board, candidate)]
         # add castling rights:
-        if not self.isInCheck(board):
+        if not board.legalityContext(self.color).checkers:
             moveCandidates.extend(self._getCastlingRights(board))
         return moveCandidates
 
+    def getValidCaptures(self, board: Board) -> List[int]:
+        return [candidate for candidate in Bitboard.toLocations(KING_ATTACKS[self.location] & board.occupancy[self.color.inverse()]) \
+            if not self._attackersOf(board, candidate)]
+
     def makeMove(self, board: Board, target: int) -> None:
         source = self.location
         self._switchSquaresAndCapture(board, target)
@@ -666,72 +1708,59 @@ class King(Piece):
         """ returns List of locations of attacking opponents or empty list, if not in check """
         return self._locationUnderAttack(board, self.location)
 
+    def _attackersOf(self, board: Board, location: int, occupied: int = None, captured: int = 0) -> int:
+        """ returns a bitboard of all opponent pieces attacking location
+            hint: the king itself is removed from the occupancy so that it does not shield squares on the
+            attack path behind it (relevant for evaluating the king's own move candidates)
+            occupied/captured can be used to look at a hypothetical position (occupancy after a move, captured opponent pieces)
+        """
+        opp = 'pnbrqk' if self.color == PieceColor.WHITE else 'PNBRQK'
+        bb = board.bitboards
+        if occupied is None:
+            occupied = board.occupied() & ~(1 << self.location)
+        attackers = (KNIGHT_ATTACKS[location] & bb[opp[1]]) | \
+            (PAWN_ATTACKS[self.color][location] & bb[opp[0]]) | \
+            (KING_ATTACKS[location] & bb[opp[5]])
+        diagonal = bb[opp[2]] | bb[opp[4]]
+        if diagonal:
+            attackers |= Bitboard.slidingAttacks(location, occupied, Bitboard.DIAGONALS) & diagonal
+        linear = bb[opp[3]] | bb[opp[4]]
+        if linear:
+            attackers |= Bitboard.slidingAttacks(location, occupied, Bitboard.LINES) & linear
+        return attackers & ~captured
+
     def _locationUnderAttack(self, board: Board, location: int, cap: int = 2) -> List[int]:
         """ This function checks if a location is under attack by an opponent piece and 
             returns the locations of attacking opponents
             hint: at the moment, the returned list is capped at a length of 2 to save executing time
         """
-        attackerLocations = []
-        # 1) the "just check one field"s: Knight, Pawn, King 
-        oneSquareAttackers = {}
-        oppPawnRankOffset = 1 if self.color == PieceColor.WHITE else -1 
-        oneSquareAttackers['N'] = [(-2,1),(-1,2),(1,2),(2,1),(2,-1),(1,-2),(-1,-2),(-2,-1)] 
-        oneSquareAttackers['P'] = [(-1,oppPawnRankOffset),(1,oppPawnRankOffset)]
-        oneSquareAttackers['K'] = [(-1,1),(1,1),(-1,-1),(1,-1),(-1,0),(1,0),(0,-1),(0,1)]
-
-        for attacker in oneSquareAttackers:
-            attackerLocs = Location.getLocationsFromOffsets(location, oneSquareAttackers[attacker])
-            for attackerLoc in attackerLocs:
-                if board.squares[attackerLoc].isOccupied and board.squares[attackerLoc].currentPiece.color != self.color and board.squares[attackerLoc].currentPiece.identifier.upper() == attacker:
-                    attackerLocations.append(attackerLoc)
-                    if len(attackerLocations) >= cap:
-                        # save executing time since more than 2 attackers make no difference for the game logic
-                        return attackerLocations
-        
-        # 2) the "check the whole attack path"s: Queen, Rook, Bishop
-        pathAttackers = {}
-        pathAttackers['B'] = [(1, 1), (1, -1), (-1, 1), (-1, -1)]
-        pathAttackers['R'] = [(0, 1), (0, -1), (1, 0), (-1, 0)]
-
-        for attacker in pathAttackers:
-            for nominalOffset in pathAttackers[attacker]:
-                next = Location.getLocationsFromOffsets(location, [nominalOffset])
-                while next:
-                    next = next[0]
-                    if board.squares[next].isOccupied and board.squares[next].currentPiece.identifier != self.identifier:
-                        if board.squares[next].currentPiece.color != self.color and board.squares[next].currentPiece.identifier.upper() in [attacker, 'Q']:
-                            attackerLocations.append(next)
-                            if len(attackerLocations) >= cap:
-                                # save executing time since more than 2 attackers make no difference for the game logic
-                                return attackerLocations
-                        # if one square is occupied, that means we found the attacker or there is no more risk:
-                        break
-                    next = Location.getLocationsFromOffsets(next, [nominalOffset])
-        return attackerLocations
+        return Bitboard.toLocations(self._attackersOf(board, location))[:cap]
 
     def _getCastlingRights(self, board: Board) -> List[int]:
         fen = set(board.fen.castlingAvailability)
         options = list(fen & set('KQ')) if self.color == PieceColor.WHITE else list(fen & set('kq'))
         if len(options) == 0:
             return []
-        options = (option.upper() for option in options)
+        options = [option.upper() for option in options]
         rank = 0 if self.color == PieceColor.WHITE else 7
+        occupied = board.occupied()
+        # safety net: the rook has to be on its initial square (captures there remove the right already):
+        rooks = board.bitboards['R' if self.color == PieceColor.WHITE else 'r']
+        if not rooks & (1 << Location.tupleToAbsoluteSq((7, rank))):
+            options = [option for option in options if option != 'K']
+        if not rooks & (1 << Location.tupleToAbsoluteSq((0, rank))):
+            options = [option for option in options if option != 'Q']
         castlingRights = []
         # add kingside castling -> if f/g are not under attack (file 5,6) and f/g are not occupied
-        if ('K' in options) and \
-            (len(self._locationUnderAttack(board, Location.tupleToAbsoluteSq((5, rank)))) == 0) and \
-            (len(self._locationUnderAttack(board, Location.tupleToAbsoluteSq((6, rank)))) == 0) and \
-            (board.squares[Location.tupleToAbsoluteSq((5, rank))].isOccupied == False) and \
-            (board.squares[Location.tupleToAbsoluteSq((6, rank))].isOccupied == False):
-            castlingRights.append(Location.tupleToAbsoluteSq((6, rank)))
+        f, g = Location.tupleToAbsoluteSq((5, rank)), Location.tupleToAbsoluteSq((6, rank))
+        if ('K' in options) and not (occupied & ((1 << f) | (1 << g))) and \
+            not self._attackersOf(board, f) and not self._attackersOf(board, g):
+            castlingRights.append(g)
         # add queenside castling -> if c/d are not under attack (file 2/3) and b, c, d are not occupied
-        if ('Q' in options) and \
-            (len(self._locationUnderAttack(board, Location.tupleToAbsoluteSq((2, rank)))) == 0) and \
-            (len(self._locationUnderAttack(board, Location.tupleToAbsoluteSq((3, rank)))) == 0) and \
-            (board.squares[Location.tupleToAbsoluteSq((1, rank))].isOccupied == False) and \
-            (board.squares[Location.tupleToAbsoluteSq((2, rank))].isOccupied == False) and \
-            (board.squares[Location.tupleToAbsoluteSq((3, rank))].isOccupied == False):
-            castlingRights.append(Location.tupleToAbsoluteSq((2, rank)))
+        b, c, d = Location.tupleToAbsoluteSq((1, rank)), Location.tupleToAbsoluteSq((2, rank)), Location.tupleToAbsoluteSq((3, rank))
+        if ('Q' in options) and not (occupied & ((1 << b) | (1 << c) | (1 << d))) and \
+            not self._attackersOf(board, c) and not self._attackersOf(board, d):
+            castlingRights.append(c)
         return castlingRights
 
 class Queen(Piece):
@@ -739,8 +1768,11 @@ class Queen(Piece):
         Piece.__init__(self, color, 'Q', 9, location)
 
     def getValidMoves(self, board: Board) -> List[int]:
-        offsets = [(-1,1), (1,1), (-1, -1), (1,-1), (-1, 0), (1, 0), (0, -1), (0, 1)]
-        moveCandidates = self._getMoveCandidatesFromOffsets(board, offsets)
+        moveCandidates = self._getSlidingMoveCandidates(board, Bitboard.DIAGONALS + Bitboard.LINES)
+        return self._getGlobalValidMoves(moveCandidates, board)
+
+    def getValidCaptures(self, board: Board) -> List[int]:
+        moveCandidates = self._getSlidingMoveCandidates(board, Bitboard.DIAGONALS + Bitboard.LINES, True)
         return self._getGlobalValidMoves(moveCandidates, board)
 
     def makeMove(self, board: Board, target: int) -> None:
@@ -751,13 +1783,16 @@ class Rook(Piece):
         Piece.__init__(self, color, 'R', 5, location)
 
     def getValidMoves(self, board: Board) -> List[int]:
-        offsets = [(-1,0), (1,0), (0, -1), (0, 1)]
-        moveCandidates = self._getMoveCandidatesFromOffsets(board, offsets)
+        moveCandidates = self._getSlidingMoveCandidates(board, Bitboard.LINES)
+        return self._getGlobalValidMoves(moveCandidates, board)
+
+    def getValidCaptures(self, board: Board) -> List[int]:
+        moveCandidates = self._getSlidingMoveCandidates(board, Bitboard.LINES, True)
         return self._getGlobalValidMoves(moveCandidates, board)
 
     def makeMove(self, board: Board, target: int) -> None:
         # update castling rights
-        location = Location.absoluteSqToTuple(self.location)[0]
+        location = Location.absoluteSqToTuple(self.location)
         defaultRank = 0 if self.color == PieceColor.WHITE else 7
         if location == (0, defaultRank):
             board.removeCastlingRights(self.color, 'Q')
@@ -770,8 +1805,11 @@ class Bishop(Piece):
         Piece.__init__(self, color, 'B', 3, location)
 
     def getValidMoves(self, board: Board) -> List[int]:
-        offsets = [(-1,1), (1,1), (-1, -1), (1,-1)]
-        moveCandidates = self._getMoveCandidatesFromOffsets(board, offsets)
+        moveCandidates = self._getSlidingMoveCandidates(board, Bitboard.DIAGONALS)
+        return self._getGlobalValidMoves(moveCandidates, board)
+
+    def getValidCaptures(self, board: Board) -> List[int]:
+        moveCandidates = self._getSlidingMoveCandidates(board, Bitboard.DIAGONALS, True)
         return self._getGlobalValidMoves(moveCandidates, board)
 
     def makeMove(self, board: Board, target: int) -> None:
@@ -782,11 +1820,11 @@ class Knight(Piece):
         Piece.__init__(self, color, 'N', 3, location)
 
     def getValidMoves(self, board: Board) -> List[int]:
-        offsets = [(-2,1),(-1,2),(1,2),(2,1),(2,-1),(1,-2),(-1,-2),(-2,-1)]
-        currentLocation = self.location
-        moveCandidates = Location.getLocationsFromOffsets(currentLocation, offsets)
-        moveCandidates[:] = filterfalse(lambda candidate : \
-            True if (board.squares[candidate].isOccupied and board.squares[candidate].currentPiece.color == self.color) else False, moveCandidates)
+        moveCandidates = Bitboard.toLocations(KNIGHT_ATTACKS[self.location] & ~board.occupancy[self.color])
+        return self._getGlobalValidMoves(moveCandidates, board)
+
+    def getValidCaptures(self, board: Board) -> List[int]:
+        moveCandidates = Bitboard.toLocations(KNIGHT_ATTACKS[self.location] & board.occupancy[self.color.inverse()])
         return self._getGlobalValidMoves(moveCandidates, board)
 
     def makeMove(self, board: Board, target: int) -> None:
@@ -811,56 +1849,68 @@ class Pawn(Piece):
             return (target >= 56)
     
     def getValidMoves(self, board: Board) -> List[int]:
-        currentLocation = self.location
-        if self.color == PieceColor.WHITE:
-            offsets = [(0,1),(1,1),(-1,1)]
-        else:
-            offsets = [(0,-1),(1,-1),(-1,-1)]
-        if self.isFirstMove():
-            offsets.append((0,2*offsets[0][1]))
-        moveCandidates = Location.getLocationsFromOffsets(currentLocation, offsets)
-        # remove candidates with a file offset if there is no opponent piece
-        # and candidates without file offset if there is any piece:
-        moveCandidates[:] = filterfalse(lambda candidate : \
-            True if (Location.getFileOffset(self.location, candidate) != 0 and (board.squares[candidate].isOccupied == False or board.squares[candidate].currentPiece.color == self.color)) else (
-                True if (Location.getFileOffset(self.location, candidate) == 0 and board.squares[candidate].isOccupied) else False
-            ), moveCandidates)
-        # if square in front of the pawn is blocked, the next square (rank offset 2) is also not a valid move :
-        if offsets[0] not in [Location.getTupleOffset(candidate, self.location) for candidate in moveCandidates]:
-            moveCandidates[:] = filterfalse(lambda candidate : \
-                True if (abs(Location.getRankOffset(self.location, candidate)) == 2) else False, moveCandidates)
-        # add en passant moves (if applicable):
-        if board.fen.enPassantTarget != '-':
+        empty = ~board.occupied()
+        # pushes: the square in front has to be empty (and for the initial double step, the one after that, too):
+        step = -8 if self.color == PieceColor.WHITE else 8
+        moveCandidates = []
+        if empty & (1 << (self.location + step)):
+            moveCandidates.append(self.location + step)
+            if self.isFirstMove() and empty & (1 << (self.location + 2 * step)):
+                moveCandidates.append(self.location + 2 * step)
+        # captures:
+        moveCandidates.extend(Bitboard.toLocations(PAWN_ATTACKS[self.color][self.location] & board.occupancy[self.color.inverse()]))
+        validMoves = self._getGlobalValidMoves(moveCandidates, board)
+        self._addEnPassant(board, validMoves)
+        return validMoves
+
+    def getValidCaptures(self, board: Board) -> List[int]:
+        """ captures (including en passant) and promotions - the moves that change the material balance """
+        moveCandidates = Bitboard.toLocations(PAWN_ATTACKS[self.color][self.location] & board.occupancy[self.color.inverse()])
+        step = -8 if self.color == PieceColor.WHITE else 8
+        if self._isPawnPromotion(self.location + step) and not board.squares[self.location + step].isOccupied:
+            moveCandidates.append(self.location + step)
+        validMoves = self._getGlobalValidMoves(moveCandidates, board)
+        self._addEnPassant(board, validMoves)
+        return validMoves
+
+    def _addEnPassant(self, board: Board, validMoves: List[int]) -> None:
+        # en passant (if applicable) -> checked separately since two pieces leave their squares at once:
+        if board.fen.enPassantTarget != '-' and board.activeColor() == self.color:
             target = Location.algebraicSqToAbsoluteSq(board.fen.enPassantTarget)
-            if target in Location.getLocationsFromOffsets(currentLocation, offsets):
-                moveCandidates.append(target)
-        return self._getGlobalValidMoves(moveCandidates, board)
+            if PAWN_ATTACKS[self.color][self.location] & (1 << target) and self._isLegalEnPassant(board, target):
+                validMoves.append(target)
+
+    def _isLegalEnPassant(self, board: Board, target: int) -> bool:
+        """ en passant is legal if the own king is not attacked after the capture - this covers pins along the rank 
+            (both pawns leave it) as well as capturing a checking pawn """
+        captured = target + 8 if self.color == PieceColor.WHITE else target - 8
+        occupied = (board.occupied() & ~(1 << self.location) & ~(1 << captured)) | (1 << target)
+        kingLocation = board.kingLocation[self.color]
+        return not board.squares[kingLocation].currentPiece._attackersOf(board, kingLocation, occupied, 1 << captured)
 
     def makeMove(self, board: Board, target: int) -> None:
         source = self.location
         if board.fen.enPassantTarget != '-' and Location.algebraicSqToAbsoluteSq(board.fen.enPassantTarget) == target:
             # en passant capture: remove the piece:
             epCaptLoc = target + 8 if self.color == PieceColor.WHITE else target - 8
-            epCaptPiece = board.squares[epCaptLoc].currentPiece
-            board.squares[epCaptLoc].reset()
-            board.removePiece(epCaptPiece)
+            board.removePiece(board._liftPiece(epCaptLoc))
         self._switchSquaresAndCapture(board, target)
         # pawn promotion - TODO: selective (atm only queens are possible)
         if self._isPawnPromotion(target):
             # remove self from target
-            board.squares[target].reset()
-            board.removePiece(self)
+            board.removePiece(board._liftPiece(target))
             promotedPiece = Queen(self.color)
-            board.squares[target].set(promotedPiece)
+            board._placePiece(promotedPiece, target)
             board.stat = board.stat + promotedPiece.value if promotedPiece.color == PieceColor.WHITE else board.stat - promotedPiece.value
             board.pieces[promotedPiece.color].append(promotedPiece)
+            board.material[promotedPiece.identifier] += 1
         # update en passant rights:
         if abs(Location.getRankOffset(source, target)) == 2:
             if self.color == PieceColor.WHITE:
                 skipped = source - 8
             else:
                 skipped = source + 8
-            board.fen.enPassantTarget = Location.absoluteSqToAlgebraicSq(skipped)
+            board.setEnPassantTarget(Location.absoluteSqToAlgebraicSq(skipped))
 
 
 class Square:
@@ -924,7 +1974,7 @@ class Location:
     """
     def absoluteSqToTuple(absoluteSq: int) -> Tuple[int, int]:
         """ absolute to tuple notation, e.g. 7 -> (7,7); 36 -> (4,3) """
-        return (absoluteSq % 8, 7 - int(absoluteSq / 8))
+        return TUPLES[absoluteSq]
 
     def tupleToAlgebraicSq(tpl: Tuple[int, int]) -> str:
         """ tuple to algebraic notation, e.g. (7,7) -> 'h8'; (4,3) -> 'e4' """
@@ -944,53 +1994,30 @@ class Location:
 
     def getLocationsFromOffsets(current: int, offsets: List[Tuple[int,int]]) -> List[int]:
         locations = []
-        currentTpl = Location.absoluteSqToTuple(current)
         for offset in offsets:
-            file = currentTpl[0] + offset[0]
-            rank = currentTpl[1] + offset[1]
-            if file >= 0 and file <= 7 and rank >= 0 and rank <= 7:
+            location = OFFSET_TARGETS[offset][current]
+            if location != INVALID_LOC:
                 # valid new location -> add to list:
-                locations.append(Location.tupleToAbsoluteSq((file, rank)))
+                locations.append(location)
         return locations
 
     def getFileOffset(current: int, target: int) -> int:
-        return Location.absoluteSqToTuple(current)[0] - Location.absoluteSqToTuple(target)[0]
+        return TUPLE_OFFSETS[current][target][0]
 
     def getRankOffset(current: int, target: int) -> int:
-        return Location.absoluteSqToTuple(current)[1] - Location.absoluteSqToTuple(target)[1]
+        return TUPLE_OFFSETS[current][target][1]
 
     def getTupleOffset(current: int, target: int) -> Tuple[int, int]:
         # returns a (file, rank) offset tuple
-        return (Location.getFileOffset(current, target), Location.getRankOffset(current, target))
+        return TUPLE_OFFSETS[current][target]
 
     def nominalizeTuple(tpl: Tuple[int, int]) -> Tuple[int, int]:
         # nominalizes tpl (-> every element will have the absolute value 1 or 0):
-        return tuple((int(ti/abs(ti)) if abs(ti) != 0 else 0) for ti in tpl)
+        return NOMINAL_OFFSETS[tpl]
 
     def getLocationsOnPath(loc1: int, loc2: int) -> List[int]:
-        # returns a list of locations on the path between loc1 and loc2
-
-        # TODO refactoring idea: where we call this method, the attacker location is explicitly appended to the List afterwards;
-        # in this method itself, we explicitly exclude the attacker's (or king's) location (i == 0) -> if there is no other 
-        # use for this method, we should change that. 
-        locations = []
-        offset = Location.getTupleOffset(loc1, loc2)
-        tpl1 = Location.absoluteSqToTuple(loc1)
-        tpl2 = Location.absoluteSqToTuple(loc2)
-        if not ((abs(offset[0]) == abs(offset[1])) or (0 in offset)):
-            # no direct path -> return empty list
-            return []
-        # diagonal path/linear path:
-        relevantIndex = 1 if offset[0] == 0 else 0
-        nominalOffset = Location.nominalizeTuple(offset)
-        for i in range(abs(offset[relevantIndex])):
-            if i == 0:
-                continue
-            loc = (tpl2[0] + i * nominalOffset[0], tpl2[1] + i * nominalOffset[1])
-            if loc == tpl1:
-                break
-            locations.append(Location.tupleToAbsoluteSq(loc))
-        return locations
+        # returns a list of locations on the path between loc1 and loc2 (both excluded; empty list if there is no direct path)
+        return Bitboard.toLocations(BETWEEN[loc1][loc2])
 
     def getLocationsOnFile(file: str) -> List[int]:
         lst = []
@@ -1008,6 +2035,212 @@ class Location:
         return lst
 
 
+class Bitboard:
+    """ 
+    A bitboard is a set of locations packed into one 64-bit integer: bit n is set if absolute square n is part of the set
+    (so bit 0 is A8 and bit 63 is H1, in accordance with the absolute notation of the Location class).
+    Directions are given as the difference of absolute squares, e.g. -8 is one rank up (towards rank 8), +1 is one file
+    to the right (towards the h-file).
+    """
+    FULL = (1 << 64) - 1
+    A_FILE = 0x0101010101010101
+    H_FILE = A_FILE << 7
+    NORTH, SOUTH, EAST, WEST = -8, 8, 1, -1
+    NORTH_EAST, NORTH_WEST, SOUTH_EAST, SOUTH_WEST = -7, -9, 9, 7
+    LINES = [NORTH, SOUTH, EAST, WEST]
+    DIAGONALS = [NORTH_EAST, NORTH_WEST, SOUTH_EAST, SOUTH_WEST]
+
+    def shift(bitboard: int, direction: int) -> int:
+        """ moves every location of the set one step into direction (locations leaving the board are dropped) """
+        if direction > 0:
+            bitboard = (bitboard << direction) & Bitboard.FULL
+        else:
+            bitboard >>= -direction
+        if direction in (Bitboard.EAST, Bitboard.NORTH_EAST, Bitboard.SOUTH_EAST):
+            # wrapped around from the h-file to the a-file:
+            bitboard &= ~Bitboard.A_FILE
+        elif direction in (Bitboard.WEST, Bitboard.NORTH_WEST, Bitboard.SOUTH_WEST):
+            # wrapped around from the a-file to the h-file:
+            bitboard &= ~Bitboard.H_FILE
+        return bitboard
+
+    def fromLocations(locations: List[int]) -> int:
+        bitboard = 0
+        for loc in locations:
+            bitboard |= 1 << loc
+        return bitboard
+
+    def toLocations(bitboard: int) -> List[int]:
+        """ returns the locations of the set in ascending order """
+        locations = []
+        while bitboard:
+            lsb = bitboard & -bitboard
+            locations.append(lsb.bit_length() - 1)
+            bitboard ^= lsb
+        return locations
+
+    def knightAttacks(location: int) -> int:
+        bit = 1 << location
+        attacks = 0
+        for first in Bitboard.LINES:
+            for second in ((Bitboard.EAST, Bitboard.WEST) if first in (Bitboard.NORTH, Bitboard.SOUTH) else (Bitboard.NORTH, Bitboard.SOUTH)):
+                attacks |= Bitboard.shift(Bitboard.shift(Bitboard.shift(bit, first), first), second)
+        return attacks
+
+    def kingAttacks(location: int) -> int:
+        bit = 1 << location
+        attacks = 0
+        for direction in Bitboard.LINES + Bitboard.DIAGONALS:
+            attacks |= Bitboard.shift(bit, direction)
+        return attacks
+
+    def pawnAttacks(location: int, color: PieceColor) -> int:
+        """ returns the locations attacked by a pawn of the given color standing on location """
+        bit = 1 << location
+        if color == PieceColor.WHITE:
+            return Bitboard.shift(bit, Bitboard.NORTH_EAST) | Bitboard.shift(bit, Bitboard.NORTH_WEST)
+        else:
+            return Bitboard.shift(bit, Bitboard.SOUTH_EAST) | Bitboard.shift(bit, Bitboard.SOUTH_WEST)
+
+    def firstLocation(bitboard: int, direction: int) -> int:
+        """ returns the location of bitboard that comes first when walking into direction """
+        if direction > 0:
+            return (bitboard & -bitboard).bit_length() - 1
+        else:
+            return bitboard.bit_length() - 1
+
+    def slidingAttacks(location: int, occupied: int, directions: List[int]) -> int:
+        """ returns the locations reachable from location in the given directions; every ray ends at (and includes)
+            the first occupied square """
+        attacks = 0
+        for direction in directions:
+            ray = RAYS[direction][location]
+            blockers = ray & occupied
+            if blockers:
+                # cut off everything behind the first blocker:
+                ray ^= RAYS[direction][Bitboard.firstLocation(blockers, direction)]
+            attacks |= ray
+        return attacks
+
+
+#### precomputed tables ####
+# Everything that only depends on locations (and not on the position) is computed once at import, so that
+# the move generation itself does not need any file/rank arithmetic.
+
+TUPLES = [(loc % 8, 7 - loc // 8) for loc in range(64)]
+TUPLE_OFFSETS = [[(TUPLES[current][0] - TUPLES[target][0], TUPLES[current][1] - TUPLES[target][1]) for target in range(64)] \
+    for current in range(64)]
+NOMINAL_OFFSETS = {}
+OFFSET_TARGETS = {}
+for fileOffset in range(-7, 8):
+    for rankOffset in range(-7, 8):
+        NOMINAL_OFFSETS[(fileOffset, rankOffset)] = ((fileOffset > 0) - (fileOffset < 0), (rankOffset > 0) - (rankOffset < 0))
+        OFFSET_TARGETS[(fileOffset, rankOffset)] = [(file + fileOffset) + (7 - rank - rankOffset) * 8 \
+            if 0 <= file + fileOffset <= 7 and 0 <= rank + rankOffset <= 7 else INVALID_LOC for file, rank in TUPLES]
+
+# leaper attacks:
+KNIGHT_ATTACKS = [Bitboard.knightAttacks(loc) for loc in range(64)]
+KING_ATTACKS = [Bitboard.kingAttacks(loc) for loc in range(64)]
+PAWN_ATTACKS = {color: [Bitboard.pawnAttacks(loc, color) for loc in range(64)] for color in (PieceColor.WHITE, PieceColor.BLACK)}
+
+# sliding rays (RAYS[direction][loc], excluding loc itself) and the direction from one location to another (0 if not aligned):
+RAYS = {}
+DIRECTIONS = [[0] * 64 for loc in range(64)]
+for direction in Bitboard.LINES + Bitboard.DIAGONALS:
+    RAYS[direction] = []
+    for loc in range(64):
+        ray = 0
+        bit = Bitboard.shift(1 << loc, direction)
+        while bit:
+            ray |= bit
+            DIRECTIONS[loc][bit.bit_length() - 1] = direction
+            bit = Bitboard.shift(bit, direction)
+        RAYS[direction].append(ray)
+
+# squares strictly between two aligned locations and the whole line through them (0 if not aligned):
+BETWEEN = [[0] * 64 for loc in range(64)]
+LINE = [[0] * 64 for loc in range(64)]
+for loc1 in range(64):
+    for loc2 in range(64):
+        direction = DIRECTIONS[loc1][loc2]
+        if direction:
+            BETWEEN[loc1][loc2] = RAYS[direction][loc1] & ~RAYS[direction][loc2] & ~(1 << loc2)
+            LINE[loc1][loc2] = RAYS[direction][loc1] | RAYS[-direction][loc1] | (1 << loc1)
+
+# piece-square tables (centipawns, from white's point of view, index = absolute square, i.e. a8 first), see
+# https://www.chessprogramming.org/Simplified_Evaluation_Function
+PIECE_SQUARE_TABLES = {
+    'P': [  0,   0,   0,   0,   0,   0,   0,   0,
+           50,  50,  50,  50,  50,  50,  50,  50,
+           10,  10,  20,  30,  30,  20,  10,  10,
+            5,   5,  10,  25,  25,  10,   5,   5,
+            0,   0,   0,  20,  20,   0,   0,   0,
+            5,  -5, -10,   0,   0, -10,  -5,   5,
+            5,  10,  10, -20, -20,  10,  10,   5,
+            0,   0,   0,   0,   0,   0,   0,   0],
+    'N': [-50, -40, -30, -30, -30, -30, -40, -50,
+          -40, -20,   0,   0,   0,   0, -20, -40,
+          -30,   0,  10,  15,  15,  10,   0, -30,
+          -30,   5,  15,  20,  20,  15,   5, -30,
+          -30,   0,  15,  20,  20,  15,   0, -30,
+          -30,   5,  10,  15,  15,  10,   5, -30,
+          -40, -20,   0,   5,   5,   0, -20, -40,
+          -50, -40, -30, -30, -30, -30, -40, -50],
+    'B': [-20, -10, -10, -10, -10, -10, -10, -20,
+          -10,   0,   0,   0,   0,   0,   0, -10,
+          -10,   0,   5,  10,  10,   5,   0, -10,
+          -10,   5,   5,  10,  10,   5,   5, -10,
+          -10,   0,  10,  10,  10,  10,   0, -10,
+          -10,  10,  10,  10,  10,  10,  10, -10,
+          -10,   5,   0,   0,   0,   0,   5, -10,
+          -20, -10, -10, -10, -10, -10, -10, -20],
+    'R': [  0,   0,   0,   0,   0,   0,   0,   0,
+            5,  10,  10,  10,  10,  10,  10,   5,
+           -5,   0,   0,   0,   0,   0,   0,  -5,
+           -5,   0,   0,   0,   0,   0,   0,  -5,
+           -5,   0,   0,   0,   0,   0,   0,  -5,
+           -5,   0,   0,   0,   0,   0,   0,  -5,
+           -5,   0,   0,   0,   0,   0,   0,  -5,
+            0,   0,   0,   5,   5,   0,   0,   0],
+    'Q': [-20, -10, -10,  -5,  -5, -10, -10, -20,
+          -10,   0,   0,   0,   0,   0,   0, -10,
+          -10,   0,   5,   5,   5,   5,   0, -10,
+           -5,   0,   5,   5,   5,   5,   0,  -5,
+            0,   0,   5,   5,   5,   5,   0,  -5,
+          -10,   5,   5,   5,   5,   5,   0, -10,
+          -10,   0,   5,   0,   0,   0,   0, -10,
+          -20, -10, -10,  -5,  -5, -10, -10, -20],
+    'K': [-30, -40, -40, -50, -50, -40, -40, -30,
+          -30, -40, -40, -50, -50, -40, -40, -30,
+          -30, -40, -40, -50, -50, -40, -40, -30,
+          -30, -40, -40, -50, -50, -40, -40, -30,
+          -20, -30, -30, -40, -40, -30, -30, -20,
+          -10, -20, -20, -20, -20, -20, -20, -10,
+           20,  20,   0,   0,   0,   0,  20,  20,
+           20,  30,  10,   0,   0,  10,  30,  20],
+}
+# signed score per identifier and location (black: vertically mirrored and negated):
+PIECE_SQUARE = {}
+for identifier, table in PIECE_SQUARE_TABLES.items():
+    PIECE_SQUARE[identifier] = list(table)
+    PIECE_SQUARE[identifier.lower()] = [-table[loc ^ 56] for loc in range(64)]
+
+# zobrist keys: one random 64-bit number per (piece, location), side to move, castling right and en passant file;
+# the key of a position is the XOR of all applicable numbers (fixed seed -> keys are stable across processes):
+_zobristRandom = random.Random(468)
+ZOBRIST_PIECES = {identifier: [_zobristRandom.getrandbits(64) for loc in range(64)] for identifier in 'PNBRQKpnbrqk'}
+ZOBRIST_BLACK_TO_MOVE = _zobristRandom.getrandbits(64)
+ZOBRIST_CASTLING = {char: _zobristRandom.getrandbits(64) for char in 'KQkq'}
+ZOBRIST_EN_PASSANT = {chr(97 + file): _zobristRandom.getrandbits(64) for file in range(8)}
+
+# compact board encoding (see Board.toCompactBytes): one nibble per square, bit 3 set for black pieces:
+COMPACT_MAGIC = b'CB'
+COMPACT_VERSION = 2                 # 2: position history appended
+COMPACT_FORMAT = struct.Struct('<B32sBBHHihB')
+COMPACT_IDENTIFIERS = ' PNBRQK  pnbrqk'
+COMPACT_CODES = {identifier: code for code, identifier in enumerate(COMPACT_IDENTIFIERS) if identifier != ' '}
+
+
 class PieceFactory:
     switcher = {
         'P' : Pawn,
@@ -0,0 +1,37 @@
+# training data export: replays the games of a PGN file (or reads a file with one FEN per line) and writes the positions
+# as NumPy arrays (see chupochess.TrainingExporter, requires numpy)
+# usage: 'python export.py games.pgn' from the root dir (see 'python export.py --help')
+
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from chupochess import TrainingExporter, TrainingHelper
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='chupochess training data export')
+    parser.add_argument('input', help='file with one or more PGN games (or FENs with --fens)')
+    parser.add_argument('--output', default='training', help='directory of the .npy files')
+    parser.add_argument('--fens', action='store_true', help='the input file has one FEN per line')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='replay processes (1: no process pool)')
+    parser.add_argument('--chunk', type=int, default=16384, help='positions per chunk written to the files')
+    args = parser.parse_args()
+    exporter = TrainingExporter(args.output, args.chunk)
+    executor = ProcessPoolExecutor(max_workers=args.workers) if args.workers > 1 and not args.fens else None
+    skipped = 0
+    start = time.perf_counter()
+    with open(args.input, encoding='utf-8') as file:
+        if args.fens:
+            exporter.extend(TrainingHelper.fenToPosition(line.strip()) for line in file if line.strip())
+        else:
+            for positions in TrainingHelper.mapGames(TrainingHelper.gamePositions, TrainingHelper.readPgns(file), executor):
+                if positions is None:
+                    skipped += 1
+                else:
+                    exporter.extend(positions)
+    exporter.close()
+    elapsed = time.perf_counter() - start
+    if executor is not None:
+        executor.shutdown()
+    print('positions: %d (skipped games: %d), time: %.2f s, positions/s: %.0f -> %s' % (exporter.count, skipped, elapsed, \
+        exporter.count / elapsed if elapsed > 0 else 0, args.output))
@@ -1,80 +1,299 @@
-from cs50 import SQL
+from collections import OrderedDict
+from concurrent.futures import Executor, wait
+from contextlib import contextmanager
 from datetime import datetime
+import queue
+import sqlite3
+import threading
+import time
+from chupochess import Board, COMPACT_MAGIC
+
+# ###### Connection Pool: #########
+class ConnectionPool:
+    """ pool of sqlite3 connections to one data base file: a connection is used by one thread at a time and returned 
+        to the pool afterwards (instead of opening a new connection per query); at most size idle connections are kept
+        - journalMode: WAL lets readers continue during a write and needs fewer fsyncs per commit than the rollback journal
+        - synchronous: NORMAL only syncs the WAL at checkpoints (a commit can be lost on power failure, but the data 
+          base stays consistent), FULL syncs on every commit """
+    JOURNAL_MODES = ('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF')
+    SYNCHRONOUS_LEVELS = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+    def __init__(self, path: str, size: int = 4, journalMode: str = 'WAL', synchronous: str = 'NORMAL') -> None:
+        # hint: PRAGMAs can't be parameterized -> only known values are accepted
+        if journalMode.upper() not in ConnectionPool.JOURNAL_MODES:
+            raise Exception("ERROR: Unknown journal mode: " + journalMode)
+        if synchronous.upper() not in ConnectionPool.SYNCHRONOUS_LEVELS:
+            raise Exception("ERROR: Unknown synchronous level: " + synchronous)
+        self.path = path
+        self.size = size
+        self.journalMode = journalMode.upper()
+        self.synchronous = synchronous.upper()
+        self._idle = queue.LifoQueue()
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode = %s;" % self.journalMode)
+        connection.execute("PRAGMA synchronous = %s;" % self.synchronous)
+        return connection
+
+    @contextmanager
+    def connection(self):
+        """ usage: 'with pool.connection() as connection: ...' """
+        try:
+            connection = self._idle.get_nowait()
+        except queue.Empty:
+            connection = self._connect()
+        try:
+            yield connection
+        finally:
+            if self._idle.qsize() < self.size:
+                self._idle.put(connection)
+            else:
+                connection.close()
+
+    def close(self) -> None:
+        while not self._idle.empty():
+            self._idle.get_nowait().close()
+
+
+# ###### Migrations: #########
+# schema changes, applied in order by DataLayer.migrate (the schema version of a data base is its PRAGMA user_version):
+MIGRATIONS = [
+    # 1: initial schema (existing data bases already have it)
+    ["CREATE TABLE IF NOT EXISTS active_games (id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, user TEXT NOT NULL, timestamp TEXT NOT NULL);",
+     "CREATE TABLE IF NOT EXISTS finished_games (id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, user TEXT NOT NULL, pgn TEXT NOT NULL, status TEXT NOT NULL, timestamp TEXT NOT NULL);",
+     "CREATE TABLE IF NOT EXISTS gamestate (id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, game_id INTEGER NOT NULL, move_id INTEGER NOT NULL, board BLOB NOT NULL);"],
+    # 2: every query on gamestate is by game (and move)
+    ["CREATE INDEX IF NOT EXISTS gamestate_game_move ON gamestate (game_id, move_id);"],
+    # 3: one active game per user (older games of a user are removed first, they are not reachable anyway)
+    ["DELETE FROM gamestate WHERE game_id IN (SELECT id FROM active_games WHERE id < (SELECT MAX(id) FROM active_games AS newer WHERE newer.user = active_games.user));",
+     "DELETE FROM active_games WHERE id < (SELECT MAX(id) FROM active_games AS newer WHERE newer.user = active_games.user);",
+     "CREATE UNIQUE INDEX IF NOT EXISTS active_games_user ON active_games (user);"],
+    # 4: the FEN based game_state table has been replaced by gamestate
+    ["DROP TABLE IF EXISTS game_state;"],
+    # 5: move records between the keyframes in gamestate (existing games are all keyframes, nothing to convert)
+    ["CREATE TABLE IF NOT EXISTS moves (game_id INTEGER NOT NULL, move_id INTEGER NOT NULL, source INTEGER NOT NULL, target INTEGER NOT NULL, " + \
+     "promotion TEXT, PRIMARY KEY (game_id, move_id)) WITHOUT ROWID;"],
+]
+
 
 # ###### Data Layer: #########
 class DataLayer:
     """ This class contains the interface to the database """
     # hint: user is the IP address right now but could be changed to a user name (combined with a login/registration form) anytime
+    # hint: all statements are parameterized, every function needs at most one write transaction
 
-    def getBytes(db: SQL, user: str) -> bytes:
-        """ returns the serialized protobuf if there is an active game or None if there isn't """
-        try: 
-            response = db.execute("SELECT board FROM gamestate WHERE move_id = (SELECT MAX(move_id) FROM gamestate WHERE " + \
-                "game_id = (SELECT id FROM active_games WHERE user = '" + user + "'));")
-            if response:
-                return response[0]['board']            
-            else:
-                return None
-        except:
+    # optional BoardCache in front of the data base: entries are invalidated whenever a game is changed other than by a new move
+    cache = None
+    # the history of a game is stored as keyframes (full boards in gamestate: the first position and every KEYFRAME_INTERVAL-th
+    # move) plus one record (source, target, promotion) per move in moves; the boards in between are replayed on demand:
+    KEYFRAME_INTERVAL = 16
+    NEXT_MOVE_ID = "(SELECT COALESCE(MAX(move_id), -1) + 1 FROM (SELECT MAX(move_id) AS move_id FROM gamestate WHERE game_id = active_games.id " + \
+        "UNION ALL SELECT MAX(move_id) FROM moves WHERE game_id = active_games.id))"
+
+    def migrate(db: ConnectionPool, version: int = len(MIGRATIONS)) -> int:
+        """ brings the schema up to version (default: the latest one), one transaction per migration; returns the 
+            schema version of the data base afterwards """
+        with db.connection() as connection:
+            current = connection.execute("PRAGMA user_version;").fetchone()[0]
+            for migration in range(current, min(version, len(MIGRATIONS))):
+                connection.execute("BEGIN;")
+                try:
+                    for statement in MIGRATIONS[migration]:
+                        connection.execute(statement)
+                    connection.execute("PRAGMA user_version = %d;" % (migration + 1))
+                    connection.commit()
+                except:
+                    connection.rollback()
+                    raise
+                current = migration + 1
+        return current
+
+    def getBytes(db: ConnectionPool, user: str) -> bytes:
+        """ returns the board of the active game (compact encoding, see Board.toBytes) or None if there isn't one: the last 
+            keyframe with the move records after it replayed (see _restore) """
+        with db.connection() as connection, connection:
+            return DataLayer._restore(connection, user)
+
+    def _restore(connection: sqlite3.Connection, user: str, moveId: int = None) -> bytes:
+        """ returns the serialized board after moveId (default: the last move) of the active game of user (or None), 
+            replayed from the nearest keyframe before it """
+        keyframe = connection.execute("SELECT gamestate.game_id, gamestate.move_id, gamestate.board FROM active_games " + \
+            "JOIN gamestate ON gamestate.game_id = active_games.id WHERE active_games.user = ? AND gamestate.move_id <= COALESCE(?, gamestate.move_id) " + \
+            "ORDER BY gamestate.move_id DESC LIMIT 1;", (user, moveId)).fetchone()
+        if not keyframe:
             return None
+        gameId, keyframeId, bytes = keyframe
+        if bytes[:len(COMPACT_MAGIC)] != COMPACT_MAGIC:
+            # legacy protobuf keyframe -> rewritten in the compact encoding (once)
+            bytes = Board.fromBytes(bytes).toBytes()
+            connection.execute("UPDATE gamestate SET board = ? WHERE game_id = ? AND move_id = ?;", (bytes, gameId, keyframeId))
+        moves = connection.execute("SELECT source, target FROM moves WHERE game_id = ? AND move_id > ? AND move_id <= COALESCE(?, move_id) " + \
+            "ORDER BY move_id;", (gameId, keyframeId, moveId)).fetchall()
+        if not moves:
+            return bytes
+        # the moves have been validated when they were made -> no legality checks, the game state is updated once at the end:
+        board = Board.fromBytes(bytes)
+        for source, target in moves:
+            board._applyMove(source, target)
+        board._updateGameState()
+        return board.toBytes()
 
-    def _createNewGame(db: SQL, user: str, bytes: bytes) -> None:
+    def _createNewGame(connection: sqlite3.Connection, user: str, bytes: bytes) -> None:
         # make sure there's only one active game per user:
-        db.execute("DELETE FROM active_games WHERE user = '" + user + "';")
+        connection.execute("DELETE FROM active_games WHERE user = ?;", (user,))
         # create new game id:
-        id = db.execute("INSERT INTO active_games (user, timestamp) VALUES ('" + user + "', '" + \
-             datetime.today().strftime('%Y-%m-%d %H:%M:%S') + "');")
+        id = connection.execute("INSERT INTO active_games (user, timestamp) VALUES (?, ?);", \
+            (user, datetime.today().strftime('%Y-%m-%d %H:%M:%S'))).lastrowid
         # create initial gamestate:
-        db.execute("INSERT INTO gamestate (game_id, move_id, board) VALUES (" + str(id) + ", 0, ?);", bytes)
-
-    def storeNewMove(db: SQL, user: str, bytes: bytes) -> bool:
-        """ stores a new serialized protobuf to the game state data base (and, if necessary, creates a new active game) """
-        # check if it's the first move:
-        gameId = db.execute("SELECT id FROM active_games WHERE user = '" + user + "';")
-        if not gameId:
-            DataLayer._createNewGame(db, user, bytes)
-            return True
-        gameId = str(gameId[0]['id'])
-        maxMoveId = db.execute("SELECT MAX(move_id) FROM gamestate WHERE " + \
-                "game_id = " + gameId + ";")[0]['MAX(move_id)']
-        if maxMoveId == None:
-            return False
-        # create new entry:
-        db.execute("INSERT INTO gamestate (game_id, move_id, board) VALUES (" + gameId + ", " + \
-            str(int(maxMoveId) + 1) + ", ?);", bytes)
+        connection.execute("INSERT INTO gamestate (game_id, move_id, board) VALUES (?, 0, ?);", (id, bytes))
+
+    def storeNewMove(db: ConnectionPool, user: str, bytes: bytes, move: tuple = None) -> bool:
+        """ stores the next position of the game (and, if necessary, creates a new active game)
+            bytes: the board after the move (compact encoding), only stored as a keyframe: without a move, for a new 
+            game and every KEYFRAME_INTERVAL moves
+            move: (source, target, promotion) that led to the board -> stored as a move record, replayed by _restore """
+        with db.connection() as connection, connection:
+            DataLayer._insertMove(connection, user, bytes, move)
+        return True
+
+    def storeMovePair(db: ConnectionPool, user: str, whiteBytes: bytes, blackBytes: bytes, whiteMove: tuple = None, blackMove: tuple = None) -> bool:
+        """ stores white's move and black's reply (boards and moves see storeNewMove) in one transaction: one commit 
+            instead of two, and the game is never stored with white's move but without the reply """
+        with db.connection() as connection, connection:
+            DataLayer._insertMove(connection, user, whiteBytes, whiteMove)
+            DataLayer._insertMove(connection, user, blackBytes, blackMove)
         return True
 
-    def reverseMove(db: SQL, user: str) -> bytes:
-        """ returns the last serialized protobof or None if reversing the move is not possible """
+    def _insertMove(connection: sqlite3.Connection, user: str, bytes: bytes, move: tuple) -> None:
+        # game id and next move id are looked up by the INSERT itself:
+        if move is None:
+            cursor = connection.execute("INSERT INTO gamestate (game_id, move_id, board) " + \
+                "SELECT id, " + DataLayer.NEXT_MOVE_ID + ", ? FROM active_games WHERE user = ?;", (bytes, user))
+            if cursor.rowcount == 0:
+                # first move:
+                DataLayer._createNewGame(connection, user, bytes)
+            return
+        row = connection.execute("INSERT INTO moves (game_id, move_id, source, target, promotion) " + \
+            "SELECT id, " + DataLayer.NEXT_MOVE_ID + ", ?, ?, ? FROM active_games WHERE user = ? RETURNING game_id, move_id;", \
+            (move[0], move[1], move[2] if len(move) > 2 else None, user)).fetchone()
+        if row is None:
+            # no active game (yet) -> the board is the starting point of a new one:
+            DataLayer._createNewGame(connection, user, bytes)
+        elif row[1] % DataLayer.KEYFRAME_INTERVAL == 0:
+            connection.execute("INSERT INTO gamestate (game_id, move_id, board) VALUES (?, ?, ?);", (row[0], row[1], bytes))
+
+    def reverseMove(db: ConnectionPool, user: str) -> bytes:
+        """ returns the board (compact encoding) before the last move pair or None if reversing the move is not possible """
         # hint: one move of white and one move of black has to be reversed so offset is actually 2
-        gameId = db.execute("SELECT id FROM active_games WHERE user = '" + user + "';")
-        if not gameId:
-            return None
-        gameId = str(gameId[0]['id'])
-        maxMove = db.execute("SELECT MAX(move_id) FROM gamestate WHERE " + \
-                "game_id = " + gameId + ";")[0]['MAX(move_id)']
-        if not maxMove:
-            return None
-        response = db.execute("SELECT board FROM gamestate WHERE move_id = " + str(int(maxMove) - 2) + ";")
-        if response:
+        if DataLayer.cache is not None:
+            DataLayer.cache.invalidate(user)
+        with db.connection() as connection, connection:
+            row = connection.execute("SELECT id, " + DataLayer.NEXT_MOVE_ID + " - 3 FROM active_games WHERE user = ?;", (user,)).fetchone()
+            if not row or row[1] < 0:
+                return None
+            bytes = DataLayer._restore(connection, user, row[1])
+            if bytes is None:
+                return None
             # Delete other moves 
-            db.execute("DELETE FROM gamestate WHERE game_id = " + gameId + " AND move_id > " + str(int(maxMove) - 2) + ";")
-            return response[0]['board']
-        else:
-            return None
+            connection.execute("DELETE FROM moves WHERE game_id = ? AND move_id > ?;", (row[0], row[1]))
+            connection.execute("DELETE FROM gamestate WHERE game_id = ? AND move_id > ?;", (row[0], row[1]))
+        return bytes
         
-    def endGame(db: SQL, user: str, pgn: str, status: str) -> bool:
+    def endGame(db: ConnectionPool, user: str, pgn: str, status: str) -> bool:
         """ deletes all status entries and adds the game to the finished games """
-        gameId = db.execute("SELECT id FROM active_games WHERE user = '" + user + "';")
-        if not gameId:
-            return False
-        gameId = str(gameId[0]['id'])
-        # delete entries:
-        db.execute("DELETE FROM active_games WHERE id = " + gameId + ";")
-        db.execute("DELETE FROM gamestate WHERE game_id = " + gameId + ";")
-        # store in finished games:
-        db.execute("INSERT INTO finished_games (user, pgn, status, timestamp) VALUES ('" + user + "', '" + pgn + \
-            "', '" + status + "', '" + datetime.today().strftime('%Y-%m-%d %H:%M:%S') + "');")
+        if DataLayer.cache is not None:
+            DataLayer.cache.invalidate(user)
+        with db.connection() as connection, connection:
+            # delete entries:
+            connection.execute("DELETE FROM gamestate WHERE game_id IN (SELECT id FROM active_games WHERE user = ?);", (user,))
+            connection.execute("DELETE FROM moves WHERE game_id IN (SELECT id FROM active_games WHERE user = ?);", (user,))
+            if connection.execute("DELETE FROM active_games WHERE user = ?;", (user,)).rowcount == 0:
+                return False
+            # store in finished games:
+            connection.execute("INSERT INTO finished_games (user, pgn, status, timestamp) VALUES (?, ?, ?, ?);", \
+                (user, pgn, status, datetime.today().strftime('%Y-%m-%d %H:%M:%S')))
         return True
 
 
+# ###### Board Cache: #########
+class BoardCache:
+    """ in-process LRU cache of live Board objects per user in front of the data layer
+        - at most maxSize boards are kept (the least recently used one is evicted first)
+        - entries older than ttl seconds are treated as missing (and re-read from the data base)
+        the cache is write-through: whoever stores a new move in the data base puts the board here, too; whoever
+        changes the game in the data base in a different way (reverseMove, endGame) has to invalidate the entry
+    """
+
+    def __init__(self, maxSize: int = 256, ttl: float = 600, clock=time.monotonic) -> None:
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self._clock = clock
+        self._entries = OrderedDict()       # user -> (timestamp, board)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user: str) -> object:
+        """ returns the cached board of user or None """
+        with self._lock:
+            entry = self._entries.get(user)
+            if entry is None or self._clock() - entry[0] > self.ttl:
+                if entry is not None:
+                    del self._entries[user]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, user: str, board: object) -> None:
+        with self._lock:
+            self._entries[user] = (self._clock(), board)
+            self._entries.move_to_end(user)
+            while len(self._entries) > self.maxSize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user: str) -> None:
+        with self._lock:
+            self._entries.pop(user, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+# ###### Pending Moves: #########
+class PendingMoves:
+    """ the chupponnent's replies that are computed in the background (at most one per user), so that the request
+        with white's move can be answered right away; the front end waits for the reply via long polling
+    """
+
+    def __init__(self, executor: Executor) -> None:
+        self._executor = executor
+        self._futures = {}          # user -> Future of the running job
+        self._lock = threading.Lock()
+
+    def submit(self, user: str, function, *args) -> None:
+        """ runs function(*args) in the background as the pending job of user """
+        with self._lock:
+            self._futures[user] = self._executor.submit(function, *args)
+
+    def isPending(self, user: str) -> bool:
+        with self._lock:
+            future = self._futures.get(user)
+        return future is not None and not future.done()
+
+    def wait(self, user: str, timeout: float = None) -> bool:
+        """ waits up to timeout seconds (None: no limit) for the pending job of user, returns False if it is still running
+            hint: exceptions of the job are raised here (once) """
+        with self._lock:
+            future = self._futures.get(user)
+        if future is None:
+            return True
+        if not wait([future], timeout).done:
+            return False
+        with self._lock:
+            if self._futures.get(user) is future:
+                del self._futures[user]
+        future.result()
+        return True
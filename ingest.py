@@ -0,0 +1,31 @@
+# PGN ingestion: replays all games of a (large, multi-game) PGN file and reports the throughput
+# usage: 'python ingest.py games.pgn' from the root dir (see 'python ingest.py --help')
+
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from chupochess import TrainingHelper
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='chupochess PGN ingestion')
+    parser.add_argument('pgn', help='file with one or more PGN games')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='replay processes (1: no process pool)')
+    parser.add_argument('--fens', action='store_true', help='also build the FEN of every position')
+    parser.add_argument('--chunk', type=int, default=64, help='games per task of the process pool')
+    args = parser.parse_args()
+    executor = ProcessPoolExecutor(max_workers=args.workers) if args.workers > 1 else None
+    games = plies = skipped = 0
+    start = time.perf_counter()
+    with open(args.pgn, encoding='utf-8') as file:
+        for result in TrainingHelper.replayGames(TrainingHelper.readPgns(file), executor, args.fens, args.chunk):
+            if result is None:
+                skipped += 1
+                continue
+            games += 1
+            plies += len(result[0])
+    elapsed = time.perf_counter() - start
+    if executor is not None:
+        executor.shutdown()
+    print('games: %d (skipped: %d), plies: %d, time: %.2f s, games/s: %.0f, plies/s: %.0f' % (games, skipped, plies, elapsed, \
+        games / elapsed if elapsed > 0 else 0, plies / elapsed if elapsed > 0 else 0))
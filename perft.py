@@ -0,0 +1,82 @@
+# perft: counts the leaf nodes of the move generation tree up to a given depth to verify the move generator
+# (against well known node counts) and to measure its speed
+# usage: 'python perft.py --help' from the root dir
+# good read: https://www.chessprogramming.org/Perft_Results
+
+import argparse
+import time
+from typing import Dict, Tuple
+from chupochess import Board, Location
+
+# standard positions with their known node counts for depth 1..n (extended FEN: FEN + unmake counter)
+# hint: the chupochess engine only supports pawn promotion to a queen, so the depths are limited to the ones without
+#       any pawn promotion in the tree (with promotions, the counts of the engine are lower by design)
+PERFT_POSITIONS = [
+    ('startpos', 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1 0', [20, 400, 8902, 197281, 4865609]),
+    ('kiwipete', 'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1 0', [48, 2039, 97862]),
+    ('position3', '8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1 0', [14, 191, 2812, 43238, 674624]),
+    ('position4', 'r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1 0', [6]),
+    ('position6', 'r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10 0', [46, 2079, 89890]),
+]
+
+
+def perft(board: Board, depth: int) -> int:
+    """ returns the number of leaf nodes after depth plies (the board is unchanged afterwards) """
+    moves = board.getAllMoves(board.activeColor())
+    if depth <= 1:
+        # bulk counting: no need to make the moves of the last ply
+        return len(moves) if depth == 1 else 1
+    nodes = 0
+    for source, target in moves:
+        record = board._applyMove(source, target)
+        nodes += perft(board, depth - 1)
+        board.unmakeMove(record)
+    return nodes
+
+
+def divide(board: Board, depth: int) -> Dict[Tuple[int, int], int]:
+    """ returns the perft node count per root move (for tracking down move generation bugs) """
+    result = {}
+    for source, target in board.getAllMoves(board.activeColor()):
+        record = board._applyMove(source, target)
+        result[(source, target)] = perft(board, depth - 1)
+        board.unmakeMove(record)
+    return result
+
+
+def runSuite(maxDepth: int = 3) -> bool:
+    """ runs all standard positions up to maxDepth and prints node counts, timing and nodes per second """
+    success = True
+    print('%-10s %5s %10s %10s %8s %10s' % ('position', 'depth', 'nodes', 'expected', 'time [s]', 'nodes/s'))
+    for name, ext_fen, expected in PERFT_POSITIONS:
+        board = Board.fromString(ext_fen)
+        for depth in range(1, min(maxDepth, len(expected)) + 1):
+            start = time.perf_counter()
+            nodes = perft(board, depth)
+            elapsed = time.perf_counter() - start
+            ok = nodes == expected[depth - 1]
+            success = success and ok
+            print('%-10s %5d %10d %10d %8.2f %10.0f %s' % (name, depth, nodes, expected[depth - 1], elapsed, \
+                nodes / elapsed if elapsed > 0 else 0, '' if ok else 'MISMATCH'))
+    return success
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='chupochess perft')
+    parser.add_argument('--fen', help='extended FEN of the position (default: run the standard suite)')
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--divide', action='store_true', help='print the node count per root move')
+    args = parser.parse_args()
+    if args.fen is None:
+        exit(0 if runSuite(args.depth) else 1)
+    board = Board.fromString(args.fen)
+    start = time.perf_counter()
+    if args.divide:
+        result = divide(board, args.depth)
+        for (source, target), nodes in sorted(result.items()):
+            print(Location.absoluteSqToAlgebraicSq(source) + Location.absoluteSqToAlgebraicSq(target) + ': ' + str(nodes))
+        nodes = sum(result.values())
+    else:
+        nodes = perft(board, args.depth)
+    elapsed = time.perf_counter() - start
+    print('nodes: %d, time: %.2f s, nodes/s: %.0f' % (nodes, elapsed, nodes / elapsed if elapsed > 0 else 0))
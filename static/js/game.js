@@ -1,5 +1,7 @@
 var selected;           // save selected square 
 var NULL_LOC = 255;     // no selection
+var opponentPending = false;    // the chupponnent's move is being computed -> clicks on the board are ignored
+var RETRY_DELAY = 2000;         // milliseconds until a failed request is followed by a new board request
         
 // responsive chess board:
 $(window).on( 'load resize', function(){
@@ -21,6 +23,10 @@ $(document).ready(function() {
 
 // monitor user's clicks on the board
 $( 'td' ).click(function(event) {
+    if (opponentPending){
+        // wait for the chupponnent's move
+        return;
+    }
     if (selected == NULL_LOC){
         // request valid moves for selected square and marks them on the board
         selected = event.target.id;
@@ -109,6 +115,15 @@ function requestHandler(endpoint, src, tar){
     }, 
     function(data, status){
         responseHandler(endpoint, src, tar, data, status);
+    })
+    .fail(function(){
+        // e.g. a server error or a timed out long poll: unlock the board and ask for the current state again
+        // (if the chupponnent is still thinking, the response says so and the long poll starts over)
+        opponentPending = false;
+        selected = NULL_LOC;
+        setTimeout(function(){
+            requestHandler("/getBoard", NULL_LOC, NULL_LOC);
+        }, RETRY_DELAY);
     });
 }
 
@@ -197,4 +212,10 @@ function responseHandler(endpoint, source, target, data, status){
     // TODO 
     // showEOG(data.action, status)  
 
+    // 6) wait for the chupponnent's move (long poll, the BE answers as soon as the move is made):
+    opponentPending = data.opponentPending;
+    if (opponentPending){
+        requestHandler("/awaitOpponent", NULL_LOC, NULL_LOC);
+    }
+
 }
\ No newline at end of file
@@ -0,0 +1,14 @@
+# endgame tablebase: solves KQK, KRK and KPK (see chupochess.Tablebase) and writes the tablebase file
+# usage: 'python tablebase.py' from the root dir (see 'python tablebase.py --help'), the app picks up 'tablebase.bin' at startup
+
+import argparse
+import time
+from chupochess import Tablebase
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='chupochess endgame tablebase builder')
+    parser.add_argument('--output', default='tablebase.bin')
+    args = parser.parse_args()
+    start = time.perf_counter()
+    Tablebase.build(args.output)
+    print('%s tables, %.1f s -> %s' % (', '.join('K' + piece + 'K' for piece in Tablebase.TABLES), time.perf_counter() - start, args.output))
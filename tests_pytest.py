@@ -2,8 +2,14 @@
 # good read: https://realpython.com/pytest-python-testing/
 
 import pytest
-from chupochess import Board, Location, PieceColor, TrainingHelper, GameState
-from helpers import DataLayer as dl
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import io
+import os
+import sqlite3
+import threading
+from chupochess import Board, Location, PieceColor, TrainingHelper, GameState, Bitboard, Chupponnent, TranspositionTable, Evaluator, OpeningBook, Tablebase, TrainingExporter
+from helpers import DataLayer as dl, BoardCache, ConnectionPool, PendingMoves, MIGRATIONS
+from perft import perft, divide
 import chupochess_pb2
 
 #### Fixtures #####
@@ -131,7 +137,7 @@ def test_locationsOnFile(file, expected_locations):
     ('1B6/P4kP1/4N3/8/2p5/8/1PP1P1PP/2KR1B1R w - - 1 44 0', 8, 0, 'QB6/5kP1/4N3/8/2p5/8/1PP1P1PP/2KR1B1R b - - 0 44 0'),
     ('rn3bnr/1bppPkpp/pp3p2/6B1/3P4/8/PPP3PP/RN1QKBNR w KQ - 1 13 0', 12, 5, 'rn3Qnr/1bpp1kpp/pp3p2/6B1/3P4/8/PPP3PP/RN1QKBNR b KQ - 0 13 0'),
     ('8/6Q1/2N5/5p2/3P1k2/8/PpP1Q1pP/R3KBNR b KQ - 1 31 0', 49, 57, '8/6Q1/2N5/5p2/3P1k2/8/P1P1Q1pP/Rq2KBNR w KQ - 0 32 0'),
-    ('8/6Q1/8/5p2/1N1P1k2/8/P1P1Q1pP/Rq2KBNR b KQ - 0 31 0', 54, 63, '8/6Q1/8/5p2/1N1P1k2/8/P1P1Q2P/Rq2KBNq w KQ - 0 32 0'),
+    ('8/6Q1/8/5p2/1N1P1k2/8/P1P1Q1pP/Rq2KBNR b KQ - 0 31 0', 54, 63, '8/6Q1/8/5p2/1N1P1k2/8/P1P1Q2P/Rq2KBNq w Q - 0 32 0'),
 ])
 def test_pawn_promotion(ext_fen, source, target, expected_ext_fen):
     # parametrize includes: 0) and 1): white pawn promotion w/o capture; 2): white pawn promotion with capture;
@@ -161,6 +167,634 @@ def test_locationUnderAttack():
     king = board.squares[3].currentPiece
     assert king._locationUnderAttack(board, 4) == [0]
 
+def test_bitboards_in_sync():
+    board = Board.fromString('r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1 0')
+    for source, target, chupponnentMove in [(60, 58, False), (10, 26, True), (27, 18, False), (4, 6, True)]:
+        board.makeMove(source, target, chupponnentMove)
+    for loc in range(64):
+        piece = board.squares[loc].currentPiece
+        for identifier, bitboard in board.bitboards.items():
+            assert bool(bitboard & (1 << loc)) == (piece is not None and piece.identifier == identifier)
+    assert board.occupied() == Bitboard.fromLocations([loc for loc in range(64) if board.squares[loc].isOccupied])
+
+@pytest.mark.parametrize("loc1, loc2, expected_locations", [
+    (60, 4, [12, 20, 28, 36, 44, 52]),
+    (0, 63, [9, 18, 27, 36, 45, 54]),
+    (56, 59, [57, 58]),
+    (60, 45, []),
+    (60, 61, []),
+])
+def test_locationsOnPath(loc1, loc2, expected_locations):
+    assert Location.getLocationsOnPath(loc1, loc2) == expected_locations
+    assert Location.getLocationsOnPath(loc2, loc1) == expected_locations
+
+def test_locationsFromOffsets():
+    assert Location.getLocationsFromOffsets(0, [(1, 0), (-1, 0), (0, 1), (0, -1), (2, -1)]) == [1, 8, 10]
+    assert Location.getTupleOffset(36, 7) == (-3, -4)
+    assert Location.nominalizeTuple((-3, 0)) == (-1, 0)
+
+def test_castling_both_sides():
+    board = Board.fromString('r3k2r/8/8/8/8/8/8/R3K2R w KQkq - 0 1 0')
+    assert 58 in board.getMoves(60)
+    assert 62 in board.getMoves(60)
+
+def test_castling_rook_captured_on_corner():
+    board = Board.fromString('4k3/8/8/8/4b3/8/7R/4K2R b K - 0 1 0')
+    # Bxh1, Rh2-h1, Kd8: the rook on h1 is not the original one anymore
+    for source, target in [(36, 63), (55, 63), (4, 3)]:
+        assert board.makeMove(source, target, True)
+    assert str(board) == '3k4/8/8/8/8/8/8/4K2R w - - 1 3 0'
+    assert 62 not in board.getMoves(60)
+
+@pytest.mark.parametrize("ext_fen", [
+    'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1 0',
+    'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1 0',
+    'rnbqkbnr/1pppp1pp/p7/4Pp2/8/8/PPPP1PPP/RNBQKBNR w KQkq f6 0 3 0',
+    '8/6Q1/2N5/5p2/3P1k2/8/PpP1Q1pP/R3KBNR b KQ - 1 31 0',
+])
+def test_make_unmake_roundtrip(ext_fen):
+    board = Board.fromString(ext_fen)
+    color = PieceColor.WHITE if board.fen.activeColor == 'w' else PieceColor.BLACK
+    pieces = {key: list(value) for key, value in board.pieces.items()}
+    bitboards = dict(board.bitboards)
+    material = dict(board.material)
+    stat = board.stat
+    for source, target in board.getAllMoves(color):
+        record = board.makeMove(source, target, True)
+        assert record
+        board.unmakeMove(record)
+        assert str(board) == ext_fen
+        assert board.bitboards == bitboards
+        assert board.pieces == pieces
+        assert board.material == material
+        assert board.stat == stat
+        assert board.gameState == GameState.IDLE
+
+def test_makeMove_invalid():
+    board = Board.startingPosition()
+    assert board.makeMove(52, 28) is None
+    assert str(board) == 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1 0'
+
+@pytest.mark.parametrize("ext_fen, expected_move", [
+    ('4k3/8/8/8/8/8/3q4/4K2R w - - 0 1 0', (60, 51)),                # capture the hanging queen
+    ('6k1/5ppp/8/8/8/8/5PPP/3R2K1 w - - 0 1 0', (59, 3)),            # back rank mate
+])
+def test_chupponnent_smartMove(ext_fen, expected_move):
+    board = Board.fromString(ext_fen)
+    assert Chupponnent(maxDepth=3).generateSmartMove(board) == expected_move
+    # the search must leave the board untouched:
+    assert str(board) == ext_fen
+
+@pytest.mark.parametrize("ext_fen, expected_state", [
+    ('Q7/8/8/5K1k/8/8/8/8 w - - 0 1 0', GameState.WHITE_WINS),
+    ('4r3/8/7k/7b/6n1/2q5/8/3K4 b - - 0 1 0', GameState.BLACK_WINS),
+])
+def test_chupponnent_findsMate(ext_fen, expected_state):
+    board = Board.fromString(ext_fen)
+    move = Chupponnent(maxDepth=2).generateSmartMove(board)
+    board.makeMove(move[0], move[1], True)
+    assert board.gameState == expected_state
+
+def test_chupponnent_nodeLimit():
+    board = Board.fromString('r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R b KQkq - 0 1 0')
+    chupponnent = Chupponnent(maxDepth=10, timeLimit=60, nodeLimit=500)
+    move = chupponnent.generateSmartMove(board)
+    assert move in board.getAllMoves(PieceColor.BLACK)
+    assert chupponnent.nodes <= 500
+    assert str(board) == 'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R b KQkq - 0 1 0'
+
+def test_zobrist_incremental():
+    board = Board.fromString('r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1 0')
+    initialKey = board.zobristKey
+    records = []
+    # castling, double pawn step (en passant target), en passant capture, castling, capture (with check), king move:
+    for source, target in [(60, 62), (10, 26), (27, 18), (4, 2), (52, 16), (2, 1)]:
+        records.append(board.makeMove(source, target, True))
+        assert board.zobristKey == board._computeZobristKey()
+    for record in reversed(records):
+        board.unmakeMove(record)
+    assert board.zobristKey == initialKey
+    # capture of a rook on its corner (removes the castling right):
+    board = Board.fromString('4k3/8/8/8/4b3/8/7R/4K2R b K - 0 1 0')
+    initialKey = board.zobristKey
+    record = board.makeMove(36, 63, True)
+    assert board.fen.castlingAvailability == '-'
+    assert board.zobristKey == board._computeZobristKey()
+    assert board.zobristKey == Board.fromString(str(board)).zobristKey
+    board.unmakeMove(record)
+    assert board.zobristKey == initialKey
+
+def test_zobrist_transposition():
+    board1 = Board.startingPosition()
+    board2 = Board.startingPosition()
+    for source, target in [(62, 45), (1, 18), (57, 42)]:
+        board1.makeMove(source, target, True)
+    for source, target in [(57, 42), (1, 18), (62, 45)]:
+        board2.makeMove(source, target, True)
+    assert board1.zobristKey == board2.zobristKey
+    assert board1.zobristKey != Board.startingPosition().zobristKey
+
+def test_transpositionTable_replacement():
+    table = TranspositionTable(bits=2)
+    table.store(1, 5, 10, TranspositionTable.EXACT, (0, 1))
+    # same bucket, shallower -> goes to the always-replace slot:
+    table.store(5, 2, 20, TranspositionTable.EXACT, (0, 2))
+    assert table.probe(1)[1] == 5
+    assert table.probe(5)[1] == 2
+    # deeper result takes over the depth-preferred slot:
+    table.store(9, 6, 30, TranspositionTable.LOWER_BOUND, (0, 3))
+    assert table.probe(9)[2] == 30
+    assert table.probe(1) is None
+    assert table.probe(2) is None
+    stats = table.stats()
+    assert stats['probes'] == 5 and stats['hits'] == 3 and stats['overwrites'] == 1
+
+def test_fen_lazy_piecePlacement():
+    board = Board.startingPosition()
+    record = board.makeMove(52, 36)
+    # nothing is built until the FEN is actually requested:
+    assert board.fen._piecePlacement is None
+    assert board.fen.piecePlacement == 'rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR'
+    assert board.fen._piecePlacement == 'rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR'
+    board.unmakeMove(record)
+    assert str(board) == 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1 0'
+
+@pytest.mark.parametrize("ext_fen", [
+    'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1 0',
+    'rnbqkbnr/1pppp1pp/p7/4Pp2/8/8/PPPP1PPP/RNBQKBNR w Kq f6 0 3 7',
+    '8/5k2/R4P2/8/8/p2r3p/8/6K1 b - - 1 68 2',
+])
+def test_compact_encoding(ext_fen):
+    board = Board.fromString(ext_fen)
+    blob = board.toBytes()
+    assert len(blob) == 48
+    decoded = Board.fromBytes(blob)
+    assert str(decoded) == ext_fen
+    assert decoded.stat == board.stat
+    assert decoded.kingLocation == board.kingLocation
+    assert decoded.zobristKey == board.zobristKey
+
+def test_legacy_protobuf_readable():
+    board = Board.fromString('r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1 0')
+    decoded = Board.fromBytes(board.toProto().SerializeToString())
+    assert str(decoded) == str(board)
+    assert decoded.bitboards == board.bitboards
+
+def test_legacy_protobuf_play():
+    # squares and piece lists share the pieces -> moved pieces can be captured afterwards
+    board = Board.fromBytes(Board.startingPosition().toProto().SerializeToString())
+    for source, target in [(52, 36), (11, 27), (36, 27), (3, 27)]:
+        assert board.makeMove(source, target, True) is not None
+    assert str(board) == 'rnb1kbnr/ppp1pppp/8/3q4/8/8/PPPP1PPP/RNBQKBNR w KQkq - 0 3 0'
+    assert board.material['P'] == 7 and board.material['p'] == 7
+    assert sorted(piece.location for piece in board.pieces[PieceColor.BLACK]) == [0, 1, 2, 4, 5, 6, 7, 8, 9, 10, 12, 13, 14, 15, 27]
+
+def test_boardCache_lru():
+    cache = BoardCache(maxSize=2)
+    boards = [Board.startingPosition() for _ in range(3)]
+    cache.put('a', boards[0])
+    cache.put('b', boards[1])
+    assert cache.get('a') is boards[0]      # 'a' is now the most recently used entry
+    cache.put('c', boards[2])
+    assert cache.get('b') is None
+    assert cache.get('a') is boards[0]
+    assert cache.get('c') is boards[2]
+    cache.invalidate('a')
+    assert cache.get('a') is None
+    assert len(cache) == 1
+
+def test_boardCache_ttl():
+    now = [0]
+    cache = BoardCache(ttl=10, clock=lambda: now[0])
+    board = Board.startingPosition()
+    cache.put('a', board)
+    now[0] = 10
+    assert cache.get('a') is board
+    now[0] = 11
+    assert cache.get('a') is None
+    assert cache.hits == 1 and cache.misses == 1
+
+def test_legalMoves_cache():
+    board = Board.startingPosition()
+    moves = board.getMoves(52)
+    assert board.getMoves(52) is moves
+    record = board.makeMove(52, 36)
+    # black's turn now -> new cache, white's lists are computed without caching:
+    assert board.getMoves(12, True) == [20, 28]
+    assert board.getMoves(51) == [43, 35]
+    board.unmakeMove(record)
+    assert board.getMoves(52) is moves
+    assert len(board.getAllMoves(PieceColor.WHITE)) == 20
+
+@pytest.mark.parametrize('ext_fen, depth, expected_nodes', [
+    ('rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1 0', 3, 8902),
+    ('r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1 0', 2, 2039),
+    ('8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1 0', 3, 2812),
+    ('r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10 0', 2, 2079)
+])
+def test_perft(ext_fen, depth, expected_nodes):
+    board = Board.fromString(ext_fen)
+    assert perft(board, depth) == expected_nodes
+    # board unchanged:
+    assert str(board) == ext_fen
+
+def test_perft_divide():
+    board = Board.startingPosition()
+    result = divide(board, 2)
+    assert len(result) == 20 and sum(result.values()) == 400
+    assert result[(52, 36)] == 20
+
+@pytest.mark.parametrize('ext_fen', [
+    'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1 0',
+    '8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1 0',
+    'r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1 0'
+])
+def test_legalityContext_matches_reference(ext_fen):
+    # differential test: the shared checks/pins have to filter exactly like the per-piece reference implementation
+    # (all 64 locations as candidates, for both colors, in the position and all positions one move later)
+    def compare(board):
+        for color in (PieceColor.WHITE, PieceColor.BLACK):
+            for piece in board.pieces[color]:
+                if piece.identifier.upper() != 'K':
+                    candidates = list(range(64))
+                    assert piece._getGlobalValidMoves(candidates, board) == piece._getGlobalValidMovesReference(candidates, board)
+    board = Board.fromString(ext_fen)
+    compare(board)
+    for source, target in board.getAllMoves(board.activeColor()):
+        record = board._applyMove(source, target)
+        compare(board)
+        board.unmakeMove(record)
+
+def test_material_counts():
+    board = Board.fromString('8/6Q1/2N5/5p2/3P1k2/8/PpP1Q1pP/R3KBNR b KQ - 1 31 0')
+    assert board.material['P'] == 4 and board.material['p'] == 3 and board.material['q'] == 0
+    # capture with promotion:
+    board.makeMove(49, 56, True)
+    assert board.material['p'] == 2 and board.material['q'] == 1 and board.material['R'] == 1
+    for identifier in 'PNBRQKpnbrqk':
+        assert board.material[identifier] == bin(board.bitboards[identifier]).count('1')
+
+@pytest.mark.parametrize("ext_fen, color, expected_result", [
+    ('rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1 0', PieceColor.WHITE, True),
+    ('7k/5Q2/6K1/8/8/8/8/8 b - - 0 1 0', PieceColor.BLACK, False),
+    ('7k/6Q1/6K1/8/8/8/8/8 b - - 0 1 0', PieceColor.BLACK, False),
+    ('7k/6Q1/8/8/8/8/8/K7 b - - 0 1 0', PieceColor.BLACK, True)
+])
+def test_hasAnyLegalMove(ext_fen, color, expected_result):
+    board = Board.fromString(ext_fen)
+    assert board.hasAnyLegalMove(color) == expected_result
+    assert board.hasAnyLegalMove(color) == (len(board.getAllMoves(color)) > 0)
+
+def test_repetition_detection():
+    board = Board.startingPosition()
+    # knights out and back: the starting position occurs again after every 4 plies
+    shuffle = [(62, 45), (6, 21), (45, 62), (21, 6)]
+    for repetition in range(2, 6):
+        for source, target in shuffle:
+            assert board.makeMove(source, target, True)
+        assert board.repetitionCount() == repetition
+        if repetition == 3:
+            assert board.opponent.acceptsDraw(board)
+    # fivefold repetition -> draw
+    assert board.gameState == GameState.DRAW
+    # irreversible move resets the history:
+    board = Board.startingPosition()
+    for source, target in shuffle:
+        board.makeMove(source, target, True)
+    record = board.makeMove(52, 36)
+    assert board.history == [] and board.repetitionCount() == 1
+    board.unmakeMove(record)
+    assert len(board.history) == 4 and board.repetitionCount() == 2
+
+def test_compact_encoding_history():
+    board = Board.startingPosition()
+    for source, target in [(62, 45), (6, 21), (45, 62), (21, 6)]:
+        board.makeMove(source, target, True)
+    blob = board.toBytes()
+    assert len(blob) == 48 + 4 * 8
+    decoded = Board.fromBytes(blob)
+    assert decoded.history == board.history
+    assert decoded.repetitionCount() == 2
+
+def test_positional_incremental():
+    board = Board.fromString('8/6Q1/2N5/5p2/3P1k2/8/PpP1Q1pP/R3KBNR b KQ - 1 31 0')
+    assert Board.startingPosition().positional == 0
+    for source, target in board.getAllMoves(PieceColor.BLACK):
+        positional = board.positional
+        record = board._applyMove(source, target)
+        assert board.positional == board._computePositional()
+        board.unmakeMove(record)
+        assert board.positional == positional
+
+def test_evaluator():
+    board = Board.startingPosition()
+    assert Evaluator().evaluate(board) == 0
+    board.makeMove(52, 36)
+    # e4: better piece-square score and more room for bishop and queen:
+    assert Evaluator(material=0, mobility=0, kingSafety=0).evaluate(board) == 40
+    assert Evaluator().mobility(board) == 10
+    assert Evaluator().kingSafety(board) == -1
+    # material only:
+    board = Board.fromString('4k3/8/8/8/8/8/3q4/4K2R w - - 0 1 0')
+    assert Evaluator(material=1, positional=0, mobility=0, kingSafety=0).evaluate(board) == -4
+    assert Chupponnent(maxDepth=2, evaluator=Evaluator(positional=0, mobility=0, kingSafety=0)).generateSmartMove(board) == (60, 51)
+
+@pytest.mark.parametrize('ext_fen', [
+    'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1 0',
+    'r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1 0',
+    'rnbqkbnr/1pppp1pp/p7/4Pp2/8/8/PPPP1PPP/RNBQKBNR w Kq f6 0 3 7',
+    '8/6Q1/2N5/5p2/3P1k2/8/PpP1Q1pP/R3KBNR b KQ - 1 31 0'
+])
+def test_getAllCaptures(ext_fen):
+    board = Board.fromString(ext_fen)
+    for color in (PieceColor.WHITE, PieceColor.BLACK):
+        expected = [(source, target) for source, target in board.getAllMoves(color) \
+            if board.squares[target].isOccupied or \
+            (board.squares[source].currentPiece.identifier.upper() == 'P' and (target <= 7 or target >= 56 or abs(target - source) in (7, 9)))]
+        assert sorted(board.getAllCaptures(color)) == sorted(expected)
+
+@pytest.mark.parametrize('ext_fen, source, target, expected_score', [
+    ('1k1r4/1pp4p/p7/4p3/8/P5P1/1PP4P/2K1R3 w - - 0 1 0', 'e1', 'e5', 1),
+    ('1k1r3q/1ppn3p/p4b2/4p3/8/P2N2P1/1PP1R1BP/2K1Q3 w - - 0 1 0', 'd3', 'e5', -2),
+    ('4k3/8/2p5/3p4/4P3/8/8/4K3 w - - 0 1 0', 'e4', 'd5', 0),
+    ('k7/8/2p5/3p4/4Q3/8/8/4K3 w - - 0 1 0', 'e4', 'd5', -8),
+    ('4k3/8/2p5/3r4/4P3/8/8/4K3 w - - 0 1 0', 'e4', 'd5', 4)
+])
+def test_staticExchange(ext_fen, source, target, expected_score):
+    board = Board.fromString(ext_fen)
+    score = Chupponnent()._staticExchange(board, Location.algebraicSqToAbsoluteSq(source), Location.algebraicSqToAbsoluteSq(target))
+    assert score == expected_score
+
+def test_chupponnent_quiescence():
+    # a 1-ply search without quiescence would grab the protected pawn with the queen:
+    ext_fen = 'k7/8/2p5/3p4/4Q3/8/8/4K3 w - - 0 1 0'
+    board = Board.fromString(ext_fen)
+    assert Chupponnent(maxDepth=1).generateSmartMove(board) != (36, 27)
+    assert str(board) == ext_fen
+
+def test_chupponnent_parallel():
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        for ext_fen, expected_move in [('4k3/8/8/8/8/8/3q4/4K2R w - - 0 1 0', (60, 51)), ('6k1/5ppp/8/8/8/8/5PPP/3R2K1 w - - 0 1 0', (59, 3))]:
+            board = Board.fromString(ext_fen)
+            assert Chupponnent(maxDepth=3, timeLimit=10).generateParallelMove(board, executor) == expected_move
+            assert str(board) == ext_fen
+        # deterministic merge: a complete search always returns the same move
+        board = Board.fromString('r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R b KQkq - 0 1 0')
+        move = Chupponnent(maxDepth=2, timeLimit=60, nodeLimit=10**6).generateParallelMove(board, executor)
+        assert move == Chupponnent(maxDepth=2, timeLimit=60, nodeLimit=10**6).generateParallelMove(board, executor)
+        assert move in board.getAllMoves(PieceColor.BLACK)
+        # the tasks score with the chupponnent's evaluator (here: one that gives away material), not the default one:
+        board = Board.fromString('4k3/8/8/8/8/8/3q4/4K2R w - - 0 1 0')
+        evaluator = Evaluator(material=-100, positional=0, mobility=0, kingSafety=0)
+        move = Chupponnent(maxDepth=2, timeLimit=60, nodeLimit=10**6, evaluator=evaluator).generateParallelMove(board, executor)
+        assert move == Chupponnent(maxDepth=2, timeLimit=60, nodeLimit=10**6, evaluator=evaluator).generateSmartMove(board) != (60, 51)
+
+def test_pendingMoves():
+    release = threading.Event()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        pending = PendingMoves(executor)
+        assert not pending.isPending('a') and pending.wait('a', 0)
+        pending.submit('a', release.wait)
+        assert pending.isPending('a')
+        # long poll runs into the timeout:
+        assert not pending.wait('a', 0.01)
+        release.set()
+        assert pending.wait('a', 5)
+        assert not pending.isPending('a')
+        # exceptions of the job are raised when waiting:
+        pending.submit('b', lambda: 1 / 0)
+        with pytest.raises(ZeroDivisionError):
+            pending.wait('b')
+        assert pending.wait('b')
+
+def test_openingBook(tmp_path):
+    pgns = ['1.e4 c5 2.Nf3 d6 1-0', '1.e4 e5 2.Nf3 Nc6 3.Bb5 1/2-1/2', '1.e4 Ke7 2.Ke3 *', '1.d4 d5 2.c4 0-1']
+    path = str(tmp_path / 'book.bin')
+    # the third game has an illegal move -> skipped
+    assert OpeningBook.build(pgns, path, maxPlies=3) == (8, 1)
+    book = OpeningBook(path)
+    board = Board.startingPosition()
+    assert sorted(book.probe(board.zobristKey)) == [((51, 35), 1), ((52, 36), 2)]
+    assert book.getMove(board) == (52, 36)
+    board.makeMove(52, 36)
+    assert sorted(book.probe(board.zobristKey)) == [((10, 26), 1), ((12, 28), 1)]
+    # out of book:
+    board.makeMove(8, 16, True)
+    assert book.probe(board.zobristKey) == [] and book.getMove(board) is None
+    # the chupponnent plays book moves:
+    Chupponnent.book = book
+    try:
+        assert Chupponnent(maxDepth=1).generateMove(Board.startingPosition()) == (52, 36)
+    finally:
+        Chupponnent.book = None
+        book.close()
+
+def test_tablebase(tmp_path):
+    # only KRK is solved (the whole tablebase takes too long for the unit tests, see test_tablebase_build):
+    path = str(tmp_path / 'tablebase.bin')
+    table = Tablebase.TABLES.index('R')
+    with open(path, 'wb') as file:
+        file.write(Tablebase.HEADER.pack(Tablebase.MAGIC, Tablebase.VERSION))
+        for i in range(len(Tablebase.TABLES)):
+            file.write(Tablebase._solve('R') if i == table else bytes(2 * Tablebase.SIZE))
+    tablebase = Tablebase(path)
+    try:
+        # longest mate (in plies + 1) of KRK:
+        offset = Tablebase.HEADER.size + table * 2 * Tablebase.SIZE
+        assert max(v for v in tablebase._map[offset:offset + 2 * Tablebase.SIZE] if v != Tablebase.STALEMATE) == 33
+        assert tablebase.probe(Board.fromString('k1R5/8/1K6/8/8/8/8/8 b - - 0 1 0')) == Tablebase.MATE
+        assert tablebase.probe(Board.fromString('K1r5/8/1k6/8/8/8/8/8 w - - 0 1 0')) == Tablebase.MATE
+        assert tablebase.probe(Board.fromString('k7/1R6/2K5/8/8/8/8/8 b - - 0 1 0')) == Tablebase.STALEMATE
+        assert tablebase.probe(Board.fromString('k7/8/8/8/8/8/N7/K7 w - - 0 1 0')) is None
+        board = Board.fromString('k7/8/1K6/8/8/8/8/2R5 w - - 0 1 0')
+        assert tablebase.probe(board) == Tablebase.MATE + 1
+        assert tablebase.score(board, 0) == Chupponnent.MATE_SCORE - 1
+        Chupponnent.tablebase = tablebase
+        try:
+            move = Chupponnent(maxDepth=2).generateMove(board)
+            assert move in [(58, 2), (58, 56)]
+            board.makeMove(*move)
+            assert board.gameState == GameState.WHITE_WINS
+        finally:
+            Chupponnent.tablebase = None
+    finally:
+        tablebase.close()
+
+@pytest.mark.skipif(not os.environ.get('SLOW_TESTS'), reason='builds the whole tablebase (set SLOW_TESTS=1)')
+def test_tablebase_build(tmp_path):
+    path = str(tmp_path / 'tablebase.bin')
+    Tablebase.build(path)
+    tablebase = Tablebase(path)
+    try:
+        # longest mates (in plies + 1) of KQK, KRK and KPK:
+        offset = Tablebase.HEADER.size
+        assert [max(v for v in tablebase._map[offset + i * 2 * Tablebase.SIZE:offset + (i + 1) * 2 * Tablebase.SIZE] \
+            if v != Tablebase.STALEMATE) for i in range(3)] == [21, 33, 57]
+        assert tablebase.probe(Board.fromString('k7/1Q6/1K6/8/8/8/8/8 b - - 0 1 0')) == Tablebase.MATE
+        assert tablebase.probe(Board.fromString('K7/1q6/1k6/8/8/8/8/8 w - - 0 1 0')) == Tablebase.MATE
+        assert tablebase.probe(Board.fromString('k7/2Q5/1K6/8/8/8/8/8 b - - 0 1 0')) == Tablebase.STALEMATE
+        assert tablebase.probe(Board.fromString('k7/8/8/8/8/8/P7/K7 w - - 0 1 0')) == Tablebase.DRAW
+        assert tablebase.probe(Board.fromString('k7/8/1K6/8/8/8/8/2Q5 w - - 0 1 0')) == Tablebase.MATE + 1
+    finally:
+        tablebase.close()
+
+def test_TrainingHelper_readPgns():
+    file = io.StringIO('[Event "A"]\n[Result "1-0"]\n\n1. e4 e5 2. Qh5 Nc6 3. Bc4 Nf6 4. Qxf7# 1-0\n\n' \
+        '[Event "B"]\n\n1. d4 {comment} d5 (1... Nf6 2. c4) 2. c4 $1 dxc4 *\n\n[Event "C"]\n\n1. e4 Ke7 2. Ke3 *\n')
+    pgns = list(TrainingHelper.readPgns(file))
+    assert len(pgns) == 3 and pgns[1].startswith('[Event "B"]')
+    assert TrainingHelper.sanMoves(pgns[0]) == ['e4', 'e5', 'Qh5', 'Nc6', 'Bc4', 'Nf6', 'Qxf7#']
+    assert TrainingHelper.sanMoves(pgns[1]) == ['d4', 'd5', 'c4', 'dxc4']
+    assert TrainingHelper.sanMoves('1. e4 (1. d4 d5 (1... Nf6 {a (comment)})) e5 2. Nf3 (2. f4 (2. Nc3) exf4) Nc6') == ['e4', 'e5', 'Nf3', 'Nc6']
+    moves, fens = TrainingHelper.replay(pgns[0])
+    assert moves[:2] == [(52, 36), (12, 28)] and moves[-1] == (31, 13) and fens == []
+    moves, fens = TrainingHelper.replay(pgns[1], True)
+    assert len(fens) == len(moves) + 1 and fens[-1] == 'rnbqkbnr/ppp1pppp/8/8/2pP4/8/PP2PPPP/RNBQKBNR w KQkq - 0 3'
+    # the last game has an illegal move:
+    with pytest.raises(Exception):
+        TrainingHelper.replay(pgns[2])
+    expected = [TrainingHelper.replay(pgns[0]), TrainingHelper.replay(pgns[1]), None] * 5
+    assert list(TrainingHelper.replayGames(pgns * 5)) == expected
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        assert list(TrainingHelper.replayGames(iter(pgns * 5), executor, chunkSize=2, readAhead=2)) == expected
+
+def test_trainingExporter(tmp_path):
+    np = pytest.importorskip('numpy')
+    pgn = '1.e4 d5 2.exd5 Qxd5 3.Nc3 Qa5 4.O-O-O'     # the last move is invalid -> ignored by mapGames
+    assert list(TrainingHelper.mapGames(TrainingHelper.gamePositions, [pgn])) == [None]
+    positions = TrainingHelper.gamePositions(pgn.replace(' 4.O-O-O', ''))
+    fens = TrainingHelper.pgnToFen(pgn.replace(' 4.O-O-O', ''))
+    assert positions == [TrainingHelper.fenToPosition(fen) for fen in fens]
+    assert TrainingHelper.fenToPosition(fens[1])[12:] == (0, 15, 44)
+    exporter = TrainingExporter(str(tmp_path), chunkSize=4)
+    exporter.extend(positions)
+    exporter.close()
+    arrays = TrainingExporter.load(str(tmp_path))
+    assert exporter.count == len(positions) == 7
+    assert arrays['planes'].shape == (7, 96) and arrays['material'].dtype == np.int16
+    assert list(arrays['material']) == [TrainingHelper.fenToStat(fen) for fen in fens]
+    assert list(arrays['side']) == [1, 0, 1, 0, 1, 0, 1] and arrays['enPassant'][1] == 44
+    squares = np.unpackbits(arrays['planes'], axis=1, bitorder='little').reshape(-1, 12, 64)
+    assert squares[0, 0].sum() == 8 and squares[0, 0, 48:56].all()     # white pawns on the 2nd rank
+    assert squares[-1, 10, 24] == 1                                     # black queen on a5
+
+def blob(i: int) -> bytes:
+    """ distinct serialized boards for the data layer tests (they only differ in the unmake counter) """
+    return Board.fromString('rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1 ' + str(i)).toBytes()
+
+def test_dataLayer(tmp_path):
+    db = ConnectionPool(str(tmp_path / 'test.db'), size=2)
+    dl.migrate(db)
+    user, other = "1.2.3.4", "x' OR '1'='1"        # the user is a parameter, not part of the SQL
+    assert dl.getBytes(db, user) is None and dl.reverseMove(db, user) is None
+    for i in range(4):
+        assert dl.storeNewMove(db, user, blob(i))
+        assert dl.storeNewMove(db, other, blob(10 + i))
+    assert dl.getBytes(db, user) == blob(3) and dl.getBytes(db, other) == blob(13)
+    # the move ids are counted per game, reversing only touches the game of the user:
+    assert dl.reverseMove(db, user) == blob(1)
+    assert dl.getBytes(db, user) == blob(1) and dl.getBytes(db, other) == blob(13)
+    assert dl.reverseMove(db, user) is None
+    assert dl.endGame(db, other, "1.e4 e5", "DRAW") and not dl.endGame(db, other, "", "DRAW")
+    assert dl.getBytes(db, other) is None and dl.getBytes(db, user) == blob(1)
+    # a new game starts at move 0:
+    assert dl.storeNewMove(db, other, blob(20))
+    with db.connection() as connection:
+        assert connection.execute("SELECT COUNT(*) FROM finished_games;").fetchone()[0] == 1
+        assert connection.execute("SELECT move_id FROM gamestate JOIN active_games ON game_id = active_games.id " + \
+            "WHERE user = ?;", (other,)).fetchall() == [(0,)]
+    db.close()
+
+def test_dataLayer_legacy_game_cached(tmp_path):
+    # a game stored as protobuf (like the games in chupochess.db) stays playable when its board is cached and reused
+    db = ConnectionPool(str(tmp_path / 'test.db'))
+    dl.migrate(db)
+    dl.storeNewMove(db, 'a', Board.startingPosition().toProto().SerializeToString())
+    cache = BoardCache()
+    cache.put('a', Board.fromBytes(dl.getBytes(db, 'a')))
+    for source, target in [(52, 36), (11, 27), (36, 27), (3, 27), (57, 42), (27, 51)]:
+        board = cache.get('a')
+        record = board.makeMove(source, target, True)
+        assert record is not None
+        dl.storeNewMove(db, 'a', board.toBytes(), (source, target, None))
+        cache.put('a', board)
+    assert dl.getBytes(db, 'a') == cache.get('a').toBytes()
+    assert cache.get('a').gameState == GameState.IDLE and cache.get('a').material['P'] == 6
+    db.close()
+
+def test_dataLayer_migrate(tmp_path):
+    db = ConnectionPool(str(tmp_path / 'test.db'))
+    assert dl.migrate(db, 1) == 1
+    with db.connection() as connection, connection:
+        # legacy data: FEN table and two active games of one user
+        connection.execute("CREATE TABLE game_state (id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, game_id INTEGER NOT NULL, move_id INTEGER NOT NULL, extended_fen TEXT NOT NULL);")
+        connection.executemany("INSERT INTO active_games (user, timestamp) VALUES (?, '');", [('a',), ('a',), ('b',)])
+        connection.executemany("INSERT INTO gamestate (game_id, move_id, board) VALUES (?, 0, x'00');", [(1,), (2,), (3,)])
+    assert dl.migrate(db) == len(MIGRATIONS) == 5
+    assert dl.migrate(db) == 5
+    with db.connection() as connection:
+        assert connection.execute("PRAGMA user_version;").fetchone()[0] == 5
+        tables = [row[0] for row in connection.execute("SELECT name FROM sqlite_master;")]
+        assert 'game_state' not in tables and 'gamestate_game_move' in tables and 'active_games_user' in tables
+        assert connection.execute("SELECT id FROM active_games ORDER BY id;").fetchall() == [(2,), (3,)]
+        assert connection.execute("SELECT game_id FROM gamestate ORDER BY game_id;").fetchall() == [(2,), (3,)]
+        with pytest.raises(sqlite3.IntegrityError):
+            connection.execute("INSERT INTO active_games (user, timestamp) VALUES ('a', '');")
+    db.close()
+
+def test_dataLayer_storeMovePair(tmp_path):
+    db = ConnectionPool(str(tmp_path / 'test.db'), synchronous='full')
+    dl.migrate(db)
+    with db.connection() as connection:
+        assert connection.execute("PRAGMA journal_mode;").fetchone()[0] == 'wal'
+        assert connection.execute("PRAGMA synchronous;").fetchone()[0] == 2
+    assert dl.storeNewMove(db, 'a', blob(0))
+    assert dl.storeMovePair(db, 'a', blob(1), blob(2))
+    assert dl.getBytes(db, 'a') == blob(2)
+    # both moves or none:
+    with pytest.raises(sqlite3.IntegrityError):
+        dl.storeMovePair(db, 'a', blob(3), None)
+    assert dl.getBytes(db, 'a') == blob(2)
+    assert dl.reverseMove(db, 'a') == blob(0)
+    db.close()
+    with pytest.raises(Exception):
+        ConnectionPool(str(tmp_path / 'test.db'), synchronous='NORMAL; DROP TABLE gamestate')
+
+def test_dataLayer_moveHistory(tmp_path, monkeypatch):
+    monkeypatch.setattr(dl, 'KEYFRAME_INTERVAL', 4)
+    db = ConnectionPool(str(tmp_path / 'test.db'))
+    dl.migrate(db)
+    board = Board.startingPosition()
+    snapshots = [board.toBytes()]
+    dl.storeNewMove(db, 'a', snapshots[0])
+    moves = TrainingHelper.replay('1.e4 c5 2.Nf3 d6 3.d4 cxd4 4.Nxd4 Nf6 5.Nc3 a6 6.Be3 e5 7.Nb3 Be6')[0]
+    for i in range(0, len(moves), 2):
+        for source, target in moves[i:i + 2]:
+            record = board.makeMove(source, target, True)
+            snapshots.append(board.toBytes())
+        dl.storeMovePair(db, 'a', snapshots[-2], snapshots[-1], moves[i] + (None,), (record.source, record.target, None))
+        assert dl.getBytes(db, 'a') == snapshots[-1]
+    with db.connection() as connection:
+        assert connection.execute("SELECT move_id FROM gamestate;").fetchall() == [(0,), (4,), (8,), (12,)]
+        assert connection.execute("SELECT COUNT(*) FROM moves;").fetchone()[0] == 14
+    # legacy protobuf keyframes are rewritten in the compact encoding when the game is restored:
+    legacy = Board.fromBytes(snapshots[12])
+    with db.connection() as connection, connection:
+        connection.execute("UPDATE gamestate SET board = ? WHERE move_id = 12;", (legacy.toProto().SerializeToString(),))
+    restored = Board.fromBytes(dl.getBytes(db, 'a'))
+    assert str(restored) == str(Board.fromBytes(snapshots[-1]))
+    with db.connection() as connection:
+        assert Board.fromBytes(connection.execute("SELECT board FROM gamestate WHERE move_id = 12;").fetchone()[0]) == legacy
+        assert connection.execute("SELECT board FROM gamestate WHERE move_id = 12;").fetchone()[0][:2] == b'CB'
+    # rewinding replays from the nearest keyframe before the target:
+    for ply in range(12, -1, -2):
+        assert dl.reverseMove(db, 'a') == snapshots[ply]
+        assert dl.getBytes(db, 'a') == snapshots[ply]
+    assert dl.reverseMove(db, 'a') is None
+    with db.connection() as connection:
+        assert connection.execute("SELECT COUNT(*) FROM moves;").fetchone()[0] == 0
+    db.close()
+
 def test_without_fixture():
     assert True
 